@@ -1,9 +1,11 @@
 from invoke import Collection
-from invoke_tasks import docker, kubernetes, docker_swarm, terraform
 
-# Create collections from modules
+from invoke_tasks.lazy import lazy_collection
+
+# Create collections from modules; task modules are only imported when one of their tasks runs
 ns = Collection()
-ns.add_collection(Collection.from_module(docker))
-ns.add_collection(Collection.from_module(kubernetes), name="k8s")
-ns.add_collection(Collection.from_module(docker_swarm), name='swarm')
-ns.add_collection(Collection.from_module(terraform), name='tf')
\ No newline at end of file
+ns.add_collection(lazy_collection("invoke_tasks.docker"))
+ns.add_collection(lazy_collection("invoke_tasks.kubernetes"), name="k8s")
+ns.add_collection(lazy_collection("invoke_tasks.docker_swarm"), name='swarm')
+ns.add_collection(lazy_collection("invoke_tasks.terraform"), name='tf')
+ns.add_collection(lazy_collection("invoke_tasks.benchmarks"), name='bench')
@@ -0,0 +1,178 @@
+"""
+Minimal HTTP/1.1 client on asyncio streams, for long-lived streaming responses.
+
+Thousands of concurrent streams (pod logs, watches, load test requests) cost one coroutine each
+instead of a thread or a process. Only what those uses need is supported: GET/POST style requests,
+Content-Length and chunked bodies, TLS with client certificates, reading the body line by line
+or as a whole, and keep-alive connections (Connection) for request after request.
+"""
+import asyncio
+import ssl
+from urllib.parse import urlencode, urlsplit
+
+
+class HTTPStatusError(Exception):
+    def __init__(self, status, body):
+        super().__init__(f"HTTP {status}: {body[:500].decode(errors='replace')}")
+        self.status = status
+        self.body = body
+
+
+def ssl_context(ca_file=None, cert_file=None, key_file=None, verify=True):
+    context = ssl.create_default_context(cafile=ca_file)
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    if cert_file:
+        context.load_cert_chain(cert_file, key_file)
+    return context
+
+
+class Response:
+    """Status, headers and the body reader of a response; close() drops the connection."""
+
+    def __init__(self, status, headers, reader, writer):
+        self.status = status
+        self.headers = headers
+        self.reader = reader
+        self.writer = writer
+        self.chunked = headers.get("transfer-encoding", "").lower() == "chunked"
+        self.remaining = int(headers["content-length"]) if "content-length" in headers else None
+
+    async def read_chunk(self):
+        """The next piece of the body, b"" at its end."""
+        if self.chunked:
+            size_line = await self.reader.readline()
+            if not size_line.strip():
+                return b""
+            size = int(size_line.split(b";")[0], 16)
+            if size == 0:
+                return b""
+            data = await self.reader.readexactly(size + 2)
+            return data[:-2]
+        if self.remaining is not None:
+            if self.remaining <= 0:
+                return b""
+            data = await self.reader.read(min(self.remaining, 65536))
+            self.remaining -= len(data)
+            return data
+        return await self.reader.read(65536)
+
+    async def read(self):
+        body = []
+        while chunk := await self.read_chunk():
+            body.append(chunk)
+        return b"".join(body)
+
+    async def lines(self, max_line=1024 * 1024):
+        """Yield the body line by line (without the newline); overlong lines are split at `max_line`."""
+        buffer = b""
+        while chunk := await self.read_chunk():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                yield line
+            while len(buffer) > max_line:
+                yield buffer[:max_line]
+                buffer = buffer[max_line:]
+        if buffer:
+            yield buffer
+
+    def close(self):
+        self.writer.close()
+
+
+def _request_head(method, parts, target, headers, body, keep_alive):
+    headers = {"Host": parts.netloc, "Connection": "keep-alive" if keep_alive else "close", "Accept": "*/*",
+               **{key.title(): value for key, value in (headers or {}).items()}}
+    lines = [f"{method} {target} HTTP/1.1"] + [f"{key}: {value}" for key, value in headers.items()]
+    if body is not None:
+        lines.append(f"Content-Length: {len(body)}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode() + (body or b"")
+
+
+async def _open(parts, ssl_context, timeout):
+    secure = parts.scheme == "https"
+    port = parts.port or (443 if secure else 80)
+    context = (ssl_context or ssl.create_default_context()) if secure else None
+    return await asyncio.wait_for(asyncio.open_connection(parts.hostname, port, ssl=context), timeout)
+
+
+async def _read_head(reader, writer, url, timeout):
+    status_line = await asyncio.wait_for(reader.readline(), timeout)
+    if not status_line:
+        writer.close()
+        raise ConnectionError(f"{url}: connection closed before a response")
+    fields = status_line.split()
+    if len(fields) < 2 or not fields[0].startswith(b"HTTP/") or not fields[1].isdigit():
+        writer.close()
+        raise ConnectionError(f"{url}: malformed status line {status_line[:100]!r}")
+    status = int(fields[1])
+    response_headers = {}
+    while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+        key, _, value = line.decode("latin-1").partition(":")
+        response_headers[key.strip().lower()] = value.strip()
+    return Response(status, response_headers, reader, writer)
+
+
+async def request(url, method="GET", params=None, headers=None, body=None, ssl_context=None, timeout=30):
+    """
+    Send a request on a new connection and return the Response once its headers arrived.
+
+    A status other than 2xx raises HTTPStatusError with the body. The caller reads the body and
+    closes the response (the connection is not reused).
+    """
+    parts = urlsplit(url)
+    reader, writer = await _open(parts, ssl_context, timeout)
+    query = "&".join(filter(None, [parts.query, urlencode(params or {})]))
+    target = (parts.path or "/") + (f"?{query}" if query else "")
+    writer.write(_request_head(method, parts, target, headers, body, keep_alive=False))
+    await writer.drain()
+
+    response = await _read_head(reader, writer, url, timeout)
+    if not 200 <= response.status < 300:
+        error_body = await response.read()
+        response.close()
+        raise HTTPStatusError(response.status, error_body)
+    return response
+
+
+class Connection:
+    """
+    Keep-alive connection to one server for a sequence of requests, e.g. a load test client.
+
+    Each request reads its whole response so the next one can reuse the socket; the connection is
+    opened on first use and again after the server closed it.
+    """
+
+    def __init__(self, url, ssl_context=None, timeout=30):
+        self.url = url
+        self.parts = urlsplit(url)
+        self.ssl_context = ssl_context
+        self.timeout = timeout
+        self.reader = self.writer = None
+
+    async def request(self, method="GET", target=None, headers=None, body=None):
+        """(status, headers, body) of one request; the status isn't checked."""
+        if self.writer is None or self.writer.is_closing():
+            self.reader, self.writer = await _open(self.parts, self.ssl_context, self.timeout)
+        if target is None:
+            target = (self.parts.path or "/") + (f"?{self.parts.query}" if self.parts.query else "")
+        try:
+            self.writer.write(_request_head(method, self.parts, target, headers, body, keep_alive=True))
+            await self.writer.drain()
+            response = await _read_head(self.reader, self.writer, self.url, self.timeout)
+            bodiless = method == "HEAD" or response.status in (204, 304) or 100 <= response.status < 200
+            data = b"" if bodiless else await asyncio.wait_for(response.read(), self.timeout)
+        except BaseException:
+            self.close()
+            raise
+        if (response.headers.get("connection", "").lower() == "close"
+                or not bodiless and not response.chunked and response.remaining is None):
+            self.close()
+        return response.status, response.headers, data
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
@@ -0,0 +1,528 @@
+import base64
+import contextlib
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+from invoke import task, Exit, Config, Context
+
+# Wall-clock budget (seconds) for a cold `invoke --list`
+STARTUP_BUDGET = float(os.getenv("INVOKE_STARTUP_BUDGET", 0.5))
+
+# Where `bench.tasks` keeps its results, compared against on the next run
+BENCH_RESULTS = Path(os.getenv("BENCH_RESULTS", ".bench/tasks.json"))
+
+# Where `bench.loadtest` keeps its runs by label, to compare e.g. ingress settings side by side
+LOADTEST_RESULTS = Path(os.getenv("LOADTEST_RESULTS", ".bench/loadtest.json"))
+
+# Wall time growth above which a task counts as regressed: both relative and in seconds, to ignore noise
+REGRESSION_THRESHOLD = 0.2
+REGRESSION_MIN_SECONDS = 0.1
+
+
+def _time_command(args, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(args, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+@task(help={
+    "runs": "Number of cold runs to take the median of",
+    "budget": "Fail when the median is slower than this many seconds (default INVOKE_STARTUP_BUDGET or 0.5)",
+    "importtime": "Also show the slowest imports of a cold start",
+})
+def startup(c, runs=5, budget=None, importtime=False):
+    """Benchmark cold `invoke --list` startup and fail if it exceeds the time budget"""
+    budget = STARTUP_BUDGET if budget is None else float(budget)
+    list_cmd = [sys.executable, "-m", "invoke", "--list"]
+    baseline_cmd = [sys.executable, "-c", "import invoke.program"]
+
+    baseline = statistics.median(_time_command(baseline_cmd, int(runs)))
+    timings = _time_command(list_cmd, int(runs))
+    median = statistics.median(timings)
+
+    print(f"invoke --list: median {median * 1000:.0f} ms, min {min(timings) * 1000:.0f} ms, "
+          f"max {max(timings) * 1000:.0f} ms over {runs} runs")
+    print(f"interpreter + invoke import alone: {baseline * 1000:.0f} ms, task collection overhead: "
+          f"{(median - baseline) * 1000:.0f} ms")
+
+    if importtime:
+        result = subprocess.run([sys.executable, "-X", "importtime", "-m", "invoke", "--list"],
+                                capture_output=True, text=True)
+        imports = []
+        for line in result.stderr.splitlines():
+            parts = line.split("|")
+            if len(parts) == 3 and parts[1].strip().isdigit():
+                imports.append((int(parts[1]), parts[2].rstrip()))
+        print("\nSlowest imports (cumulative):")
+        for micros, module in sorted(imports, reverse=True)[:15]:
+            print(f"  {micros / 1000:8.1f} ms {module}")
+
+    if median > budget:
+        raise Exit(f"Startup regression: {median * 1000:.0f} ms exceeds the {budget * 1000:.0f} ms budget", code=1)
+    print(f"Within the {budget * 1000:.0f} ms budget.")
+
+
+# Benchmark name -> function(c, fixture) running real tasks against the fakes, registered by @case
+CASES = {}
+
+
+def case(name, responses=None, docker_routes=None):
+    """
+    Register a task benchmark, with canned shim output `responses` (see fakes.install_shims) and
+    fake Docker Engine API responses `docker_routes` (see fakes.FakeDockerDaemon).
+    """
+    def register(func):
+        CASES[name] = (func, responses or {}, docker_routes or {})
+        return func
+    return register
+
+
+@case("deploy_monitoring_stack")
+def _deploy_monitoring_stack(c, fixture):
+    from invoke_tasks.kubernetes.monitoring import deploy_monitoring_stack
+
+    deploy_monitoring_stack(c)
+
+
+@case("bootstrap")
+def _bootstrap(c, fixture):
+    from invoke_tasks.kubernetes.bootstrap import bootstrap
+
+    fixture.kube.add("operator.tigera.io/v1", "Installation", "default")
+    bootstrap(c, skip="cluster")
+
+
+@case("clean_namespace")
+def _clean_namespace(c, fixture):
+    from invoke_tasks.kubernetes.setup_cluster import clean_namespace
+
+    for i in range(30):
+        fixture.kube.add("v1", "Pod", f"web-{i}", "bench")
+    for i in range(10):
+        fixture.kube.add("v1", "ConfigMap", f"config-{i}", "bench")
+        fixture.kube.add("v1", "Secret", f"secret-{i}", "bench")
+    for i in range(3):
+        fixture.kube.add("apps/v1", "Deployment", f"app-{i}", "bench")
+    fixture.kube.add("longhorn.io/v1beta2", "Volume", "data", "bench")
+    clean_namespace(c, "bench", timeout=30)
+
+
+@case("node_taints")
+def _node_taints(c, fixture):
+    from invoke_tasks.kubernetes.setup_cluster import add_taint, remove_taint, get_cluster_ip
+
+    fixture.kube.add("v1", "Node", "cp-1", metadata={"labels": {"node-role.kubernetes.io/control-plane": ""}}, spec={},
+                     status={"addresses": [{"type": "InternalIP", "address": "10.0.0.1"}]})
+    for i in range(20):
+        fixture.kube.add("v1", "Node", f"worker-{i}", spec={},
+                         status={"addresses": [{"type": "InternalIP", "address": f"10.0.1.{i}"}]})
+    for _ in range(3):
+        add_taint(c)
+        remove_taint(c)
+    get_cluster_ip(c)
+
+
+@case("run_dag_output")
+def _run_dag_output(c, fixture):
+    from invoke_tasks.parallel import run_dag
+
+    def step(ctx):
+        ctx.run("echo hidden-output", hide=True)
+        ctx.run("echo hidden-error >&2", hide="err")
+        ctx.run("echo shown-output", hide=False)
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        results = run_dag(c, {f"step-{i}": (step, []) for i in range(4)})
+    lines = output.getvalue().splitlines()
+    if any("hidden" in line for line in lines):
+        raise RuntimeError(f"hidden command output was printed: {lines}")
+    if sorted(lines) != [f"[step-{i}] shown-output" for i in range(4)] or any(status != "ok" for status, _ in results.values()):
+        raise RuntimeError(f"unexpected run_dag output: {lines} {results}")
+
+
+# A freshly deployed release as the API server stores it: quantities canonical ("500m", "1Gi"), defaults filled in
+RECONCILE_MANIFEST = """
+apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: web
+spec:
+  replicas: 2
+  template:
+    spec:
+      containers:
+        - name: web
+          image: nginx:1.21.6
+          resources:
+            requests: {cpu: "0.5", memory: 1024Mi}
+            limits: {cpu: 1, memory: 2048Mi}
+"""
+
+
+@case("reconcile_in_sync")
+def _reconcile_in_sync(c, fixture):
+    import gzip
+
+    from invoke_tasks.kubernetes import reconcile
+
+    record = gzip.compress(json.dumps({"manifest": RECONCILE_MANIFEST, "chart": {"metadata": {"version": "1.0.0"}}}).encode())
+    fixture.kube.add("v1", "Secret", "sh.helm.release.v1.web.v1", "bench",
+                     metadata={"labels": {"owner": "helm", "name": "web", "status": "deployed", "version": "1",
+                                          "invoke-tasks/desired-state": "bench-state"}},
+                     data={"release": base64.b64encode(base64.b64encode(record)).decode()})
+    fixture.kube.add("apps/v1", "Deployment", "web", "bench",
+                     metadata={"generation": 1, "annotations": {reconcile.RELEASE_ANNOTATION: "web",
+                                                                 reconcile.RELEASE_NAMESPACE_ANNOTATION: "bench"}},
+                     spec={"replicas": 2, "selector": {}, "template": {"spec": {"containers": [{
+                         "name": "web", "image": "nginx:1.21.6", "imagePullPolicy": "IfNotPresent",
+                         "resources": {"requests": {"cpu": "500m", "memory": "1Gi"},
+                                       "limits": {"cpu": "1", "memory": "2Gi"}}}]}}})
+    desired = {"web": {"spec": {"release": "web", "namespace": "bench", "state": "bench-state"}, "task": (None, None)}}
+    reconciler = reconcile.Reconciler(c, desired, settle=0, dry_run=True)
+    reconciler.load("web")
+    for target in reconciler.watch_targets():
+        reconciler.list_and_check(target)
+    if reconciler.queue.pending:
+        raise RuntimeError(f"freshly deployed release counted as drifted: {reconciler.queue.pending}")
+
+
+# Five hours of 15s samples for vault-0, long before the run: CPU rising evenly to 1 core, memory flat at 100Mi
+CAPACITY_END = 1_700_000_000
+CAPACITY_SAMPLES = 1200
+CAPACITY_RECORDED = {
+    "container_cpu_usage_seconds_total": [{
+        "metric": {"namespace": "vault", "pod": "vault-0", "container": "vault"},
+        "values": [[CAPACITY_END - 15 * i, str(i / (CAPACITY_SAMPLES - 1))] for i in range(CAPACITY_SAMPLES)],
+    }],
+    "container_memory_working_set_bytes": [{
+        "metric": {"namespace": "vault", "pod": "vault-0", "container": "vault"},
+        "values": [[CAPACITY_END - 15 * i, str(100 * 1024 ** 2)] for i in range(CAPACITY_SAMPLES)],
+    }],
+}
+# p95 and peak plus 20% headroom
+CAPACITY_EXPECTED = {"server": {"resources": {"requests": {"cpu": "1140m", "memory": "120Mi"},
+                                              "limits": {"memory": "120Mi"}}}}
+
+
+@case("capacity_report")
+def _capacity_report(c, fixture):
+    import yaml
+
+    from invoke_tasks.fakes import FakePrometheus
+    from invoke_tasks.kubernetes.capacity import capacity_report
+
+    record = fixture.directory / "capacity.json"
+    with FakePrometheus(CAPACITY_RECORDED) as prometheus:
+        capacity_report(c, releases="vault", window="5h", prometheus=prometheus.url, end=CAPACITY_END,
+                        output_dir=fixture.directory / "live", record=record)
+    # Replaying the recording gives the same recommendations
+    with FakePrometheus.from_file(record) as prometheus:
+        capacity_report(c, releases="vault", window="5h", prometheus=prometheus.url, end=CAPACITY_END,
+                        output_dir=fixture.directory / "replay")
+    for run in ("live", "replay"):
+        values = yaml.safe_load((fixture.directory / run / "vault-resources.yaml").read_text())
+        if values != CAPACITY_EXPECTED:
+            raise RuntimeError(f"{run} recommendations {values}, expected {CAPACITY_EXPECTED}")
+
+
+@case("loadtest")
+def _loadtest(c, fixture):
+    import asyncio
+
+    from invoke_tasks.fakes import FakeWebServer
+    from invoke_tasks.loadtest import LoadTest
+
+    # Every 10th request gets a 503, every one takes at least 5ms
+    for rate in (None, 200):
+        with FakeWebServer(latency=0.005, fail_every=10) as server:
+            result = asyncio.run(LoadTest(server.url, "web.bench", rate=rate, concurrency=4, duration=0.5).run())
+        served = server.requests["web.bench"]
+        latency = result["latency_ms"]
+        problems = []
+        if not served or result["requests"] != served:
+            problems.append(f"{result['requests']} requests counted, {served} served")
+        if result["errors"] != {"HTTP 503": served // 10}:
+            problems.append(f"errors {result['errors']}, expected {served // 10} HTTP 503")
+        if rate and not 0.9 * rate <= result["rps"] <= 1.1 * rate:
+            problems.append(f"{result['rps']} requests/s at a rate of {rate}/s")
+        if not 5 <= latency["p50"] <= latency["p99"] <= latency["max"]:
+            problems.append(f"latency percentiles {latency}")
+        if problems:
+            raise RuntimeError(f"{result['mode']}: " + "; ".join(problems))
+
+    # A response that isn't HTTP counts as an error instead of crashing the client
+    async def garbage(reader, writer):
+        await reader.readline()
+        writer.write(b"garbage\r\n\r\n")
+        await writer.drain()
+        writer.close()
+
+    async def against_garbage():
+        server = await asyncio.start_server(garbage, "127.0.0.1", 0)
+        async with server:
+            port = server.sockets[0].getsockname()[1]
+            return await LoadTest(f"http://127.0.0.1:{port}/", concurrency=1, duration=0.1).run()
+
+    result = asyncio.run(against_garbage())
+    if not result["errors"].get("ConnectionError") or result["statuses"]:
+        raise RuntimeError(f"malformed responses counted as {result['statuses']}, errors {result['errors']}")
+
+
+@case("full_cleanup", responses={
+    "docker ps -a": {"stdout": "".join(f"{i:012x}   registry.k8s.io/pause:3.9   k8s_POD_pod-{i}\n" for i in range(3))},
+})
+def _full_cleanup(c, fixture):
+    from invoke_tasks.kubernetes.setup_cluster import full_cleanup
+
+    full_cleanup(c)
+
+
+@case("deploy_to_swarm")
+def _deploy_to_swarm(c, fixture):
+    from invoke_tasks.docker_swarm import deploy_to_swarm
+
+    deploy_to_swarm(c, "docker_swarm/docker-compose-swarm.yml")
+
+
+SWARM_NODE = {
+    "ID": "n1", "Spec": {"Availability": "active"}, "Status": {"State": "ready"},
+    "ManagerStatus": {"Leader": True}, "Description": {"Hostname": "manager", "Engine": {"EngineVersion": "27.0.0"}},
+}
+SWARM_SERVICE = {
+    "Spec": {"Name": "hosting_traefik", "Labels": {"com.docker.stack.namespace": "hosting"},
+             "TaskTemplate": {"ContainerSpec": {"Image": "traefik:v2.5"}}},
+    "ServiceStatus": {"RunningTasks": 1, "DesiredTasks": 1},
+}
+
+
+@case("swarm_sequence", docker_routes={
+    "POST /swarm/init": "n1",
+    "GET /swarm": {"JoinTokens": {"Worker": "SWMTKN-1-worker", "Manager": "SWMTKN-1-manager"}},
+    "GET /nodes": [SWARM_NODE],
+    "GET /services": [SWARM_SERVICE],
+    "GET /info": {"Swarm": {"LocalNodeState": "active"}},
+})
+def _swarm_sequence(c, fixture):
+    from invoke_tasks import docker_swarm
+
+    os.environ["SWARM_MASTER_IP"] = "10.0.0.1"
+    docker_swarm.setup_master_node(c)
+    docker_swarm.get_worker_join_token(c)
+    docker_swarm.deploy_to_swarm(c, "docker_swarm/docker-compose-swarm.yml")
+    docker_swarm.list_nodes(c)
+    docker_swarm.list_stack_services(c)
+    docker_swarm.status(c)
+
+
+class Fixture:
+    """The fakes one benchmark runs against, and the environment that points the tasks at them."""
+
+    def __init__(self, directory, responses, docker_routes, latency):
+        from invoke_tasks import fakes
+
+        self.directory = Path(directory)
+        self.kube = fakes.FakeKubeAPI()
+        self.docker = fakes.FakeDockerDaemon(self.directory / "docker.sock", docker_routes)
+        self.env = {
+            **fakes.install_shims(self.directory / "bin", responses),
+            "BENCH_SHIM_LATENCY": str(latency),
+            "BENCH_FAKE_API": self.kube.url,
+            "KUBECONFIG": self.kube.kubeconfig(self.directory / "kubeconfig"),
+            "HELM_REPOSITORY_CONFIG": str(self.directory / "helm" / "repositories.yaml"),
+            "HELM_REPOSITORY_CACHE": str(self.directory / "helm" / "repository"),
+            "DOCKER_SOCKET": str(self.directory / "docker.sock"),
+            "DOCKER_HOST": "",
+            "DOCKER_CONTEXT": "default",
+            "SWARM_MASTER_IP": "",
+        }
+
+    @contextlib.contextmanager
+    def active(self):
+        from invoke_tasks import docker
+        from invoke_tasks.kubernetes import api, cache, helm
+
+        saved = {key: os.environ.get(key) for key in self.env}
+        patched = [(docker, "DOCKER_SOCKET", self.env["DOCKER_SOCKET"]),
+                   (docker, "DOCKER_HEALTH_CACHE", self.directory / "docker-healthy"),
+                   (docker, "_docker_healthy", None),
+                   (helm, "VERSION_CACHE", self.directory / "chart-versions.json")]
+        originals = [(module, attr, getattr(module, attr)) for module, attr, _ in patched]
+        os.environ.update(self.env)
+        for module, attr, value in patched:
+            setattr(module, attr, value)
+        api.api_client.cache_clear()
+        api.dynamic.cache_clear()
+        cache.reset()
+        try:
+            with self.kube, self.docker:
+                yield self
+        finally:
+            for key, value in saved.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+            for module, attr, value in originals:
+                setattr(module, attr, value)
+            api.api_client.cache_clear()
+            api.dynamic.cache_clear()
+            cache.reset()
+
+
+@contextlib.contextmanager
+def _count_spawns():
+    """Count every process started from this interpreter (invoke's runners, subprocess.run, ...)."""
+    spawns = []
+    execute_child = subprocess.Popen._execute_child
+
+    def counting(self, args, *rest, **kwargs):
+        spawns.append(args)
+        return execute_child(self, args, *rest, **kwargs)
+
+    subprocess.Popen._execute_child = counting
+    try:
+        yield spawns
+    finally:
+        subprocess.Popen._execute_child = execute_child
+
+
+def _measure(func, c, fixture):
+    """Run a benchmark once and return its wall time, spawn counts and API requests."""
+    from invoke_tasks.fakes import read_shim_log
+
+    read_shim_log(fixture.directory / "bin")
+    kube_before, docker_before = Counter(fixture.kube.requests), Counter(fixture.docker.requests)
+    output = io.StringIO()
+    error = None
+    start = time.perf_counter()
+    with _count_spawns() as spawns, contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        try:
+            func(c, fixture)
+        except BaseException as e:  # tasks call exit() on some failures
+            error = repr(e)
+    wall = time.perf_counter() - start
+
+    calls = [" ".join([call["tool"]] + call["args"]) for call in read_shim_log(fixture.directory / "bin")
+             if call["tool"] != "sudo"]
+    return {
+        "wall": wall,
+        "spawns": len(spawns),
+        "tool_calls": len(calls),
+        "redundant": sum(count - 1 for count in Counter(calls).values()),
+        "api_requests": sum((fixture.kube.requests - kube_before).values()),
+        "docker_requests": sum((fixture.docker.requests - docker_before).values()),
+        "error": error,
+        "calls": calls,
+    }
+
+
+def run_case(name, latency=0.05):
+    """Run benchmark `name` twice against fresh fakes: cold, then again with the state it left behind."""
+    func, responses, docker_routes = CASES[name]
+    config = Config(overrides={"run": {"pty": False, "hide": True, "in_stream": False}})
+    c = Context(config)
+    with tempfile.TemporaryDirectory(prefix="invoke-bench-") as directory:
+        with Fixture(directory, responses, docker_routes, latency).active() as fixture:
+            return {"cold": _measure(func, c, fixture), "warm": _measure(func, c, fixture)}
+
+
+@task(help={
+    "cases": "Comma separated benchmarks to run (default all), see CASES in invoke_tasks/benchmarks.py",
+    "latency": "Seconds every stubbed kubectl/helm/docker/... call takes",
+    "save": "Store the results in BENCH_RESULTS (default .bench/tasks.json) for the next comparison",
+    "fail_on_regression": "Exit non-zero when a task got slower or spawns more processes than last time",
+    "verbose": "List the stubbed commands each task ran",
+})
+def tasks(c, cases="", latency=0.05, save=True, fail_on_regression=False, verbose=False):
+    """Benchmark task orchestration overhead against stubbed CLIs and fake Kubernetes/Docker APIs"""
+    selected = [name.strip() for name in cases.split(",") if name.strip()] or list(CASES)
+    previous = json.loads(BENCH_RESULTS.read_text()) if BENCH_RESULTS.exists() else {}
+    results = {name: run_case(name, float(latency)) for name in selected}
+
+    print(f"{'task':<26}{'run':<6}{'wall':>9}{'spawns':>8}{'tools':>7}{'redundant':>11}{'api':>6}{'docker':>8}  vs last")
+    regressions = []
+    for name, runs in results.items():
+        for run, result in runs.items():
+            before = previous.get("results", {}).get(name, {}).get(run)
+            change = ""
+            if before:
+                change = f"{(result['wall'] - before['wall']) / before['wall'] * 100:+.0f}% wall, {result['spawns'] - before['spawns']:+d} spawns"
+                slower = result["wall"] - before["wall"]
+                if (slower > before["wall"] * REGRESSION_THRESHOLD and slower > REGRESSION_MIN_SECONDS
+                        or result["spawns"] > before["spawns"]):
+                    regressions.append(f"{name} ({run})")
+            print(f"{name:<26}{run:<6}{result['wall'] * 1000:>7.0f}ms{result['spawns']:>8}{result['tool_calls']:>7}"
+                  f"{result['redundant']:>11}{result['api_requests']:>6}{result['docker_requests']:>8}  {change}")
+            if result["error"]:
+                print(f"  failed: {result['error']}")
+            if verbose:
+                for command, count in Counter(result["calls"]).items():
+                    print(f"    {count}x {command}")
+
+    if save:
+        BENCH_RESULTS.parent.mkdir(parents=True, exist_ok=True)
+        stored = {**previous.get("results", {}), **results}
+        BENCH_RESULTS.write_text(json.dumps({"latency": float(latency), "time": time.time(), "results": stored}, indent=1))
+    if regressions:
+        print(f"\nSlower or more processes than the last run: {', '.join(regressions)}")
+        if fail_on_regression:
+            raise Exit(code=1)
+
+
+@task(help={
+    "url": "URL to load, e.g. https://<node ip>/ for the Traefik ingress",
+    "host": "Host header to send, to hit an ingress route by name (default: the URL's host)",
+    "rate": "Requests per second to schedule (open loop); default: as fast as --concurrency clients get answers",
+    "concurrency": "Keep-alive connections (with --rate: the most requests in flight at once)",
+    "duration": "Seconds to send requests for",
+    "timeout": "Seconds before a request counts as failed",
+    "insecure": "Don't verify the server's TLS certificate",
+    "label": "Name of the stored run (default: URL, host and mode)",
+})
+def loadtest(c, url="http://localhost/", host=None, rate=None, concurrency=10, duration=10, timeout=10,
+             insecure=False, label=None):
+    """Load an HTTP endpoint from asyncio clients and report RPS, errors and latency percentiles"""
+    import asyncio
+
+    from invoke_tasks import asynchttp
+    from invoke_tasks.loadtest import LoadTest
+
+    context = asynchttp.ssl_context(verify=False) if insecure else None
+    run = LoadTest(url, host, rate=float(rate) if rate else None, concurrency=int(concurrency),
+                   duration=float(duration), timeout=float(timeout), ssl_context=context)
+    print(f"Loading {url}{f' (Host: {host})' if host else ''} for {float(duration):g}s, "
+          f"{f'{float(rate):g} requests/s on up to {int(concurrency)} connections' if rate else f'{int(concurrency)} connections'}")
+    result = asyncio.run(run.run())
+    result["time"] = time.time()
+    label = label or f"{host or url} {result['mode']}"
+
+    latency = result["latency_ms"]
+    print(f"\n{result['requests']} requests, {result['rps']} requests/s, {result['error_rate']:.2%} errors")
+    for error, count in sorted(result["errors"].items(), key=lambda item: -item[1]):
+        print(f"  {count}x {error}")
+    print("latency ms: " + ", ".join(f"{key} {value:.2f}" for key, value in latency.items()))
+
+    stored = json.loads(LOADTEST_RESULTS.read_text()) if LOADTEST_RESULTS.exists() else {}
+    stored[label] = result
+    LOADTEST_RESULTS.parent.mkdir(parents=True, exist_ok=True)
+    LOADTEST_RESULTS.write_text(json.dumps(stored, indent=1, sort_keys=True))
+
+    print(f"\n{'run':<40} {'RPS':>9} {'errors':>8} {'p50':>8} {'p90':>8} {'p99':>8} {'p99.9':>8}")
+    for name, row in sorted(stored.items()):
+        marker = "*" if name == label else " "
+        ms = row["latency_ms"]
+        print(f"{marker}{name:<39} {row['rps']:9.1f} {row['error_rate']:8.2%} {ms['p50']:8.2f} {ms['p90']:8.2f} "
+              f"{ms['p99']:8.2f} {ms['p999']:8.2f}")
+    print(f"\n* measured now; latencies in ms, all runs are kept in {LOADTEST_RESULTS}")
@@ -2,61 +2,249 @@ import subprocess
 from invoke import task, Collection
 
 import base64
+import hashlib
+import http.client
+import json
 import os
 import platform
+import shutil
+import socket
+import ssl
 import time
 from pathlib import Path
+from urllib.parse import urlencode
 
-import yaml
-from dotenv import load_dotenv
 from invoke import task
 from loguru import logger
 
-load_dotenv()
+from invoke_tasks.wait import wait_for
 
 
-def check_docker_installed():
-    """Check if Docker is installed by running `docker --version`."""
+DOCKER_SOCKET = os.getenv("DOCKER_SOCKET", "/var/run/docker.sock")
+# The docker CLI's config directory: config.json (currentContext) and contexts/
+DOCKER_CONFIG_DIR = Path(os.getenv("DOCKER_CONFIG", Path.home() / ".docker"))
+WINDOWS_DOCKER_PIPE = r"\\.\pipe\docker_engine"
+
+# A healthy daemon is remembered on disk for this many seconds, shared by consecutive invoke runs;
+# the file holds the endpoint it was checked at
+DOCKER_HEALTH_TTL = float(os.getenv("DOCKER_HEALTH_TTL", 30))
+DOCKER_HEALTH_CACHE = Path.home() / ".cache" / "invoke-tasks" / "docker-healthy"
+
+# Endpoint of the daemon this process found healthy
+_docker_healthy = None
+
+
+class DockerEngineError(Exception):
+    """Error response from the Docker Engine API."""
+
+    def __init__(self, status, message):
+        super().__init__(f"Docker Engine API error {status}: {message}")
+        self.status = status
+        self.message = message
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=60):
+        super().__init__("docker", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def docker_endpoint():
+    """
+    (host, TLS directory or None, verify) of the daemon the docker CLI would talk to.
+
+    Like the CLI: DOCKER_HOST (with DOCKER_TLS_VERIFY / DOCKER_CERT_PATH), else the context named
+    by DOCKER_CONTEXT or config.json's currentContext, else the local socket ("" as host).
+    """
+    docker_host = os.getenv("DOCKER_HOST", "")
+    if docker_host:
+        tls = os.getenv("DOCKER_TLS_VERIFY", "") not in ("", "0")
+        return docker_host, (os.getenv("DOCKER_CERT_PATH") or str(DOCKER_CONFIG_DIR)) if tls else None, tls
+    context = os.getenv("DOCKER_CONTEXT")
+    if context is None:
+        try:
+            context = json.loads((DOCKER_CONFIG_DIR / "config.json").read_text()).get("currentContext")
+        except (OSError, ValueError):
+            context = None
+    if not context or context == "default":
+        return "", None, True
+    # The CLI stores contexts under the sha256 of their name
+    digest = hashlib.sha256(context.encode()).hexdigest()
     try:
-        subprocess.run(["docker", "--version"], check=True, capture_output=True, text=True)
-        print("Docker is installed and running.")
-    except subprocess.CalledProcessError:
-        print("Docker is not installed or not running correctly. Please install Docker and ensure it is running.")
-        exit(1)
+        meta = json.loads((DOCKER_CONFIG_DIR / "contexts" / "meta" / digest / "meta.json").read_text())
+    except OSError:
+        raise DockerEngineError(None, f"docker context '{context}' not found, see `docker context ls`")
+    endpoint = meta["Endpoints"]["docker"]
+    tls_dir = DOCKER_CONFIG_DIR / "contexts" / "tls" / digest / "docker"
+    return endpoint["Host"], str(tls_dir) if tls_dir.is_dir() else None, not endpoint.get("SkipTLSVerify")
 
 
-def start_docker():
-    """Start Docker daemon if it is not running."""
+def _engine_connection(timeout=60):
+    docker_host, tls_dir, verify = docker_endpoint()
+    if docker_host.startswith("tcp://"):
+        host, _, port = docker_host[len("tcp://"):].rstrip("/").partition(":")
+        if tls_dir is None:
+            return http.client.HTTPConnection(host, int(port or 2375), timeout=timeout)
+        context = ssl.create_default_context(cafile=os.path.join(tls_dir, "ca.pem")
+                                             if os.path.exists(os.path.join(tls_dir, "ca.pem")) else None)
+        if not verify:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        if os.path.exists(os.path.join(tls_dir, "cert.pem")):
+            context.load_cert_chain(os.path.join(tls_dir, "cert.pem"), os.path.join(tls_dir, "key.pem"))
+        return http.client.HTTPSConnection(host, int(port or 2376), timeout=timeout, context=context)
+    if docker_host.startswith("unix://"):
+        return _UnixHTTPConnection(docker_host[len("unix://"):], timeout)
+    if docker_host:
+        # ssh://, npipe://, fd://: talking to the local socket instead would act on another daemon
+        raise DockerEngineError(None, f"Docker host {docker_host} is not supported by the Engine API client, "
+                                      "use tcp:// (with TLS) or unix://, e.g. forward the remote socket with "
+                                      "`ssh -NL /tmp/docker.sock:/var/run/docker.sock <host>`")
+    if platform.system() == "Windows":
+        raise DockerEngineError(None, "the Engine API needs DOCKER_HOST=tcp://localhost:2375 on Windows")
+    return _UnixHTTPConnection(DOCKER_SOCKET, timeout)
+
+
+def engine_request(method, path, body=None, params=None, timeout=60):
+    """
+    Call the Docker Engine API on the local socket (or DOCKER_HOST) and return the decoded response.
+
+    JSON responses are parsed, anything else is returned as text. Raises DockerEngineError for
+    error statuses.
+    """
+    if params:
+        path = f"{path}?{urlencode(params)}"
+    connection = _engine_connection(timeout)
+    try:
+        payload = json.dumps(body).encode() if body is not None else None
+        headers = {"Content-Type": "application/json"} if payload is not None else {}
+        connection.request(method, path, body=payload, headers=headers)
+        response = connection.getresponse()
+        data = response.read()
+    finally:
+        connection.close()
+    if "json" in (response.getheader("Content-Type") or "") and data:
+        data = json.loads(data)
+    elif isinstance(data, bytes):
+        data = data.decode(errors="replace")
+    if response.status >= 400:
+        raise DockerEngineError(response.status, data.get("message", data) if isinstance(data, dict) else data)
+    return data
+
+
+def engine_stream(method, path, params=None, headers=None, timeout=600):
+    """
+    Call an Engine API endpoint that streams JSON progress messages (push, pull, build, ...).
+
+    Yields the decoded messages as they arrive. Raises DockerEngineError for error statuses; errors
+    reported inside the stream are yielded as `{"error": ...}` messages, as Docker sends them.
+    """
+    if params:
+        path = f"{path}?{urlencode(params)}"
+    connection = _engine_connection(timeout)
+    try:
+        connection.request(method, path, headers=headers or {})
+        response = connection.getresponse()
+        if response.status >= 400:
+            data = response.read()
+            try:
+                message = json.loads(data).get("message", data)
+            except ValueError:
+                message = data.decode(errors="replace")
+            raise DockerEngineError(response.status, message)
+        for line in response:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+    finally:
+        connection.close()
+
+
+def docker_responding():
+    """Check whether the Docker daemon answers, via a `/_ping` on its socket instead of `docker info`."""
+    if platform.system() == "Windows" and not os.getenv("DOCKER_HOST"):
+        if not os.path.exists(WINDOWS_DOCKER_PIPE):
+            return False
+        return subprocess.run(["docker", "info"], capture_output=True, text=True).returncode == 0
+    try:
+        return engine_request("GET", "/_ping", timeout=2) == "OK"
+    except PermissionError as e:
+        # The daemon may well be running, but every Engine API call would fail the same way
+        socket_path = docker_endpoint()[0].removeprefix("unix://") or DOCKER_SOCKET
+        raise PermissionError(f"No permission to use the Docker socket {socket_path}: add the user to the docker "
+                              "group (`sudo usermod -aG docker $USER`) and log in again") from e
+    except OSError:
+        return False
+    except DockerEngineError as e:
+        if e.status is None:  # an unsupported DOCKER_HOST or context, not a daemon that is down
+            raise
+        return False
+
+
+def wait_for_docker(timeout=150):
+    """Block until the Docker daemon responds, checking with backoff instead of fixed sleeps."""
+    wait_for(docker_responding, timeout=timeout, interval=0.5, description="the Docker daemon")
+
+
+def _start_docker_daemon():
     system = platform.system()
     if system == "Windows":
-        result = subprocess.run(["docker", "info"], capture_output=True, text=True)
-        if "error during connect" in result.stderr:
-            logger.info("Starting Docker Desktop...")
-            docker_desktop_path = r"C:\Program Files\Docker\Docker\Docker Desktop.exe"
-            if os.path.exists(docker_desktop_path):
-                logger.info(f"Found Docker Desktop at {docker_desktop_path}, starting it now...")
-                subprocess.Popen([docker_desktop_path], shell=True)
-            else:
-                logger.error(f"Docker Desktop executable not found at {docker_desktop_path}")
-                exit(1)
-            # Wait for Docker to start
-            max_attempts = 30
-            for attempt in range(max_attempts):
-                result = subprocess.run(["docker", "info"], capture_output=True, text=True)
-                if "error during connect" not in result.stderr:
-                    logger.info("Docker Desktop is running.")
-                    break
-                logger.info(f"Waiting for Docker Desktop to start... (attempt {attempt + 1}/{max_attempts})")
-                time.sleep(5)
-            else:
-                logger.error("Docker Desktop did not start in the expected time.")
-                exit(1)
+        logger.info("Starting Docker Desktop...")
+        docker_desktop_path = r"C:\Program Files\Docker\Docker\Docker Desktop.exe"
+        if os.path.exists(docker_desktop_path):
+            logger.info(f"Found Docker Desktop at {docker_desktop_path}, starting it now...")
+            subprocess.Popen([docker_desktop_path], shell=True)
+        else:
+            logger.error(f"Docker Desktop executable not found at {docker_desktop_path}")
+            exit(1)
     else:
-        result = subprocess.run(["systemctl", "is-active", "--quiet", "docker"])
-        if result.returncode != 0:
-            logger.info("Starting Docker service...")
-            subprocess.run(["sudo", "systemctl", "start", "docker"])
+        logger.info("Starting Docker service...")
+        subprocess.run(["sudo", "systemctl", "start", "docker"])
+
+    try:
+        wait_for_docker()
+    except TimeoutError as e:
+        logger.error(f"Docker did not start in the expected time: {e}")
+        exit(1)
+    logger.info("Docker is running.")
+
+
+def ensure_docker():
+    """
+    Make sure Docker is installed and its daemon is running, starting it if needed.
+
+    A healthy daemon is remembered for the rest of the process and, for DOCKER_HEALTH_TTL seconds,
+    on disk, so a sequence of swarm tasks probes the socket once instead of forking `docker` and
+    `systemctl` in every task. Only positive results are cached, keyed by the endpoint
+    docker_endpoint() resolves, so switching DOCKER_HOST or the context probes the new daemon.
+    """
+    global _docker_healthy
+    docker_host, tls_dir, verify = docker_endpoint()
+    endpoint = json.dumps([docker_host or f"unix://{DOCKER_SOCKET}", tls_dir, verify])
+    if _docker_healthy == endpoint:
+        return
+    try:
+        if (time.time() - DOCKER_HEALTH_CACHE.stat().st_mtime < DOCKER_HEALTH_TTL
+                and DOCKER_HEALTH_CACHE.read_text() == endpoint):
+            _docker_healthy = endpoint
+            return
+    except OSError:
+        pass
+
+    if not docker_responding():
+        if not shutil.which("docker"):
+            print("Docker is not installed or not running correctly. Please install Docker and ensure it is running.")
+            exit(1)
+        _start_docker_daemon()
 
+    _docker_healthy = endpoint
+    DOCKER_HEALTH_CACHE.parent.mkdir(parents=True, exist_ok=True)
+    DOCKER_HEALTH_CACHE.write_text(endpoint)
 
 
 @task
@@ -68,6 +256,5 @@ def check_docker(ctx):
 @task
 def start_docker_deamon(ctx):
     """Start Docker daemon if it is not running."""
-    check_docker_installed()
-    start_docker()
+    ensure_docker()
     print("Docker has been started successfully.")
@@ -1,16 +1,12 @@
 from invoke import task
+import json
 import os
 import subprocess
 
-from invoke import task
-from pyngrok import ngrok
+from invoke import task, Exit
 import time
 
-from dotenv import load_dotenv
-
-from invoke_tasks.docker import check_docker_installed, start_docker
-
-load_dotenv()  # This loads the variables from .env
+from invoke_tasks.docker import engine_request, ensure_docker
 
 
 @task
@@ -32,22 +28,19 @@ def remove_hosting_setup(ctx):
 @task
 def setup_master_node(ctx):
     """Initialize Docker Swarm on the master node using env vars."""
-    check_docker_installed()
-    start_docker()
+    ensure_docker()
     master_ip = os.getenv("SWARM_MASTER_IP")
     if not master_ip:
         raise ValueError("SWARM_MASTER_IP environment variable must be set")
     
-    ctx.run(f"docker swarm init --advertise-addr {master_ip}")
+    engine_request("POST", "/swarm/init", {"ListenAddr": "0.0.0.0:2377", "AdvertiseAddr": master_ip})
     print("Swarm master initialized.")
 
 @task
 def get_worker_join_token(ctx):
     """Fetch and print the worker join token for the swarm in .env format."""
-    check_docker_installed()
-    start_docker()
-    result = ctx.run("docker swarm join-token worker -q", hide=True)
-    worker_token = result.stdout.strip()
+    ensure_docker()
+    worker_token = engine_request("GET", "/swarm")["JoinTokens"]["Worker"]
     master_ip = os.getenv("SWARM_MASTER_IP")
     if not master_ip:
         raise ValueError("SWARM_MASTER_IP environment variable must be set")
@@ -61,56 +54,193 @@ def get_worker_join_token(ctx):
 @task
 def setup_worker_node(ctx):
     """Join a worker node to the Docker Swarm using env vars."""
-    check_docker_installed()
-    start_docker()
+    ensure_docker()
     join_token = os.getenv("SWARM_JOIN_TOKEN")
     master_ip = os.getenv("SWARM_MASTER_IP")
     if not join_token or not master_ip:
         raise ValueError("SWARM_JOIN_TOKEN and SWARM_MASTER_IP environment variables must be set")
     
-    ctx.run(f"docker swarm join --token {join_token} {master_ip}:2377")
+    engine_request("POST", "/swarm/join", {
+        "ListenAddr": "0.0.0.0:2377",
+        "RemoteAddrs": [f"{master_ip}:2377"],
+        "JoinToken": join_token,
+    })
     print("Worker node joined the swarm.")
 
 @task
 def deploy_to_swarm(ctx, compose_file):
     """Deploy a Docker Compose file to the swarm."""
-    check_docker_installed()
-    start_docker()
+    ensure_docker()
     stack_name = os.path.splitext(os.path.basename(compose_file))[0]
     ctx.run(f"docker stack deploy -c {compose_file} {stack_name}")
     print(f"Stack {stack_name} deployed to the swarm.")
 
+STACK_LABEL = "com.docker.stack.namespace"
+
+# Polls that may find the stack without services right after the deploy, before rollout gives up
+EMPTY_STACK_POLLS = 5
+
+
+def _stack_services(stack_name):
+    """{service name: service} of a stack, with ServiceStatus replica counts."""
+    filters = {"label": [f"{STACK_LABEL}={stack_name}"]}
+    services = engine_request("GET", "/services", params={"filters": json.dumps(filters), "status": "true"})
+    return {service["Spec"]["Name"]: service for service in services}
+
+
+def rollout_state(service, before, running):
+    """
+    (state, done) of one service's rollout, given the service as it was before the deploy (None if
+    it is new) and its number of running tasks.
+    """
+    desired = (service.get("ServiceStatus") or {}).get("DesiredTasks", 0)
+    update = service.get("UpdateStatus") or {}
+    if before is not None and service["Spec"]["TaskTemplate"] == before["Spec"]["TaskTemplate"]:
+        # Nothing to roll out: unchanged, or only labels/replicas changed
+        return ("converged" if running >= desired else "scaling"), running >= desired
+    if before is not None and update.get("StartedAt") == (before.get("UpdateStatus") or {}).get("StartedAt"):
+        return "pending", False
+    state = update.get("State")
+    if state in (None, "completed"):
+        return ("converged" if running >= desired else "starting"), running >= desired
+    # paused (a task failed and failure_action is pause) and rollback_paused need a human
+    return state, state in ("paused", "rollback_paused", "rollback_completed")
+
+
+@task(help={
+    "compose_file": "Stack file to deploy",
+    "stack_name": "Stack name (default: the compose file name, like deploy-to-swarm)",
+    "parallelism": "Replicas of dummy-server updated at the same time (DUMMY_UPDATE_PARALLELISM in the stack file)",
+    "timeout": "Seconds to wait for all services to converge",
+    "interval": "Seconds between polls of the services and their tasks",
+    "stall": "Warn when a service's rollout makes no progress for this many seconds",
+    "output": "Write the per-service timeline of running replicas as JSON to this file",
+})
+def rollout(ctx, compose_file="docker_swarm/docker-compose-swarm.yml", stack_name=None, parallelism=None, timeout=600,
+            interval=1, stall=60, output=None):
+    """Deploy a stack and follow its rolling update until every service converged, with the replicas available over time"""
+    ensure_docker()
+    stack_name = stack_name or os.path.splitext(os.path.basename(compose_file))[0]
+    before = _stack_services(stack_name)
+    env = {"DUMMY_UPDATE_PARALLELISM": str(parallelism)} if parallelism else {}
+    start = time.monotonic()
+    ctx.run(f"docker stack deploy -c {compose_file} {stack_name}", env=env)
+
+    timelines, states, finished, reported, changed_at, warned = {}, {}, {}, set(), {}, set()
+    polls = 0
+    while True:
+        now = time.monotonic() - start
+        services = _stack_services(stack_name)
+        polls += 1
+        # `docker stack deploy` creates the services before it returns, a few polls only cover a slow manager
+        if not services and polls >= EMPTY_STACK_POLLS:
+            raise Exit(f"Stack {stack_name} has no services after the deploy, check the stack name and {compose_file}",
+                       code=1)
+        names = {service["ID"]: name for name, service in services.items()}
+        tasks = engine_request("GET", "/tasks", params={"filters": json.dumps({"service": list(names)})}) if names else []
+        running = {name: 0 for name in services}
+        for swarm_task in tasks:
+            name = names.get(swarm_task["ServiceID"])
+            task_status = swarm_task.get("Status") or {}
+            if name is None:
+                continue
+            if task_status.get("State") == "running" and swarm_task.get("DesiredState") == "running":
+                running[name] += 1
+            elif task_status.get("State") in ("failed", "rejected") and swarm_task["ID"] not in reported:
+                reported.add(swarm_task["ID"])
+                print(f"{now:7.1f}s {name}: task {swarm_task.get('Slot', '')} {task_status['State']}: {task_status.get('Err', '')}")
+
+        for name, service in sorted(services.items()):
+            if name in finished:
+                continue
+            desired = (service.get("ServiceStatus") or {}).get("DesiredTasks", 0)
+            state, done = rollout_state(service, before.get(name), running[name])
+            timeline = timelines.setdefault(name, [])
+            if not timeline or timeline[-1][1:] != [running[name], desired] or states.get(name) != state:
+                timeline.append([round(now, 1), running[name], desired])
+                states[name] = state
+                changed_at[name] = now
+                print(f"{now:7.1f}s {name}: {running[name]}/{desired} running, {state}")
+            if done:
+                finished[name] = now
+            elif now - changed_at[name] > float(stall) and name not in warned:
+                warned.add(name)
+                message = (service.get("UpdateStatus") or {}).get("Message", "")
+                print(f"{now:7.1f}s {name}: no progress for {float(stall):.0f}s, rollout may be stuck {message}".rstrip())
+
+        if services and len(finished) == len(services) or now > float(timeout):
+            break
+        time.sleep(float(interval))
+
+    print(f"\n{'SERVICE':<40}{'RESULT':<20}{'SECONDS':>8}{'MIN AVAILABLE':>15}")
+    failed = []
+    for name in sorted(timelines):
+        desired = timelines[name][-1][2]
+        available = min(entry[1] for entry in timelines[name])
+        result = states[name] if name in finished else f"{states[name]} (timed out)"
+        seconds = f"{finished[name]:.1f}" if name in finished else "-"
+        print(f"{name:<40}{result:<20}{seconds:>8}{f'{available}/{desired}':>15}")
+        if result != "converged":
+            failed.append(name)
+    if output:
+        with open(output, "w") as f:
+            json.dump({name: {"result": states[name], "timeline": timeline,
+                              "seconds": round(finished[name], 1) if name in finished else None}
+                       for name, timeline in timelines.items()}, f, indent=1)
+    if failed:
+        raise Exit(f"Rollout of {', '.join(failed)} did not converge", code=1)
+    print(f"Stack {stack_name} converged in {max(finished.values(), default=0):.1f}s")
+
+
 @task
 def remove_deployment(ctx, compose_file):
     """Remove a deployed stack from the swarm."""
-    check_docker_installed()
-    start_docker()
+    ensure_docker()
     stack_name = os.path.splitext(os.path.basename(compose_file))[0]
     ctx.run(f"docker stack rm {stack_name}")
     print(f"Stack {stack_name} removed from the swarm.")
 
+@task
+def list_stack_services(ctx, stack_name=""):
+    """List the services of the deployed stacks (or of one stack) with their replica counts."""
+    ensure_docker()
+    label = "com.docker.stack.namespace"
+    filters = {"label": [f"{label}={stack_name}" if stack_name else label]}
+    services = engine_request("GET", "/services", params={"filters": json.dumps(filters), "status": "true"})
+    print(f"{'STACK':<24}{'SERVICE':<40}{'REPLICAS':<10}IMAGE")
+    for service in sorted(services, key=lambda service: service["Spec"]["Name"]):
+        spec = service["Spec"]
+        status = service.get("ServiceStatus") or {}
+        replicas = f"{status.get('RunningTasks', 0)}/{status.get('DesiredTasks', 0)}"
+        image = spec["TaskTemplate"]["ContainerSpec"]["Image"].split("@")[0]
+        print(f"{spec['Labels'].get(label, ''):<24}{spec['Name']:<40}{replicas:<10}{image}")
+
+
 @task
 def list_nodes(ctx):
     """List all nodes in the Docker Swarm."""
-    check_docker_installed()
-    start_docker()
-    ctx.run("docker node ls")
+    ensure_docker()
+    nodes = engine_request("GET", "/nodes")
+    print(f"{'ID':<27}{'HOSTNAME':<24}{'STATUS':<9}{'AVAILABILITY':<14}{'MANAGER STATUS':<16}ENGINE VERSION")
+    for node in sorted(nodes, key=lambda node: node["Description"]["Hostname"]):
+        manager = node.get("ManagerStatus") or {}
+        manager_status = "Leader" if manager.get("Leader") else manager.get("Reachability", "")
+        print(f"{node['ID']:<27}{node['Description']['Hostname']:<24}{node['Status']['State']:<9}"
+              f"{node['Spec']['Availability']:<14}{manager_status:<16}{node['Description']['Engine']['EngineVersion']}")
 
 @task
 def remove_node(ctx):
     """Remove the current node from the Docker Swarm."""
-    check_docker_installed()
-    start_docker()
-    ctx.run("docker swarm leave --force")
+    ensure_docker()
+    engine_request("POST", "/swarm/leave", params={"force": "true"})
     print("Node removed from the swarm.")
 
 @task
 def status(ctx):
     """Check the status of the Docker Swarm."""
-    check_docker_installed()
-    start_docker()
-    ctx.run("echo Swarm status:")
-    ctx.run("docker info --format '{{.Swarm.LocalNodeState}}'")
+    ensure_docker()
+    print("Swarm status:")
+    print(engine_request("GET", "/info")["Swarm"]["LocalNodeState"])
 
 
 @task
@@ -118,6 +248,8 @@ def start_ngrok(c):
     """
     Start ngrok tunnel for port 80
     """
+    from pyngrok import ngrok
+
     print("Starting ngrok tunnel for port 80...")
     http_tunnel = ngrok.connect(80, "http")
     print(f"Ngrok tunnel established: {http_tunnel.public_url}")
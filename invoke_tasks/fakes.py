@@ -0,0 +1,520 @@
+"""
+Stand-ins for the external tools and APIs the tasks talk to, used by the benchmarks.
+
+- `install_shims()` puts stub kubectl/helm/docker/... executables in a directory. Every call is
+  appended to a JSON-lines log, sleeps BENCH_SHIM_LATENCY seconds and prints a canned response.
+  `sudo` never runs anything for real: it only forwards to another shim.
+- `FakeKubeAPI` is a small in-memory Kubernetes API server (discovery, CRUD, deletecollection,
+  watch, merge/apply patches) that counts the requests it serves.
+- `FakeDockerDaemon` answers the Docker Engine API on a unix socket.
+- `FakePrometheus` serves recorded Prometheus range query results.
+- `FakeWebServer` is a keep-alive HTTP server with configurable latency and errors, for load tests.
+
+The API stand-ins derive from `FakeServer`, which runs the server thread; each only adds its
+request handler.
+"""
+import json
+import os
+import socketserver
+import stat
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+SHIM_TOOLS = ("kubectl", "helm", "docker", "kubeadm", "terraform", "systemctl", "crictl", "sudo")
+
+SHIM_SOURCE = r'''#!{python}
+import json, os, sys, time, urllib.request
+from pathlib import Path
+
+tool, args = os.path.basename(sys.argv[0]), sys.argv[1:]
+shim_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
+with open(os.environ["BENCH_SHIM_LOG"], "a") as log:
+    log.write(json.dumps({{"tool": tool, "args": args, "time": time.time()}}) + "\n")
+
+if tool == "sudo":
+    # Drop sudo's own options and VAR=value assignments, then forward to a shim (never run for real)
+    while args and (args[0].startswith("-") or "=" in args[0]):
+        args = args[2:] if args[0] in ("-p", "-u", "-g") else args[1:]
+    if args and os.path.exists(os.path.join(shim_dir, args[0])):
+        os.execv(os.path.join(shim_dir, args[0]), [os.path.join(shim_dir, args[0])] + args[1:])
+    sys.exit(0)
+
+time.sleep(float(os.environ.get("BENCH_SHIM_LATENCY", 0)))
+
+if tool == "helm" and args[:2] == ["repo", "add"]:
+    name, url = [a for a in args[2:] if not a.startswith("-")][:2]
+    config = Path(os.environ["HELM_REPOSITORY_CONFIG"])
+    text = config.read_text() if config.exists() else "repositories:\n"
+    config.write_text(text + f"- name: {{name}}\n  url: {{url}}\n")
+    cache = Path(os.environ["HELM_REPOSITORY_CACHE"])
+    cache.mkdir(parents=True, exist_ok=True)
+    (cache / f"{{name}}-index.yaml").write_text("apiVersion: v1\nentries: {{}}\n")
+elif tool == "helm" and args[:2] == ["repo", "update"]:
+    cache = Path(os.environ["HELM_REPOSITORY_CACHE"])
+    for name in args[2:]:
+        (cache / f"{{name}}-index.yaml").touch()
+elif tool == "helm" and args[:2] == ["upgrade", "--install"] and os.environ.get("BENCH_FAKE_API"):
+    # Record a deployed release the way Helm does, as a labelled secret
+    release, namespace = args[2], args[args.index("--namespace") + 1]
+    base = f"{{os.environ['BENCH_FAKE_API']}}/api/v1/namespaces/{{namespace}}/secrets"
+    selector = f"owner%3Dhelm%2Cname%3D{{release}}%2Cstatus%3Ddeployed"
+    revisions = json.load(urllib.request.urlopen(f"{{base}}?labelSelector={{selector}}"))["items"]
+    revision = 1 + max((int(s["metadata"]["labels"]["version"]) for s in revisions), default=0)
+    for secret in revisions:
+        urllib.request.urlopen(urllib.request.Request(
+            f"{{base}}/{{secret['metadata']['name']}}", method="PATCH",
+            data=json.dumps({{"metadata": {{"labels": {{"status": "superseded"}}}}}}).encode(),
+            headers={{"Content-Type": "application/merge-patch+json"}}))
+    body = {{"apiVersion": "v1", "kind": "Secret", "metadata": {{
+        "name": f"sh.helm.release.v1.{{release}}.v{{revision}}",
+        "labels": {{"owner": "helm", "name": release, "status": "deployed", "version": str(revision)}}}}}}
+    urllib.request.urlopen(urllib.request.Request(
+        base, method="POST", data=json.dumps(body).encode(), headers={{"Content-Type": "application/json"}}))
+
+# Canned output: the response with the longest matching "tool args..." prefix
+responses = json.loads(Path(os.environ["BENCH_SHIM_RESPONSES"]).read_text())
+command = " ".join([tool] + args)
+matches = [prefix for prefix in responses if command.startswith(prefix)]
+if matches:
+    response = responses[max(matches, key=len)]
+    sys.stdout.write(response.get("stdout", ""))
+    sys.exit(response.get("exit", 0))
+'''
+
+
+def install_shims(directory, responses=None):
+    """
+    Write the stub executables to `directory` and return the environment that activates them.
+
+    `responses` maps command prefixes ("docker ps -a") to {"stdout": ..., "exit": ...}.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    for tool in SHIM_TOOLS:
+        path = directory / tool
+        path.write_text(SHIM_SOURCE.format(python=sys.executable))
+        path.chmod(path.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    (directory / "responses.json").write_text(json.dumps(responses or {}))
+    return {
+        "PATH": f"{directory}{os.pathsep}{os.environ.get('PATH', '')}",
+        "BENCH_SHIM_LOG": str(directory / "calls.jsonl"),
+        "BENCH_SHIM_RESPONSES": str(directory / "responses.json"),
+    }
+
+
+def read_shim_log(directory):
+    """The recorded calls as a list of {"tool", "args", "time"} dicts (and truncate the log)."""
+    log = Path(directory) / "calls.jsonl"
+    if not log.exists():
+        return []
+    calls = [json.loads(line) for line in log.read_text().splitlines() if line]
+    log.write_text("")
+    return calls
+
+
+# (group, version) -> [(plural, kind, namespaced)]
+FAKE_RESOURCES = {
+    ("", "v1"): [
+        ("pods", "Pod", True), ("configmaps", "ConfigMap", True), ("secrets", "Secret", True),
+        ("serviceaccounts", "ServiceAccount", True), ("services", "Service", True),
+        ("events", "Event", True), ("persistentvolumeclaims", "PersistentVolumeClaim", True),
+        ("nodes", "Node", False), ("namespaces", "Namespace", False),
+    ],
+    ("apps", "v1"): [("deployments", "Deployment", True), ("replicasets", "ReplicaSet", True)],
+    ("batch", "v1"): [("jobs", "Job", True)],
+    ("rbac.authorization.k8s.io", "v1"): [("clusterrolebindings", "ClusterRoleBinding", False)],
+    ("storage.k8s.io", "v1"): [("storageclasses", "StorageClass", False)],
+    ("longhorn.io", "v1beta2"): [("volumes", "Volume", True), ("nodes", "Node", True)],
+    ("operator.tigera.io", "v1"): [("installations", "Installation", False)],
+}
+FAKE_VERBS = ["create", "delete", "deletecollection", "get", "list", "patch", "update", "watch"]
+
+
+def _merge(target, patch):
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = value
+
+
+class _FakeHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # listen() backlog: load tests open many connections at once
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    """Quiet keep-alive request handler of the fakes."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, payload, code=200, content_type=None):
+        """Answer with `payload`: bytes or str as they are, anything else as JSON."""
+        if isinstance(payload, (bytes, str)):
+            data = payload.encode() if isinstance(payload, str) else payload
+            content_type = content_type or "text/plain"
+        else:
+            data = json.dumps(payload).encode()
+            content_type = content_type or "application/json"
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+
+class FakeServer:
+    """
+    Base of the HTTP stand-ins: serves `_handler()`'s request handler from a background thread
+    while used as a context manager, on a free localhost port (`url`) or on `address`.
+    """
+
+    server_class = _FakeHTTPServer
+
+    def __init__(self, address=("127.0.0.1", 0)):
+        self.server = self.server_class(address, self._handler())
+        if isinstance(address, tuple):
+            self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def _handler(self):
+        raise NotImplementedError
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeKubeAPI(FakeServer):
+    """
+    In-memory Kubernetes API server on a free localhost port.
+
+    Objects are plain dicts keyed by (group, plural, namespace, name). Deleting an object with
+    finalizers only marks it terminating; patching its finalizers away removes it. Watches return
+    the events after the requested resourceVersion, waiting up to a second for new ones.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.events = []
+        self.requests = Counter()
+        self.resource_version = 100
+        self.changed = threading.Condition()
+        super().__init__()
+
+    def kubeconfig(self, path):
+        """Write a kubeconfig pointing at this server and return its path."""
+        Path(path).write_text(json.dumps({
+            "apiVersion": "v1", "kind": "Config", "current-context": "fake",
+            "clusters": [{"name": "fake", "cluster": {"server": self.url}}],
+            "users": [{"name": "fake", "user": {"token": "fake"}}],
+            "contexts": [{"name": "fake", "context": {"cluster": "fake", "user": "fake"}}],
+        }))
+        return str(path)
+
+    def add(self, api_version, kind, name, namespace=None, **fields):
+        """Store an object, e.g. `add("v1", "Pod", "web-0", "demo", status={...})`."""
+        group, _, version = api_version.rpartition("/")
+        plural = next(p for p, k, _ in FAKE_RESOURCES[(group, version)] if k == kind)
+        with self.changed:
+            self._store(group, plural, namespace, {
+                "apiVersion": api_version, "kind": kind,
+                "metadata": {"name": name, "namespace": namespace, **fields.pop("metadata", {})}, **fields,
+            }, "ADDED")
+
+    def _store(self, group, plural, namespace, obj, event):
+        self.resource_version += 1
+        obj["metadata"]["resourceVersion"] = str(self.resource_version)
+        key = (group, plural, namespace, obj["metadata"]["name"])
+        if event == "DELETED":
+            self.objects.pop(key, None)
+        else:
+            self.objects[key] = obj
+        self.events.append((self.resource_version, group, plural, namespace, event, json.loads(json.dumps(obj))))
+        self.changed.notify_all()
+
+    def _delete(self, group, plural, namespace, obj):
+        if obj["metadata"].get("finalizers"):
+            obj["metadata"]["deletionTimestamp"] = "2024-01-01T00:00:00Z"
+            self._store(group, plural, namespace, obj, "MODIFIED")
+        else:
+            self._store(group, plural, namespace, obj, "DELETED")
+
+    def _handler(self):
+        api = self
+
+        class Handler(_FakeHandler):
+            def not_found(self):
+                self.send({"kind": "Status", "apiVersion": "v1", "status": "Failure",
+                           "reason": "NotFound", "code": 404}, 404)
+
+            def body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length)) if length else {}
+
+            def route(self):
+                url = urlparse(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                parts = url.path.strip("/").split("/")
+                if parts[0] == "api":
+                    group, version, rest = "", parts[1] if len(parts) > 1 else None, parts[2:]
+                else:
+                    group, version, rest = parts[1:2] or [None], parts[2:3] or [None], parts[3:]
+                    group, version = group[0], version[0]
+                namespace = None
+                if rest[:1] == ["namespaces"] and len(rest) >= 3:
+                    namespace, rest = rest[1], rest[2:]
+                return group, version, namespace, (rest + [None, None])[:2], query
+
+            def matching(self, group, plural, namespace, query):
+                items = [obj for (g, p, ns, _), obj in api.objects.items()
+                         if g == group and p == plural and (namespace is None or ns == namespace)]
+                for requirement in filter(None, query.get("labelSelector", "").split(",")):
+                    key, _, value = requirement.partition("=")
+                    items = [obj for obj in items if (obj["metadata"].get("labels") or {}).get(key) == value]
+                return items
+
+            def do_GET(self):
+                api.requests["GET"] += 1
+                path = urlparse(self.path).path
+                if path == "/version":
+                    return self.send({"major": "1", "minor": "30", "gitVersion": "v1.30.0"})
+                if path == "/api":
+                    return self.send({"kind": "APIVersions", "versions": ["v1"]})
+                if path == "/apis":
+                    return self.send({"kind": "APIGroupList", "groups": [
+                        {"name": g, "versions": [{"groupVersion": f"{g}/{v}", "version": v}],
+                         "preferredVersion": {"groupVersion": f"{g}/{v}", "version": v}}
+                        for g, v in FAKE_RESOURCES if g]})
+                group, version, namespace, (plural, name), query = self.route()
+                if plural is None:
+                    if (group, version) not in FAKE_RESOURCES:
+                        return self.not_found()
+                    return self.send({
+                        "kind": "APIResourceList", "groupVersion": f"{group}/{version}".lstrip("/"),
+                        "resources": [{"name": p, "singularName": "", "kind": k, "namespaced": namespaced,
+                                       "verbs": FAKE_VERBS} for p, k, namespaced in FAKE_RESOURCES[(group, version)]],
+                    })
+                if query.get("watch") in ("true", "True", "1"):
+                    return self.watch(group, plural, namespace, query)
+                with api.changed:
+                    if name:
+                        obj = api.objects.get((group, plural, namespace, name))
+                        return self.send(obj) if obj else self.not_found()
+                    items = self.matching(group, plural, namespace, query)
+                    return self.send({"kind": "List", "apiVersion": "v1", "items": items,
+                                      "metadata": {"resourceVersion": str(api.resource_version)}})
+
+            def watch(self, group, plural, namespace, query):
+                since = int(query.get("resourceVersion") or 0)
+                deadline = time.monotonic() + min(float(query.get("timeoutSeconds", 1)), 1)
+                with api.changed:
+                    while True:
+                        events = [e for e in api.events if e[0] > since and e[1:3] == (group, plural)
+                                  and (namespace is None or e[3] == namespace)]
+                        if events or time.monotonic() >= deadline:
+                            break
+                        api.changed.wait(deadline - time.monotonic())
+                body = b"".join(json.dumps({"type": e[4], "object": e[5]}).encode() + b"\n" for e in events)
+                self.send(body, content_type="application/json")
+
+            def do_POST(self):
+                api.requests["POST"] += 1
+                group, version, namespace, (plural, name), _ = self.route()
+                obj = self.body()
+                if plural == "serviceaccounts" and urlparse(self.path).path.endswith("/token"):
+                    # TokenRequest: tokens are issued, not stored
+                    obj["status"] = {"token": f"fake-token-{name}", "expirationTimestamp": "2030-01-01T00:00:00Z"}
+                    return self.send(obj, 201)
+                obj.setdefault("metadata", {})["namespace"] = namespace
+                with api.changed:
+                    api._store(group, plural, namespace, obj, "ADDED")
+                self.send(obj, 201)
+
+            def do_PATCH(self):
+                api.requests["PATCH"] += 1
+                group, version, namespace, (plural, name), _ = self.route()
+                patch = self.body()
+                with api.changed:
+                    obj = api.objects.get((group, plural, namespace, name))
+                    if obj is None:
+                        if "apply-patch" not in self.headers.get("Content-Type", ""):
+                            return self.not_found()
+                        obj = patch
+                        obj["metadata"]["namespace"] = namespace
+                    else:
+                        _merge(obj, patch)
+                    if obj["metadata"].get("deletionTimestamp") and not obj["metadata"].get("finalizers"):
+                        api._store(group, plural, namespace, obj, "DELETED")
+                    else:
+                        api._store(group, plural, namespace, obj, "MODIFIED")
+                self.send(obj)
+
+            def do_DELETE(self):
+                api.requests["DELETE"] += 1
+                group, version, namespace, (plural, name), query = self.route()
+                self.body()
+                with api.changed:
+                    if name:
+                        obj = api.objects.get((group, plural, namespace, name))
+                        if obj is None:
+                            return self.not_found()
+                        api._delete(group, plural, namespace, obj)
+                    else:
+                        for obj in self.matching(group, plural, namespace, query):
+                            api._delete(group, plural, namespace, obj)
+                self.send({"kind": "Status", "apiVersion": "v1", "status": "Success"})
+
+        return Handler
+
+
+class _UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class FakeDockerDaemon(FakeServer):
+    """
+    Docker Engine API stand-in on a unix socket.
+
+    `routes` maps "METHOD /path" (without the API version prefix) to a JSON-serializable response
+    or a callable taking the request body and returning one. Requests are counted per route.
+    """
+
+    server_class = _UnixHTTPServer
+
+    def __init__(self, socket_path, routes=None):
+        self.socket_path = str(socket_path)
+        self.routes = {"GET /_ping": "OK", **(routes or {})}
+        self.requests = Counter()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        super().__init__(self.socket_path)
+
+    def __exit__(self, *exc):
+        super().__exit__(*exc)
+        os.unlink(self.socket_path)
+
+    def _handler(self):
+        daemon = self
+
+        class Handler(_FakeHandler):
+            def address_string(self):
+                return "docker"
+
+            def handle_any(self):
+                path = urlparse(self.path).path
+                if path.startswith("/v1.") and path.count("/") > 1:
+                    path = "/" + path.split("/", 2)[2]
+                route = f"{self.command} {path}"
+                daemon.requests[route] += 1
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                response = daemon.routes.get(route)
+                if response is None:
+                    return self.send({"message": f"no fake route for {route}"}, 404)
+                self.send(response(body) if callable(response) else response)
+
+            do_GET = do_POST = do_DELETE = do_HEAD = handle_any
+
+        return Handler
+
+
+class FakePrometheus(FakeServer):
+    """
+    Prometheus HTTP API stand-in serving recorded range query results.
+
+    `recorded` maps a substring of the PromQL query to the series it returns, in the API's own
+    format (`[{"metric": {...}, "values": [[timestamp, "value"], ...]}]`). /api/v1/query_range
+    answers with the samples between the requested start and end, so callers that split a long
+    window into several requests get consistent data. `from_file` loads what
+    `k8s.capacity-report --record` wrote; replay it with the `--end` that the recording printed.
+    """
+
+    def __init__(self, recorded):
+        self.recorded = recorded
+        self.requests = Counter()
+        super().__init__()
+
+    @classmethod
+    def from_file(cls, path):
+        return cls(json.loads(Path(path).read_text()))
+
+    def _handler(self):
+        prometheus = self
+
+        class Handler(_FakeHandler):
+            def handle_any(self):
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                form = self.rfile.read(length).decode() if length else ""
+                query = {key: values[0] for key, values in parse_qs("&".join(filter(None, [url.query, form]))).items()}
+                prometheus.requests[url.path] += 1
+                if url.path != "/api/v1/query_range":
+                    return self.send({"status": "error", "error": f"no fake for {url.path}"}, 404)
+                start, end = float(query["start"]), float(query["end"])
+                series = next((series for pattern, series in prometheus.recorded.items()
+                               if pattern in query["query"]), [])
+                result = [{"metric": s["metric"], "values": [v for v in s["values"] if start <= v[0] <= end]}
+                          for s in series]
+                self.send({"status": "success", "data": {
+                    "resultType": "matrix", "result": [s for s in result if s["values"]]}})
+
+            do_GET = do_POST = handle_any
+
+        return Handler
+
+
+class FakeWebServer(FakeServer):
+    """
+    Keep-alive HTTP server standing in for an ingress route, for load tests.
+
+    Every request sleeps `latency` seconds and gets a small 200 response, except every
+    `fail_every`th one, which gets a 503. Requests are counted per Host header, and accepted
+    connections in `connections`.
+    """
+
+    def __init__(self, latency=0.0, fail_every=0):
+        self.latency = latency
+        self.fail_every = fail_every
+        self.requests = Counter()
+        self.connections = 0
+        self.lock = threading.Lock()
+        super().__init__()
+
+    def _handler(self):
+        web = self
+
+        class Handler(_FakeHandler):
+            disable_nagle_algorithm = True  # headers and body are separate writes
+
+            def setup(self):
+                super().setup()
+                with web.lock:
+                    web.connections += 1
+
+            def handle_any(self):
+                with web.lock:
+                    web.requests[self.headers.get("Host", "")] += 1
+                    count = sum(web.requests.values())
+                time.sleep(web.latency)
+                if web.fail_every and count % web.fail_every == 0:
+                    return self.send("unavailable\n", 503)
+                self.send("ok\n")
+
+            do_GET = do_POST = do_HEAD = handle_any
+
+        return Handler
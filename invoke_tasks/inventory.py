@@ -0,0 +1,134 @@
+"""
+Run node-scoped tasks on the hosts of the kubespray inventory, in parallel over SSH.
+
+Hosts and groups come from INVENTORY (default kubespray_config/inventory.yaml), using the same
+`ansible_host` / `ansible_user` / `ansible_port` / `ansible_ssh_private_key_file` variables as
+kubespray. One Fabric connection is kept open per host for the whole invoke run, so every command
+after the first reuses the SSH session.
+"""
+import atexit
+import os
+import threading
+from functools import lru_cache
+
+import yaml
+from invoke import Exit
+
+from invoke_tasks.parallel import PrefixedOutput, run_dag, print_summary
+
+INVENTORY = os.getenv("INVENTORY", "kubespray_config/inventory.yaml")
+
+# Hosts worked on at the same time by default
+FAN_OUT_WORKERS = int(os.getenv("FAN_OUT_WORKERS", 10))
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def load_inventory(path=INVENTORY):
+    """Return ({host: vars}, {group: [hosts]}) with child groups expanded, in inventory order."""
+    with open(path) as f:
+        data = yaml.safe_load(f) or {}
+
+    hosts = {}
+    groups = {}
+
+    def walk(name, group):
+        group = group or {}
+        members = []
+        for host, host_vars in (group.get("hosts") or {}).items():
+            hosts.setdefault(host, {}).update(host_vars or {})
+            members.append(host)
+        for child, child_group in (group.get("children") or {}).items():
+            # Children are often only referenced by name below k8s_cluster; use the full definition
+            members += walk(child, child_group or _find_group(data, child))
+        groups[name] = list(dict.fromkeys(members + groups.get(name, [])))
+        return groups[name]
+
+    for name, group in data.items():
+        walk(name, group)
+    return hosts, groups
+
+
+def _find_group(group_tree, name):
+    for group_name, group in (group_tree or {}).items():
+        if group_name == name and (group or {}).get("hosts") is not None:
+            return group
+        found = _find_group((group or {}).get("children"), name)
+        if found:
+            return found
+    return None
+
+
+def hosts_in(selector, path=INVENTORY):
+    """{host: vars} for a comma separated list of inventory groups and/or host names."""
+    hosts, groups = load_inventory(path)
+    selected = []
+    for name in (part.strip() for part in selector.split(",")):
+        if name in groups:
+            selected += groups[name]
+        elif name in hosts:
+            selected.append(name)
+        elif name:
+            raise Exit(f"'{name}' is neither a group nor a host in {path}", code=1)
+    return {host: hosts[host] for host in dict.fromkeys(selected)}
+
+
+@lru_cache(maxsize=None)
+def _host_connection_class():
+    from fabric import Connection
+
+    return type("HostConnection", (PrefixedOutput, Connection), {})
+
+
+def connect(c, name, host_vars, stream=None):
+    """
+    The pooled SSH connection to inventory host `name`, writing command output to `stream`.
+
+    The connection is opened on first use and kept until invoke exits. Its `inventory_name`
+    attribute is the host's inventory (and Kubernetes node) name.
+    """
+    with _connections_lock:
+        connection = _connections.get(name)
+        if connection is None:
+            key_file = host_vars.get("ansible_ssh_private_key_file")
+            connection = _host_connection_class()(
+                host_vars.get("ansible_host", name),
+                user=host_vars.get("ansible_user"),
+                port=host_vars.get("ansible_port"),
+                config=c.config,
+                connect_kwargs={"key_filename": os.path.expanduser(key_file)} if key_file else None,
+            )
+            connection._set(inventory_name=name)
+            _connections[name] = connection
+    connection._set(_stream=stream)
+    return connection
+
+
+@atexit.register
+def _close_connections():
+    for connection in _connections.values():
+        connection.close()
+
+
+def on_hosts(c, group, func, workers=None, title="Hosts"):
+    """
+    Call `func(connection)` for every host of the inventory `group`, at most `workers` (default
+    FAN_OUT_WORKERS) at a time.
+
+    Output of each host is prefixed with its name. Prints a per-host report and raises Exit when
+    any host failed.
+    """
+    hosts = hosts_in(group)
+    if not hosts:
+        raise Exit(f"No hosts in '{group}' ({INVENTORY})", code=1)
+
+    results = run_dag(
+        c, {host: (func, []) for host in hosts}, workers=int(workers or FAN_OUT_WORKERS),
+        make_context=lambda host, stream: connect(c, host, hosts[host], stream),
+    )
+    print_summary(results, f"{title} on {group}")
+    failed = [host for host, (status, _) in results.items() if status != "ok"]
+    if failed:
+        raise Exit(f"Failed on {len(failed)} of {len(results)} hosts: {', '.join(failed)}", code=1)
+    return results
@@ -1,7 +0,0 @@
-from .deployment_examples import *
-from .devops import *
-from .monitoring import *
-from .network_and_routing import *
-from .setup_cluster import *
-from .storage import *
-from .services import *
@@ -0,0 +1,63 @@
+import time
+
+from invoke import task
+
+from invoke_tasks.parallel import run_dag, print_summary
+from .devops import deploy_harbor, deploy_docker_registry
+from .monitoring import deploy_prometheus, deploy_grafana, deploy_dashboard
+from .network_and_routing import deploy_pod_network, deploy_traefik
+from .setup_cluster import setup_cluster
+from .storage import deploy_longhorn
+
+# Step name -> (deploy function, steps it depends on).
+# CNI comes first, Longhorn before anything with a longhorn PVC, Traefik before anything exposed by ingress.
+BOOTSTRAP_STEPS = {
+    "cluster": (setup_cluster, []),
+    "pod-network": (deploy_pod_network, ["cluster"]),
+    "longhorn": (deploy_longhorn, ["pod-network"]),
+    "traefik": (deploy_traefik, ["pod-network"]),
+    "dashboard": (deploy_dashboard, ["pod-network"]),
+    "prometheus": (deploy_prometheus, ["longhorn"]),
+    "grafana": (deploy_grafana, ["longhorn"]),
+    "docker-registry": (deploy_docker_registry, ["longhorn", "traefik"]),
+    "harbor": (deploy_harbor, ["longhorn", "traefik"]),
+}
+
+
+def bootstrap_plan(skip=()):
+    """Return the bootstrap steps without `skip`, treating skipped dependencies as already satisfied."""
+    return {
+        name: (func, [dep for dep in deps if dep not in skip])
+        for name, (func, deps) in BOOTSTRAP_STEPS.items()
+        if name not in skip
+    }
+
+
+@task(help={
+    "workers": "Maximum number of steps running at the same time",
+    "skip": "Comma separated steps to leave out, e.g. 'harbor,dashboard'",
+    "init_cluster": "Also run kubeadm init (setup_cluster) as the first step",
+    "dry_run": "Only print the steps and their dependencies",
+})
+def bootstrap(c, workers=4, skip="", init_cluster=False, dry_run=False):
+    """Bring up the whole k8s stack, running independent deploy steps in parallel"""
+    skipped = {name.strip() for name in skip.split(",") if name.strip()}
+    if not init_cluster:
+        skipped.add("cluster")
+    unknown = skipped - set(BOOTSTRAP_STEPS)
+    if unknown:
+        raise ValueError(f"Unknown bootstrap steps: {', '.join(sorted(unknown))}")
+
+    steps = bootstrap_plan(skipped)
+    for name, (func, deps) in steps.items():
+        print(f"{name:<16} after: {', '.join(deps) or '-'}")
+    if dry_run:
+        return
+
+    start = time.monotonic()
+    results = run_dag(c, steps, workers=int(workers))
+    print_summary(results, title=f"Bootstrap finished in {time.monotonic() - start:.1f}s")
+
+    failed = [name for name, (status, _) in results.items() if status != "ok"]
+    if failed:
+        raise SystemExit(f"Bootstrap incomplete, failed or skipped steps: {', '.join(failed)}")
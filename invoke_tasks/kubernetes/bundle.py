@@ -0,0 +1,239 @@
+"""
+Offline bundle of the Helm charts the deploy tasks install and the container images they run.
+
+A bundle is a directory holding content-addressed blobs, the way OCI image layouts do:
+
+    bundle/
+      index.json              {"charts": {"repo/chart": {"version", "digest", "images"}}, "images": {ref: digest}}
+      blobs/sha256/<digest>   chart archives (helm pull) and image tarballs (docker save)
+
+Rebuilding only downloads what changed: a chart version or image already in the index, with its
+blob present, is kept. With OFFLINE_BUNDLE=<bundle> every deploy task installs its chart from the
+bundle (see helm.upgrade_install). bundle_load pushes the images into the registry that
+kubespray's offline.yml `registry_host` points at, under their source registry
+(`<registry_host>/quay.io/org/app`), and makes that registry the containerd mirror of every
+source registry (override_path onto `<registry_host>/v2/<source>`, see mirror.py). The charts keep
+their image references and the nodes pull them from the offline registry, so a fresh install
+needs no internet.
+"""
+import ast
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import yaml
+from invoke import task, Exit
+
+from .helm import ensure_repos, resolve_chart_version
+
+BUNDLE_DIR = os.getenv("BUNDLE_DIR", "bundle")
+
+
+def chart_references():
+    """The repo charts installed by the deploy tasks, read from their upgrade_install calls."""
+    charts = []
+    for path in sorted(Path(__file__).parent.glob("*.py")):
+        for node in ast.walk(ast.parse(path.read_text(encoding="utf-8"))):
+            if (isinstance(node, ast.Call) and getattr(node.func, "id", None) == "upgrade_install"
+                    and len(node.args) >= 3 and isinstance(node.args[2], ast.Constant)):
+                chart = node.args[2].value
+                if "/" in chart and not chart.startswith("."):
+                    charts.append(chart)
+    return list(dict.fromkeys(charts))
+
+
+def blob_path(bundle, digest):
+    return Path(bundle) / "blobs" / "sha256" / digest.split(":")[1]
+
+
+def store_blob(bundle, path):
+    """Move the file `path` into the bundle under its sha256 and return the digest."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    digest = f"sha256:{sha.hexdigest()}"
+    target = blob_path(bundle, digest)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    if target.exists():
+        os.remove(path)
+    else:
+        shutil.move(path, target)
+    return digest
+
+
+def load_index(bundle):
+    index_file = Path(bundle) / "index.json"
+    if not index_file.exists():
+        return {"charts": {}, "images": {}}
+    with open(index_file) as f:
+        return json.load(f)
+
+
+def _collect_images(node, images):
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == "image" and isinstance(value, str):
+                images.append(value)
+            else:
+                _collect_images(value, images)
+    elif isinstance(node, list):
+        for item in node:
+            _collect_images(item, images)
+
+
+def chart_images(c, archive):
+    """Images referenced by the manifests `archive` renders with its default values."""
+    result = c.run(f"helm template bundle {archive}", hide=True, warn=True)
+    if not result.ok:
+        print(f"Warning: could not render {archive} with default values, pass its images with --images")
+        return []
+    images = []
+    for document in yaml.safe_load_all(result.stdout):
+        _collect_images(document, images)
+    return list(dict.fromkeys(images))
+
+
+def _saved_name(image):
+    """Name an image is saved and pushed under: digest pins are dropped, docker save needs a tag."""
+    name = image.split("@")[0]
+    if ":" in name.rsplit("/", 1)[-1]:
+        return name
+    return None if "@" in image else f"{name}:latest"
+
+
+def _fetch_chart(c, bundle, chart, version, directory):
+    c.run(f"helm pull {chart} --version {version} --destination {directory}", hide=True)
+    archive = next(Path(directory).glob("*.tgz"))
+    images = chart_images(c, archive)
+    return {"version": version, "digest": store_blob(bundle, archive), "images": images}
+
+
+def _fetch_image(c, bundle, image, directory):
+    name = _saved_name(image)
+    c.run(f"docker pull -q {image}", hide=True)
+    if name != image:
+        c.run(f"docker tag {image} {name}", hide=True)
+    tarball = Path(directory) / "image.tar"
+    c.run(f"docker save -o {tarball} {name}", hide=True)
+    return store_blob(bundle, tarball)
+
+
+@task(help={
+    "directory": "Bundle directory (default $BUNDLE_DIR or ./bundle)",
+    "charts": "Comma separated repo charts, defaults to every chart a deploy task installs",
+    "images": "Comma separated extra images, e.g. ones operators pull at runtime",
+    "workers": "Number of charts/images downloaded at the same time",
+    "skip_images": "Only bundle the charts",
+})
+def bundle(c, directory=None, charts="", images="", workers=4, skip_images=False):
+    """Download the deploy tasks' charts and their images into a content-addressed offline bundle"""
+    directory = directory or BUNDLE_DIR
+    selected = [chart.strip() for chart in charts.split(",") if chart.strip()] or chart_references()
+    index = load_index(directory)
+
+    ensure_repos(c, *dict.fromkeys(chart.split("/", 1)[0] for chart in selected))
+    versions = {chart: resolve_chart_version(chart) for chart in selected}
+    missing = [chart for chart, version in versions.items() if version is None]
+    if missing:
+        raise Exit(f"No stable version found for: {', '.join(missing)}", code=1)
+
+    def current(entry, version):
+        return entry and entry["version"] == version and blob_path(directory, entry["digest"]).exists()
+
+    def fetch_chart(chart):
+        with tempfile.TemporaryDirectory() as tmp:
+            return chart, _fetch_chart(c, directory, chart, versions[chart], tmp)
+
+    stale_charts = [chart for chart in selected if not current(index["charts"].get(chart), versions[chart])]
+    with ThreadPoolExecutor(max_workers=int(workers)) as pool:
+        for chart, entry in pool.map(fetch_chart, stale_charts):
+            print(f"chart  {chart} {entry['version']}: {len(entry['images'])} images")
+            index["charts"][chart] = entry
+
+    wanted = [image for chart in selected for image in index["charts"][chart]["images"]]
+    wanted += [image.strip() for image in images.split(",") if image.strip()]
+    unnamed = [image for image in dict.fromkeys(wanted) if _saved_name(image) is None]
+    if unnamed:
+        print(f"Warning: skipping images pinned by digest only (no tag to push them under): {', '.join(unnamed)}")
+    wanted = [image for image in dict.fromkeys(wanted) if image not in unnamed]
+
+    def fetch_image(image):
+        with tempfile.TemporaryDirectory() as tmp:
+            return image, _fetch_image(c, directory, image, tmp)
+
+    stale_images = [] if skip_images else [
+        image for image in wanted
+        if image not in index["images"] or not blob_path(directory, index["images"][image]).exists()
+    ]
+    failed = []
+    with ThreadPoolExecutor(max_workers=int(workers)) as pool:
+        futures = {pool.submit(fetch_image, image): image for image in stale_images}
+        for future, image in futures.items():
+            try:
+                index["images"][image] = future.result()[1]
+                print(f"image  {image}")
+            except Exception as e:
+                failed.append(image)
+                print(f"failed {image}: {e}")
+
+    with open(Path(directory) / "index.json", "w") as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+
+    size = sum(path.stat().st_size for path in (Path(directory) / "blobs").rglob("*") if path.is_file())
+    print(f"\nBundle {directory}: {len(selected)} charts ({len(stale_charts)} downloaded), "
+          f"{len(wanted)} images ({len(stale_images) - len(failed)} downloaded), {size / 1024 ** 3:.2f} GB")
+    print(f"Install from it with: OFFLINE_BUNDLE={directory} invoke k8s.<deploy task>")
+    if failed:
+        raise Exit(f"{len(failed)} images could not be bundled", code=1)
+
+
+@task(help={
+    "directory": "Bundle directory (default $BUNDLE_DIR or ./bundle)",
+    "registry": "Registry to push the images to (default $REGISTRY or localhost:5000), i.e. kubespray's registry_host",
+    "workers": "Number of images pushed at the same time",
+    "username": "Registry user (default: the credentials of `docker login`)",
+    "password": "Registry password (default $REGISTRY_PASSWORD)",
+    "group": "Inventory group or hosts whose containerd should pull through the registry right away",
+    "skip_verify": "Don't verify the registry's TLS certificate on the nodes",
+})
+def bundle_load(c, directory=None, registry=None, workers=4, username=None, password=None, group=None,
+                skip_verify=False):
+    """Push the bundle's images to the offline registry and make it the nodes' mirror of their source registries"""
+    from invoke_tasks import registry as registries
+
+    from .mirror import (KUBESPRAY_CONTAINERD, UPSTREAM_SERVERS, install_mirrors, render_containerd_config,
+                         render_kubespray_mirrors)
+
+    directory = directory or BUNDLE_DIR
+    index = load_index(directory)
+    for image, digest in index["images"].items():
+        c.run(f"docker load -q -i {blob_path(directory, digest)}", hide=True)
+    names = [_saved_name(image) for image in index["images"]]
+    credentials = (username, password or os.getenv("REGISTRY_PASSWORD", "")) if username else None
+    registry = registry or registries.REGISTRY
+    results = registries.push_images(",".join(names), registry, workers=int(workers), credentials=credentials,
+                                     keep_source=True)
+    failed = [result["image"] for result in results if result["status"] == "failed"]
+    if failed:
+        raise Exit(f"Failed to push: {', '.join(failed)}", code=1)
+
+    # Pods keep pulling e.g. docker.io/library/nginx; containerd resolves it through the offline registry
+    upstreams = sorted({registries.source_repository(name).split("/", 1)[0] for name in names})
+    entries = [{
+        "prefix": upstream,
+        "server": UPSTREAM_SERVERS.get(upstream, f"https://{upstream}"),
+        "host": f"{registries.registry_url(registry)}/v2/{upstream}",
+        "override_path": True,
+        "skip_verify": skip_verify,
+    } for upstream in upstreams]
+    if registries.registry_host(registry).split(":")[0] in ("localhost", "127.0.0.1"):
+        print(f"Warning: the nodes would pull from their own {registry}, pass --registry <registry_host>")
+    render_kubespray_mirrors(entries)
+    print(f"Mirrors of {', '.join(upstreams)} written to {KUBESPRAY_CONTAINERD}")
+    if group:
+        install_mirrors(c, group, entries, render_containerd_config(), title="bundle_load")
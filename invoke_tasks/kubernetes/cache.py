@@ -0,0 +1,136 @@
+"""
+Informer cache of cluster objects, shared by all tasks of one invoke run.
+
+The first lookup of a resource type lists it once; a background watch then keeps the cached
+objects current from that list's resourceVersion on (and lists again when the watch expires), so
+chained tasks read nodes and service accounts from memory instead of listing them again.
+Lookups see the objects as of the last watch event. Writes based on a cached object send its
+resourceVersion along, so the API server rejects them with 409 Conflict when the cache was behind.
+"""
+import threading
+import time
+
+from . import api
+
+_informers = {}
+_lock = threading.Lock()
+
+
+class Informer:
+    """Objects of one list call (e.g. the service accounts of a namespace), kept current by a watch thread."""
+
+    def __init__(self, list_func, **list_kwargs):
+        self.list_func = list_func
+        self.list_kwargs = list_kwargs
+        self.objects = {}
+        self.resource_version = None
+        self.changed = threading.Condition()
+        self.stopped = False
+        self._relist()
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def _relist(self):
+        listing = self.list_func(**self.list_kwargs)
+        with self.changed:
+            self.objects = {item.metadata.name: item for item in listing.items}
+            self.resource_version = listing.metadata.resource_version
+            self.changed.notify_all()
+
+    def _watch(self):
+        from kubernetes import watch
+
+        backoff = 0.25
+        while not self.stopped:
+            try:
+                for event in watch.Watch().stream(self.list_func, resource_version=self.resource_version,
+                                                  timeout_seconds=60, **self.list_kwargs):
+                    if self.stopped:
+                        return
+                    item = event["object"]
+                    with self.changed:
+                        self.resource_version = item.metadata.resource_version
+                        if event["type"] == "DELETED":
+                            self.objects.pop(item.metadata.name, None)
+                        else:
+                            self.objects[item.metadata.name] = item
+                        self.changed.notify_all()
+                backoff = 0.25
+            except Exception:
+                if self.stopped:
+                    return
+                # An expired resourceVersion (410 Gone) or a broken connection: back off and list again
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 5)
+                try:
+                    self._relist()
+                except Exception:
+                    pass  # the next round retries
+
+    def get(self, name):
+        with self.changed:
+            return self.objects.get(name)
+
+    def store(self, item):
+        """Put an object returned by a write into the cache, ahead of its watch event."""
+        with self.changed:
+            self.objects[item.metadata.name] = item
+            self.changed.notify_all()
+
+    def list(self):
+        with self.changed:
+            return list(self.objects.values())
+
+    def wait_for(self, condition, timeout=60, description="condition"):
+        """Wait until `condition(objects)` is truthy for the cached objects and return its result."""
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while not (result := condition(list(self.objects.values()))):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"Timed out after {timeout}s waiting for {description}")
+                self.changed.wait(remaining)
+            return result
+
+
+def informer(key, list_func, **list_kwargs):
+    """The session's Informer for `key`, started on first use."""
+    with _lock:
+        if key not in _informers:
+            _informers[key] = Informer(list_func, **list_kwargs)
+        return _informers[key]
+
+
+def reset():
+    """Stop and forget all informers, e.g. after pointing the API client at another cluster."""
+    with _lock:
+        for cached in _informers.values():
+            cached.stopped = True
+        _informers.clear()
+
+
+def nodes():
+    return informer(("nodes",), api.core().list_node)
+
+
+def service_accounts(namespace):
+    return informer(("serviceaccounts", namespace), api.core().list_namespaced_service_account, namespace=namespace)
+
+
+def control_plane_node():
+    """Name of the (first) control-plane node."""
+    names = sorted(node.metadata.name for node in nodes().list()
+                   if "node-role.kubernetes.io/control-plane" in (node.metadata.labels or {}))
+    if not names:
+        raise LookupError("No node with the node-role.kubernetes.io/control-plane label")
+    return names[0]
+
+
+def node_ips(address_type="InternalIP"):
+    """{node name: address} of every node that has an address of `address_type`."""
+    ips = {}
+    for node in nodes().list():
+        addresses = [a.address for a in (node.status.addresses if node.status else None) or [] if a.type == address_type]
+        if addresses:
+            ips[node.metadata.name] = addresses[0]
+    return ips
+
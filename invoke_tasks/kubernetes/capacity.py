@@ -0,0 +1,284 @@
+"""
+Right-sizing of the releases' resource requests and limits from what they actually use.
+
+CPU and memory usage per container come from the Prometheus that deploy_prometheus installs (or
+any other, see PROMETHEUS_URL), over a window of days or weeks at scrape resolution. Long windows
+are fetched as several range queries in parallel, because Prometheus returns at most 11000 points
+per series per query. Percentiles are computed for all containers at once with numpy: the samples
+are sorted once by (container, value) and every percentile is an index into the sorted array.
+"""
+import json
+import math
+import os
+import re
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from pathlib import Path
+
+import numpy as np
+import yaml
+from invoke import task, Exit
+
+PROMETHEUS_URL = os.getenv("PROMETHEUS_URL", "http://localhost:9090")
+
+# Most points Prometheus returns per series in one range query
+MAX_POINTS = 11000
+
+QUERIES = {
+    "cpu": 'sum by (namespace, pod, container) (rate(container_cpu_usage_seconds_total'
+           '{{namespace=~"{namespaces}", container!="", container!="POD"}}[5m]))',
+    "memory": 'max by (namespace, pod, container) (container_memory_working_set_bytes'
+              '{{namespace=~"{namespaces}", container!="", container!="POD"}})',
+}
+
+# Release -> (namespace, {"workload/container": values path of its resources block})
+RELEASES = {
+    "harbor": ("harbor", {
+        "harbor-core/core": "core.resources",
+        "harbor-jobservice/jobservice": "jobservice.resources",
+        "harbor-portal/portal": "portal.resources",
+        "harbor-registry/registry": "registry.registry.resources",
+        "harbor-registry/registryctl": "registry.controller.resources",
+        "harbor-database/database": "database.internal.resources",
+        "harbor-redis/redis": "redis.internal.resources",
+        "harbor-trivy/trivy": "trivy.resources",
+    }),
+    "gitlab": ("gitlab", {
+        "gitlab-webservice-default/webservice": "gitlab.webservice.resources",
+        "gitlab-webservice-default/gitlab-workhorse": "gitlab.webservice.workhorse.resources",
+        "gitlab-sidekiq-all-in-1-v2/sidekiq": "gitlab.sidekiq.resources",
+        "gitlab-gitaly/gitaly": "gitlab.gitaly.resources",
+        "gitlab-gitlab-shell/gitlab-shell": "gitlab.gitlab-shell.resources",
+        "gitlab-toolbox/toolbox": "gitlab.toolbox.resources",
+        "gitlab-kas/kas": "gitlab.kas.resources",
+        "gitlab-registry/registry": "registry.resources",
+        "gitlab-postgresql/postgresql": "postgresql.primary.resources",
+        "gitlab-redis-master/redis": "redis.master.resources",
+        "gitlab-minio/minio": "minio.resources",
+    }),
+    "vault": ("vault", {"vault/vault": "server.resources"}),
+    "ollama": ("ollama", {"ollama/ollama": "resources"}),
+    "open-webui": ("ollama", {"open-webui/open-webui": "resources"}),
+}
+
+MIN_CPU_CORES = 0.01
+MIN_MEMORY_BYTES = 32 * 1024 ** 2
+
+
+def parse_duration(value):
+    """Seconds in a Prometheus style duration, e.g. '15s', '30m', '12h', '14d', '2w'."""
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([smhdw])", str(value).strip())
+    if not match:
+        raise ValueError(f"Invalid duration '{value}', use e.g. 15s, 30m, 12h, 14d")
+    return float(match.group(1)) * units[match.group(2)]
+
+
+def workload_name(pod):
+    """The Deployment, StatefulSet or DaemonSet a pod name belongs to."""
+    match = re.fullmatch(r"(.+?)(?:-[a-z0-9]{6,10})?-[a-z0-9]{5}", pod)
+    if match:
+        return match.group(1)
+    match = re.fullmatch(r"(.+)-\d+", pod)
+    return match.group(1) if match else pod
+
+
+def query_range(url, query, start, end, step):
+    data = urllib.parse.urlencode({"query": query, "start": start, "end": end, "step": step}).encode()
+    with urllib.request.urlopen(f"{url.rstrip('/')}/api/v1/query_range", data=data, timeout=300) as response:
+        payload = json.load(response)
+    if payload.get("status") != "success":
+        raise RuntimeError(f"Prometheus query failed: {payload.get('error')}")
+    return payload["data"]["result"]
+
+
+def fetch_series(url, query, start, end, step, workers=8):
+    """
+    {(namespace, pod, container): [[timestamp, value], ...]} of a range query over [start, end].
+
+    The window is split into pieces of at most MAX_POINTS steps, queried in parallel.
+    """
+    span = step * (MAX_POINTS - 1)
+    pieces = [(t, min(t + span, end)) for t in np.arange(start, end, span + step)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(lambda piece: query_range(url, query, piece[0], piece[1], step), pieces)
+        series = {}
+        for result in results:
+            for entry in result:
+                metric = entry["metric"]
+                key = (metric.get("namespace"), metric.get("pod"), metric.get("container"))
+                series.setdefault(key, []).extend(entry["values"])
+    return series
+
+
+def grouped_percentiles(values, groups, count, quantiles):
+    """
+    {q: array of the q-quantile of `values` per group id 0..count-1} (NaN for empty groups).
+
+    One lexsort orders the samples by group and value, after which every quantile of every group is
+    a (linearly interpolated) index into the sorted array, the same as numpy.percentile's default.
+    """
+    keep = ~np.isnan(values)
+    values, groups = values[keep], groups[keep]
+    order = np.lexsort((values, groups))
+    values, groups = values[order], groups[order]
+    counts = np.bincount(groups, minlength=count)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    empty = counts == 0
+    last = np.maximum(starts + counts - 1, 0)
+    result = {}
+    for q in quantiles:
+        position = starts + np.maximum(counts - 1, 0) * q
+        low = np.minimum(np.floor(position).astype(np.int64), last)
+        high = np.minimum(low + 1, last)
+        fraction = position - low
+        if len(values):
+            result[q] = values[low] * (1 - fraction) + values[high] * fraction
+        else:
+            result[q] = np.full(count, np.nan)
+        result[q][empty] = np.nan
+    return result
+
+
+def usage_stats(series):
+    """{(namespace, workload, container): {"samples", "p50", "p95", "p99", "max"}} over all its pods."""
+    keys = sorted({(namespace, workload_name(pod), container) for namespace, pod, container in series})
+    index = {key: i for i, key in enumerate(keys)}
+    arrays, groups = [], []
+    for (namespace, pod, container), values in series.items():
+        # Sample values arrive as [timestamp, "value"] pairs; numpy parses the strings in C
+        array = np.array(list(map(itemgetter(1), values)), dtype=np.float64)
+        arrays.append(array)
+        groups.append(np.full(len(array), index[(namespace, workload_name(pod), container)], dtype=np.int64))
+    if not keys:
+        return {}
+    values, group_ids = np.concatenate(arrays), np.concatenate(groups)
+    quantiles = grouped_percentiles(values, group_ids, len(keys), (0.5, 0.95, 0.99, 1.0))
+    samples = np.bincount(group_ids[~np.isnan(values)], minlength=len(keys))
+    return {key: {"samples": int(samples[i]), "p50": quantiles[0.5][i], "p95": quantiles[0.95][i],
+                  "p99": quantiles[0.99][i], "max": quantiles[1.0][i]} for key, i in index.items()}
+
+
+def format_cpu(cores):
+    return f"{math.ceil(cores * 1000)}m"
+
+
+def format_memory(size):
+    return f"{math.ceil(size / 1024 ** 2)}Mi"
+
+
+def recommend(cpu, memory, headroom=0.2, cpu_limits=False):
+    """Requests at the p95 plus headroom, memory limit at the peak plus headroom (CPU unlimited by default)."""
+    factor = 1 + headroom
+    cpu_request = max(cpu["p95"] * factor, MIN_CPU_CORES)
+    memory_request = max(memory["p95"] * factor, MIN_MEMORY_BYTES)
+    resources = {
+        "requests": {"cpu": format_cpu(cpu_request), "memory": format_memory(memory_request)},
+        "limits": {"memory": format_memory(max(memory["max"] * factor, memory_request))},
+    }
+    if cpu_limits:
+        resources["limits"]["cpu"] = format_cpu(max(cpu["p99"] * factor, cpu_request))
+    return resources
+
+
+def _nested(path, value):
+    for key in reversed(path.split(".")):
+        value = {key: value}
+    return value
+
+
+def _merge(target, update):
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+
+@task(help={
+    "releases": "Comma separated releases to size, see RELEASES in invoke_tasks/kubernetes/capacity.py",
+    "window": "How far back to look, e.g. 7d or 2w",
+    "step": "Sample resolution, normally the scrape interval",
+    "prometheus": "Prometheus URL (default $PROMETHEUS_URL or http://localhost:9090, e.g. via port-forward)",
+    "headroom": "Fraction added on top of the observed usage",
+    "cpu_limits": "Also recommend CPU limits (p99 plus headroom); by default CPU is left unlimited",
+    "output_dir": "Write a <release>-resources.yaml values file per release into this directory",
+    "record": "Save the raw query results to this JSON file (replayable with fakes.FakePrometheus)",
+    "workers": "Range queries in flight at the same time",
+    "end": "End of the window as a Unix timestamp (default now), e.g. the one printed by --record to replay it",
+})
+def capacity_report(c, releases="harbor,gitlab,vault,ollama,open-webui", window="7d", step="15s", prometheus=None,
+                    headroom=0.2, cpu_limits=False, output_dir=None, record=None, workers=8, end=None):
+    """Recommend resource requests/limits per release from CPU and memory usage in Prometheus"""
+    selected = [release.strip() for release in releases.split(",") if release.strip()]
+    unknown = [release for release in selected if release not in RELEASES]
+    if unknown:
+        raise Exit(f"Unknown releases: {', '.join(unknown)} (known: {', '.join(RELEASES)})", code=1)
+    url = prometheus or PROMETHEUS_URL
+    # Whole seconds, so the end printed for --record replays the exact same window
+    end = float(end) if end else float(int(time.time()))
+    start, step_seconds = end - parse_duration(window), parse_duration(step)
+    namespaces = "|".join(sorted({RELEASES[release][0] for release in selected}))
+
+    series = {kind: fetch_series(url, query.format(namespaces=namespaces), start, end, step_seconds, int(workers))
+              for kind, query in QUERIES.items()}
+    if record:
+        Path(record).write_text(json.dumps({
+            pattern: [{"metric": {"namespace": ns, "pod": pod, "container": container}, "values": values}
+                      for (ns, pod, container), values in series[kind].items()]
+            for kind, pattern in (("cpu", "container_cpu_usage_seconds_total"),
+                                  ("memory", "container_memory_working_set_bytes"))
+        }))
+        print(f"Recorded the query results in {record}, replay them with --end {end:.0f}")
+
+    cpu, memory = usage_stats(series["cpu"]), usage_stats(series["memory"])
+    mapped = {(RELEASES[release][0], target): (release, path)
+              for release in selected for target, path in RELEASES[release][1].items()}
+
+    print(f"{'release':<12} {'workload/container':<48} {'samples':>8} {'cpu p50':>8} {'cpu p95':>8} "
+          f"{'cpu p99':>8} {'mem p95':>8} {'mem max':>8}")
+    values = {release: {} for release in selected}
+    unmapped = []
+    for key in sorted(set(cpu) & set(memory)):
+        namespace, workload, container = key
+        target = f"{workload}/{container}"
+        release, path = mapped.get((namespace, target), (None, None))
+        usage_cpu, usage_memory = cpu[key], memory[key]
+        print(f"{release or namespace:<12} {target:<48} {usage_cpu['samples']:>8} "
+              f"{format_cpu(usage_cpu['p50']):>8} {format_cpu(usage_cpu['p95']):>8} {format_cpu(usage_cpu['p99']):>8} "
+              f"{format_memory(usage_memory['p95']):>8} {format_memory(usage_memory['max']):>8}")
+        resources = recommend(usage_cpu, usage_memory, float(headroom), cpu_limits)
+        if path:
+            _merge(values[release], _nested(path, resources))
+        else:
+            unmapped.append((namespace, target, resources))
+
+    for release in selected:
+        if not values[release]:
+            print(f"\n{release}: no usage data in {RELEASES[release][0]}")
+            continue
+        flat = []
+
+        def flatten(prefix, node):
+            for key, value in node.items():
+                if isinstance(value, dict):
+                    flatten(f"{prefix}{key}.", value)
+                else:
+                    flat.append(f"--set {prefix}{key}={value}")
+
+        flatten("", values[release])
+        print(f"\n{release}:\n  " + " \\\n  ".join(flat))
+        if output_dir:
+            Path(output_dir).mkdir(parents=True, exist_ok=True)
+            values_file = Path(output_dir) / f"{release}-resources.yaml"
+            values_file.write_text(yaml.safe_dump(values[release], sort_keys=True))
+            print(f"  written to {values_file} (helm upgrade ... -f {values_file})")
+
+    if unmapped:
+        print("\nNo values path known (add it to RELEASES in invoke_tasks/kubernetes/capacity.py):")
+        for namespace, target, resources in unmapped:
+            print(f"  {namespace}/{target}: {json.dumps(resources)}")
@@ -1,22 +1,166 @@
+import copy
+import json
 import os
-from invoke import task
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-@task
-def deploy_nginx(c, release_name="my-nginx", namespace="default"):
+import yaml
+from invoke import task, Exit
+
+from invoke_tasks.parallel import PrefixedStream
+
+from . import api
+from .helm import upgrade_install
+
+# Values deploy_nginx --performance adds: the chart's tuned nginx.conf
+NGINX_PERFORMANCE_VALUES = {
+    "performance.enabled": "true",
+}
+
+# ... and unless --no-autoscale, an HPA on CPU (which needs CPU requests) starting at the default two replicas
+NGINX_AUTOSCALING_VALUES = {
+    "autoscaling.enabled": "true",
+    "autoscaling.minReplicas": "2",
+    "autoscaling.maxReplicas": "10",
+    "autoscaling.targetCPUUtilizationPercentage": "70",
+    "resources.requests.cpu": "100m",
+    "resources.requests.memory": "64Mi",
+    "resources.limits.memory": "256Mi",
+}
+
+# Directives the rendered nginx.conf of the performance profile must contain
+NGINX_PERFORMANCE_DIRECTIVES = [
+    "worker_processes", "worker_connections", "keepalive_timeout", "keepalive_requests", "sendfile",
+    "tcp_nopush", "open_file_cache", "gzip on", "gzip_types", "Cache-Control",
+]
+
+
+@task(help={
+    "force": "Run the Helm upgrade even if the release is already up to date",
+    "performance": "Use the chart's tuned nginx.conf and autoscale on CPU",
+    "autoscale": "With --performance, autoscale on CPU; --no-autoscale keeps the fixed replicas and no resources",
+    "requests_per_second": "With --performance, also scale at this many requests/s per pod (needs a custom metrics API)",
+})
+def deploy_nginx(c, release_name="my-nginx", namespace="default", force=False, performance=False, autoscale=True,
+                 requests_per_second=0):
     """Deploy Nginx using local Helm chart"""
     kubeconfig = os.getenv('KUBECONFIG')
     print(f"Using KUBECONFIG: {kubeconfig}")
     
     # Deploy Nginx using local Helm chart
-    c.run(f"helm upgrade --install {release_name} ./nginx-server "
-          f"--namespace {namespace} "
-          f"--set ingress.enabled=true "
-          f"--set ingress.hosts[0].host=test-server.wsh-it.dk "
-          f"--set ingress.hosts[0].paths[0].path=/ "
-          f"--set ingress.hosts[0].paths[0].pathType=Prefix")
+    values = {
+        "ingress.enabled": "true",
+        "ingress.hosts[0].host": "test-server.wsh-it.dk",
+        "ingress.hosts[0].paths[0].path": "/",
+        "ingress.hosts[0].paths[0].pathType": "Prefix",
+    }
+    if performance:
+        values.update(NGINX_PERFORMANCE_VALUES)
+        if autoscale:
+            values.update(NGINX_AUTOSCALING_VALUES)
+            if int(requests_per_second):
+                values["autoscaling.targetRequestsPerSecond"] = str(int(requests_per_second))
+    upgrade_install(c, release_name, "./nginx-server", namespace, values=values, force=force)
     
     print(f"Nginx deployed successfully using local Helm chart as '{release_name}' in namespace '{namespace}'")
 
+
+@task(help={
+    "image": "nginx image to run `nginx -t` with (default: the chart's image)",
+    "requests_per_second": "Render the HPA with this requests/s target too",
+})
+def check_nginx_config(c, image=None, requests_per_second=100):
+    """Render the nginx-server chart's performance profile and check the nginx.conf, Deployment and HPA"""
+    import shutil
+    import tempfile
+
+    from .plan import manifest_documents
+
+    values = {**NGINX_PERFORMANCE_VALUES, **NGINX_AUTOSCALING_VALUES, "autoscaling.targetRequestsPerSecond": str(int(requests_per_second))}
+    sets = ",".join(f"{key}={value}" for key, value in values.items())
+    manifest = c.run(f"helm template check ./nginx-server --set {sets}", hide=True, in_stream=False).stdout
+    objects = {item["kind"]: item for item in manifest_documents(manifest)}
+    problems = []
+
+    config = (objects.get("ConfigMap") or {}).get("data", {}).get("nginx.conf", "")
+    problems += [f"nginx.conf has no {directive}" for directive in NGINX_PERFORMANCE_DIRECTIVES
+                 if directive not in config]
+    if "e+" in config:
+        problems.append("nginx.conf has a number in scientific notation")
+
+    pod = (objects.get("Deployment") or {}).get("spec", {}).get("template", {})
+    container = (pod.get("spec", {}).get("containers") or [{}])[0]
+    if not any(mount.get("mountPath") == "/etc/nginx/nginx.conf" for mount in container.get("volumeMounts", [])):
+        problems.append("the nginx container doesn't mount nginx.conf")
+    if "checksum/config" not in (pod.get("metadata", {}).get("annotations") or {}):
+        problems.append("the pod template has no checksum/config annotation, config changes won't roll the pods")
+    if not container.get("resources", {}).get("requests", {}).get("cpu"):
+        problems.append("the nginx container has no CPU request, the HPA can't compute CPU utilization")
+
+    metrics = (objects.get("HorizontalPodAutoscaler") or {}).get("spec", {}).get("metrics", [])
+    if not any(metric["type"] == "Resource" and metric["resource"]["name"] == "cpu" for metric in metrics):
+        problems.append("the HPA has no CPU target")
+    if not any(metric["type"] == "Pods" for metric in metrics):
+        problems.append("the HPA has no requests/s target")
+
+    if shutil.which("docker"):
+        image = image or container.get("image", "nginx")
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "nginx.conf")
+            with open(path, "w") as f:
+                f.write(config)
+            result = c.run(f"docker run --rm -v {path}:/etc/nginx/nginx.conf:ro {image} nginx -t",
+                           hide=True, warn=True, in_stream=False)
+        if result.failed:
+            problems.append(f"nginx -t failed: {result.stderr.strip()}")
+        else:
+            print(f"nginx -t passed with {image}")
+    else:
+        print("docker not found, skipping `nginx -t`")
+
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    if problems:
+        raise Exit(code=1)
+    print(f"nginx-server performance profile OK: {len(objects)} objects, {len(metrics)} HPA metrics")
+
+
+@task(help={
+    "url": "URL to load (default: http://<first node's InternalIP>/, i.e. through the Traefik ingress)",
+    "host": "Host header of the ingress route",
+    "duration": "Seconds per load test",
+    "concurrency": "Keep-alive connections of the load test",
+    "rate": "Requests per second to schedule instead of running closed loop",
+})
+def benchmark_nginx(c, url=None, host="test-server.wsh-it.dk", release_name="my-nginx", namespace="default",
+                    duration=30, concurrency=50, rate=None):
+    """Load test the Nginx release with the image's default config, then with the performance profile"""
+    from invoke_tasks.benchmarks import LOADTEST_RESULTS, loadtest
+    from invoke_tasks.wait import wait_for_rollout
+
+    from . import cache
+
+    if url is None:
+        url = f"http://{next(iter(cache.node_ips().values()))}/"
+    labels = {}
+    for profile in ("baseline", "performance"):
+        # Without the HPA both runs have the same replicas and resources, so only nginx.conf differs
+        deploy_nginx(c, release_name, namespace, performance=profile == "performance", autoscale=False)
+        wait_for_rollout(namespace, release_name if "nginx-server" in release_name else f"{release_name}-nginx-server")
+        labels[profile] = f"{release_name} {profile}"
+        loadtest(c, url=url, host=host, rate=rate, concurrency=concurrency, duration=duration, label=labels[profile])
+
+    with open(LOADTEST_RESULTS) as f:
+        stored = json.load(f)
+    before, after = (stored[labels[profile]] for profile in ("baseline", "performance"))
+    print(f"\nperformance profile vs baseline: {(after['rps'] / before['rps'] - 1) * 100 if before['rps'] else 0:+.1f}% requests/s, "
+          f"p99 {before['latency_ms']['p99']:.2f} -> {after['latency_ms']['p99']:.2f}ms, "
+          f"errors {before['error_rate']:.2%} -> {after['error_rate']:.2%}")
+
+
 @task
 def delete_nginx(c, release_name="my-nginx", namespace="default"):
     """Delete the Nginx deployment using Helm"""
@@ -26,24 +170,220 @@ def delete_nginx(c, release_name="my-nginx", namespace="default"):
 @task
 def deploy_job(c, job_file):
     """Deploy a Kubernetes job"""
-    c.run(f"kubectl apply -f {job_file}")
+    with open(job_file) as f:
+        for manifest in yaml.safe_load_all(f):
+            if manifest:
+                manifest["metadata"].setdefault("namespace", "default")
+                api.apply(manifest)
     print(f"Job from {job_file} deployed successfully")
 
 
 @task
-def list_jobs(c):
+def list_jobs(c, namespace="default"):
     """List all Kubernetes jobs"""
-    c.run("kubectl get jobs")
+    print(f"{'NAME':<40} {'COMPLETIONS':<12} {'ACTIVE':<7} {'FAILED':<7}")
+    for job in api.batch().list_namespaced_job(namespace).items:
+        completions = f"{job.status.succeeded or 0}/{job.spec.completions or 1}"
+        print(f"{job.metadata.name:<40} {completions:<12} {job.status.active or 0:<7} {job.status.failed or 0:<7}")
 
 
 @task
-def delete_job(c, job_name):
+def delete_job(c, job_name, namespace="default"):
     """Delete a Kubernetes job"""
-    c.run(f"kubectl delete job {job_name}")
+    api.batch().delete_namespaced_job(job_name, namespace, propagation_policy="Background")
     print(f"Job '{job_name}' deleted successfully")
 
 
 @task
-def get_job_logs(c, job_name):
+def get_job_logs(c, job_name, namespace="default"):
     """Get logs for a specific job"""
-    c.run(f"kubectl logs job/{job_name}")
+    for pod in api.core().list_namespaced_pod(namespace, label_selector=f"job-name={job_name}").items:
+        print(api.core().read_namespaced_pod_log(pod.metadata.name, namespace), end="")
+
+
+# Label tying the jobs and pods of one run_batch run together
+BATCH_LABEL = "invoke-tasks/batch"
+# Index of a fan-out job's pods; Indexed Jobs annotate theirs with COMPLETION_INDEX
+BATCH_INDEX_LABEL = "invoke-tasks/batch-index"
+COMPLETION_INDEX = "batch.kubernetes.io/job-completion-index"
+
+
+def _job_finished(job):
+    return any(cond.type in ("Complete", "Failed") and cond.status == "True" for cond in (job.status and job.status.conditions) or [])
+
+
+def _job_failed(job):
+    return any(cond.type == "Failed" and cond.status == "True" for cond in (job.status and job.status.conditions) or [])
+
+
+def _pod_index(pod):
+    index = (pod.metadata.annotations or {}).get(COMPLETION_INDEX) or (pod.metadata.labels or {}).get(BATCH_INDEX_LABEL)
+    return int(index) if index is not None else None
+
+
+def batch_jobs(manifest, run, mode, completions, parallelism, command=None):
+    """
+    The Job manifests of one batch run of the Job `manifest`.
+
+    "indexed" is a single Indexed Job running `parallelism` pods at a time; "fanout" is one suspended
+    Job per index, resumed by run_batch `parallelism` at a time. Either way every container gets its
+    index in JOB_COMPLETION_INDEX, and `command` replaces the first container's command (run by sh -c).
+    """
+    manifest = copy.deepcopy(manifest)
+    pod_spec = manifest["spec"]["template"]["spec"]
+    if command:
+        pod_spec["containers"][0]["command"] = ["sh", "-c", command]
+        pod_spec["containers"][0].pop("args", None)
+    manifest["spec"]["template"].setdefault("metadata", {}).setdefault("labels", {})[BATCH_LABEL] = run
+    manifest["metadata"] = {**manifest["metadata"], "labels": {**manifest["metadata"].get("labels", {}), BATCH_LABEL: run}}
+
+    if mode == "indexed":
+        manifest["metadata"]["name"] = run
+        manifest["spec"].update({"completionMode": "Indexed", "completions": completions, "parallelism": parallelism})
+        return [manifest]
+
+    jobs = []
+    for index in range(completions):
+        job = copy.deepcopy(manifest)
+        job["metadata"]["name"] = f"{run}-{index}"
+        job["spec"]["suspend"] = True
+        job["spec"]["template"]["metadata"]["labels"][BATCH_INDEX_LABEL] = str(index)
+        for container in job["spec"]["template"]["spec"]["containers"]:
+            container["env"] = container.get("env", []) + [{"name": "JOB_COMPLETION_INDEX", "value": str(index)}]
+        jobs.append(job)
+    return jobs
+
+
+class _LogFollower:
+    """Streams the logs of every pod of a batch as it starts, each line prefixed with the pod's index."""
+
+    def __init__(self, namespace, run, output):
+        self.namespace = namespace
+        self.selector = f"{BATCH_LABEL}={run}"
+        self.output = output
+        self.followed = set()
+        self.threads = []
+        self.stopped = threading.Event()
+        self.watcher = threading.Thread(target=self._watch_pods, daemon=True)
+
+    def __enter__(self):
+        self.watcher.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        # Pods that finished just now may only be picked up by the watch's last round
+        self.watcher.join(timeout=5)
+        # Followers end by themselves when their container exits; the last lines are still on the way
+        for thread in self.threads:
+            thread.join(timeout=10)
+
+    def _watch_pods(self):
+        from kubernetes import watch
+
+        while not self.stopped.is_set():
+            try:
+                for event in watch.Watch().stream(api.core().list_namespaced_pod, self.namespace,
+                                                  label_selector=self.selector, timeout_seconds=2):
+                    pod = event["object"]
+                    if pod.status.phase != "Pending" and pod.metadata.name not in self.followed:
+                        self.followed.add(pod.metadata.name)
+                        thread = threading.Thread(target=self._follow, args=(pod,), daemon=True)
+                        thread.start()
+                        self.threads.append(thread)
+            except Exception as e:
+                print(f"Warning: pod watch interrupted ({e}), resuming")
+                time.sleep(1)
+
+    def _follow(self, pod):
+        stream = PrefixedStream(_pod_index(pod), self.output)
+        try:
+            response = api.core().read_namespaced_pod_log(pod.metadata.name, self.namespace, follow=True,
+                                                          _preload_content=False)
+            for line in response:
+                stream.write(line.decode(errors="replace"))
+        except Exception as e:
+            stream.write(f"<log unavailable: {e}>\n")
+        stream.close()
+
+
+@task(help={
+    "job_file": "Job manifest to run as a batch",
+    "completions": "Number of indexes (work items) in the batch",
+    "parallelism": "Pods (indexed) or jobs (fanout) running at the same time",
+    "mode": "'indexed' for one Indexed Job, 'fanout' for one Job per index",
+    "command": "Shell command replacing the first container's command, e.g. 'backfill --shard $JOB_COMPLETION_INDEX'",
+    "name": "Batch name, default the job name plus a timestamp",
+    "namespace": "Namespace to run the batch in",
+    "timeout": "Seconds to wait for the whole batch",
+    "keep": "Keep the jobs and their pods after the batch finished",
+})
+def run_batch(c, job_file="k8s/example_deployments/jobs/sample-job.yaml", completions=4, parallelism=2, mode="indexed",
+              command=None, name=None, namespace="default", timeout=3600, keep=False):
+    """Run a job as a batch of indexed work items, streaming all pod logs and reporting per-index durations"""
+    from invoke_tasks.wait import watch_until
+
+    completions, parallelism = int(completions), int(parallelism)
+    if mode not in ("indexed", "fanout"):
+        raise Exit(f"Unknown mode '{mode}', use indexed or fanout", code=1)
+    with open(job_file) as f:
+        manifest = next(doc for doc in yaml.safe_load_all(f) if doc and doc.get("kind") == "Job")
+    run = name or f"{manifest['metadata']['name']}-{time.strftime('%Y%m%d-%H%M%S')}"
+    jobs = batch_jobs(manifest, run, mode, completions, parallelism, command)
+    for job in jobs:
+        job["metadata"]["namespace"] = namespace
+
+    def release(jobs_now):
+        # Fan-out jobs are created suspended and resumed here as running ones finish
+        active = [j for j in jobs_now.values() if not j.spec.suspend and not _job_finished(j)]
+        waiting = sorted((j for j in jobs_now.values() if j.spec.suspend), key=lambda j: j.metadata.name)
+        for job in waiting[:max(0, parallelism - len(active))]:
+            api.batch().patch_namespaced_job(job.metadata.name, namespace, {"spec": {"suspend": False}})
+            job.spec.suspend = False
+
+    def batch_finished(jobs_now):
+        if mode == "fanout":
+            release(jobs_now)
+        return len(jobs_now) == len(jobs) and all(_job_finished(job) for job in jobs_now.values())
+
+    start = time.monotonic()
+    with _LogFollower(namespace, run, sys.stdout):
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            list(pool.map(api.apply, jobs))
+        print(f"Submitted {run}: {completions} indexes as {len(jobs)} job(s), {parallelism} at a time")
+        finished = watch_until(api.batch().list_namespaced_job, batch_finished, timeout=int(timeout),
+                               description=f"batch {run}", namespace=namespace,
+                               label_selector=f"{BATCH_LABEL}={run}")
+    elapsed = time.monotonic() - start
+
+    pods = api.core().list_namespaced_pod(namespace, label_selector=f"{BATCH_LABEL}={run}").items
+    by_index = {}
+    for pod in pods:
+        by_index.setdefault(_pod_index(pod), []).append(pod)
+
+    print(f"\n{'index':>5} {'status':<10} {'attempts':>8} {'seconds':>8}")
+    durations = []
+    for index in range(completions):
+        attempts = by_index.get(index, [])
+        done = [pod for pod in attempts if pod.status.phase == "Succeeded"]
+        seconds = None
+        if done and done[0].status.container_statuses:
+            terminated = done[0].status.container_statuses[0].state.terminated
+            if terminated:
+                seconds = (terminated.finished_at - done[0].status.start_time).total_seconds()
+                durations.append(seconds)
+        status = "succeeded" if done else "failed" if attempts else "not run"
+        print(f"{index:>5} {status:<10} {len(attempts):>8} {'-' if seconds is None else f'{seconds:.1f}':>8}")
+
+    succeeded = sum(1 for index in range(completions) if any(p.status.phase == "Succeeded" for p in by_index.get(index, [])))
+    print(f"\n{run}: {succeeded}/{completions} indexes succeeded in {elapsed:.1f}s "
+          f"({succeeded / elapsed * 60:.1f} per minute)")
+    if durations:
+        print(f"per index: median {statistics.median(durations):.1f}s, max {max(durations):.1f}s")
+
+    if not keep:
+        for job in jobs:
+            api.ignore_not_found(api.batch().delete_namespaced_job, job["metadata"]["name"], namespace,
+                                 propagation_policy="Background")
+    if succeeded < completions or any(_job_failed(job) for job in finished.values()):
+        raise Exit(f"Batch {run} failed", code=1)
@@ -1,30 +1,25 @@
 import os
 
-from invoke import task
+from invoke import task, Exit
 
-@task
-def deploy_harbor(c):
-    kubeconfig = os.environ.get('KUBECONFIG')
+from invoke_tasks.wait import wait_for_port
+from .helm import upgrade_install
+
+@task(help={"force": "Run the Helm upgrade even if the release is already up to date"})
+def deploy_harbor(c, force=False):
     admin_password = os.getenv("ADMIN_PASSWORD")
     domain = os.getenv("DOMAIN")
     harbor_domain = f"harbor.{domain}"
 
     """Deploy Harbor container registry to the Kubernetes cluster"""
-    # Add the Harbor Helm repository
-    c.run("helm repo add harbor https://helm.goharbor.io")
-    c.run("helm repo update")
-
     # Deploy Harbor
-    c.run(f"""
-    KUBECONFIG={kubeconfig} helm upgrade --install harbor harbor/harbor \
-        --namespace harbor --create-namespace \
-        --set expose.type=ingress \
-        --set expose.ingress.hosts.core={harbor_domain} \
-        --set externalURL=https://{harbor_domain} \
-        --set persistence.enabled=true \
-        --set harborAdminPassword={admin_password} \
-        --timeout 600s
-    """)
+    upgrade_install(c, "harbor", "harbor/harbor", "harbor", values={
+        "expose.type": "ingress",
+        "expose.ingress.hosts.core": harbor_domain,
+        "externalURL": f"https://{harbor_domain}",
+        "persistence.enabled": "true",
+        "harborAdminPassword": admin_password,
+    }, timeout="600s", force=force)
 
     print("Harbor deployment initiated. This may take several minutes to complete.")
     print("You can check the status of the deployment with:")
@@ -37,28 +32,29 @@ def deploy_harbor(c):
 
 
 
-@task
-def deploy_docker_registry(c):
-    kubeconfig = os.environ.get('KUBECONFIG')
+@task(help={
+    "force": "Run the Helm upgrade even if the release is already up to date",
+    "proxy": "Run the registry as a pull-through cache of this upstream, e.g. https://registry-1.docker.io",
+})
+def deploy_docker_registry(c, force=False, proxy=""):
     domain = os.getenv("DOMAIN", "yourdomain.com")
     registry_domain = f"registry.{domain}"
 
     """Deploy Docker Registry to the Kubernetes cluster"""
-    c.run("helm repo add twuni https://helm.twun.io")
-    c.run("helm repo update")
-
-    c.run(f"""
-    KUBECONFIG={kubeconfig} helm upgrade --install docker-registry twuni/docker-registry \
-        --namespace container-registry --create-namespace \
-        --set service.type=ClusterIP \
-        --set ingress.enabled=true \
-        --set ingress.hosts[0].host={registry_domain} \
-        --set ingress.hosts[0].paths[0].path=/ \
-        --set ingress.hosts[0].paths[0].pathType=Prefix \
-        --set persistence.enabled=true \
-        --set persistence.size=10Gi \
-        --timeout 600s
-    """)
+    values = {
+        "service.type": "ClusterIP",
+        "ingress.enabled": "true",
+        "ingress.hosts[0].host": registry_domain,
+        "ingress.hosts[0].paths[0].path": "/",
+        "ingress.hosts[0].paths[0].pathType": "Prefix",
+        "persistence.enabled": "true",
+        "persistence.size": "10Gi",
+    }
+    if proxy:
+        # A proxying registry is read-only: it caches what it pulls from `proxy` and rejects pushes
+        values.update({"proxy.enabled": "true", "proxy.remoteurl": proxy})
+    upgrade_install(c, "docker-registry", "twuni/docker-registry", "container-registry", values=values,
+                    timeout="600s", force=force)
 
     print("Docker Registry deployment initiated. This may take several minutes to complete.")
     print("You can check the status of the deployment with:")
@@ -66,27 +62,19 @@ def deploy_docker_registry(c):
     print(f"\nOnce deployed, you can access the Docker Registry at: https://{registry_domain}")
 
 
-@task
-def deploy_dokku(c):
-    kubeconfig = os.environ.get('KUBECONFIG')
+@task(help={"force": "Run the Helm upgrade even if the release is already up to date"})
+def deploy_dokku(c, force=False):
     """Deploy Dokku to the Kubernetes cluster"""
-    # Add the Dokku Helm repository
-    c.run("helm repo add dokku https://dokku.github.io/dokku")
-    c.run("helm repo update")
-
     # Deploy Dokku
-    c.run(f"""
-    KUBECONFIG={kubeconfig} helm upgrade --install dokku dokku/dokku \
-        --namespace dokku --create-namespace \
-        --set service.type=LoadBalancer \
-        --set service.annotations."external-dns\\.alpha\\.kubernetes\\.io/hostname"=dokku.wsh-it.dk \
-        --set ingress.enabled=true \
-        --set ingress.annotations."kubernetes\\.io/ingress\\.class"=traefik \
-        --set ingress.hosts[0].host=dokku.wsh-it.dk \
-        --set ingress.hosts[0].paths[0].path=/ \
-        --set persistence.enabled=true \
-        --timeout 600s
-    """)
+    upgrade_install(c, "dokku", "dokku/dokku", "dokku", values={
+        "service.type": "LoadBalancer",
+        r"service.annotations.external-dns\.alpha\.kubernetes\.io/hostname": "dokku.wsh-it.dk",
+        "ingress.enabled": "true",
+        r"ingress.annotations.kubernetes\.io/ingress\.class": "traefik",
+        "ingress.hosts[0].host": "dokku.wsh-it.dk",
+        "ingress.hosts[0].paths[0].path": "/",
+        "persistence.enabled": "true",
+    }, timeout="600s", force=force)
 
     print("Dokku deployment initiated. This may take several minutes to complete.")
     print("You can check the status of the deployment with:")
@@ -95,13 +83,9 @@ def deploy_dokku(c):
     print("To use Dokku, you'll need to set up SSH access and configure your local Dokku CLI.")
     print("Refer to the Dokku documentation for post-installation steps and usage instructions.")
 
-@task
-def deploy_gitlab(c):
-    kubeconfig = os.environ.get('KUBECONFIG')
+@task(help={"force": "Run the Helm upgrade even if the release is already up to date"})
+def deploy_gitlab(c, force=False):
     """Deploy GitLab to the Kubernetes cluster using Helm"""
-    # Add the GitLab Helm repository
-    c.run("helm repo add gitlab https://charts.gitlab.io/")
-    c.run("helm repo update")
 
     admin_email = os.getenv("ADMIN_EMAIL")
     # Define the runners config as a multiline string
@@ -120,15 +104,13 @@ def deploy_gitlab(c):
     """
 
     # Deploy GitLab
-    c.run(f"""
-    KUBECONFIG={kubeconfig} helm upgrade --install gitlab gitlab/gitlab \
-        --namespace gitlab --create-namespace \
-        --set global.hosts.domain=gitlab.wsh-it.dk \
-        --set certmanager-issuer.email={admin_email} \
-        --set gitlab-runner.runners.privileged=true \
-        --set-string gitlab-runner.runners.config="{runners_config}" \
-        --timeout 600s
-    """)
+    upgrade_install(c, "gitlab", "gitlab/gitlab", "gitlab", values={
+        "global.hosts.domain": "gitlab.wsh-it.dk",
+        "certmanager-issuer.email": admin_email,
+        "gitlab-runner.runners.privileged": "true",
+    }, string_values={
+        "gitlab-runner.runners.config": runners_config,
+    }, timeout="600s", force=force)
 
 
     print("GitLab deployment initiated. This may take several minutes to complete.")
@@ -140,6 +122,7 @@ def deploy_gitlab(c):
 def create_docker_registry(c):
     """Create a local Docker registry"""
     c.run("docker run -d -p 5000:5000 --name registry registry:2")
+    wait_for_port("localhost", 5000)
     print("Local Docker registry created on port 5000")
 
 
@@ -152,30 +135,51 @@ def push_image_to_registry(c, image_name, tag="latest"):
     print(f"Image {image_name}:{tag} pushed to local registry")
 
 
+@task(help={
+    "images": "Comma separated local images or globs, e.g. 'myapp:1.2,tools/*' (no tag means :latest)",
+    "registry": "Registry to push to (default $REGISTRY or localhost:5000), e.g. registry.example.com",
+    "workers": "Number of images pushed at the same time",
+    "username": "Registry user (default: the credentials of `docker login`)",
+    "password": "Registry password (default $REGISTRY_PASSWORD)",
+})
+def push_images(c, images, registry=None, workers=4, username=None, password=None):
+    """Push many images concurrently, skipping the ones the registry already has"""
+    from invoke_tasks import registry as registries
+
+    registry = registry or registries.REGISTRY
+    credentials = (username, password or os.getenv("REGISTRY_PASSWORD", "")) if username else None
+    results = registries.push_images(images, registry, workers=int(workers), credentials=credentials)
+
+    def megabytes(size):
+        return f"{size / 1024 / 1024:9.1f} MB"
+
+    print(f"\n{'status':<8} {'uploaded':>12} {'skipped':>12}  image")
+    for result in sorted(results, key=lambda result: result["image"]):
+        print(f"{result['status']:<8} {megabytes(result['uploaded'])} {megabytes(result['skipped'])}  {result['target'] or result['image']}")
+    uploaded = sum(result["uploaded"] for result in results)
+    skipped = sum(result["skipped"] for result in results)
+    counts = {status: sum(result["status"] == status for result in results) for status in ("pushed", "skipped", "failed")}
+    print(f"{counts['pushed']} pushed, {counts['skipped']} already in {registry}, {counts['failed']} failed; "
+          f"uploaded {megabytes(uploaded).strip()}, skipped {megabytes(skipped).strip()}")
+    if counts["failed"]:
+        raise Exit(code=1)
+
+
 from invoke import task
 
-@task
-def deploy_vault(c):
+@task(help={"force": "Run the Helm upgrade even if the release is already up to date"})
+def deploy_vault(c, force=False):
     """Deploy HashiCorp Vault to the Kubernetes cluster using Helm."""
 
-    # Path to your kubeconfig
-    kubeconfig = os.environ.get('KUBECONFIG')
-
-    # Add the HashiCorp Helm repository
-    c.run("helm repo add hashicorp https://helm.releases.hashicorp.com")
-    c.run("helm repo update")
-
-    # Deploy Vault with hardcoded settings directly in the command
-    c.run(f"""KUBECONFIG={kubeconfig} helm upgrade --install vault hashicorp/vault \
-        --namespace vault --create-namespace \
-        --set server.ha.enabled=true \
-        --set server.ha.raft.enabled=true \
-        --set server.ha.raft.storageClass=standard \
-        --set server.ha.raft.setSize=3 \
-        --set server.dataStorage.storageClass=standard \
-        --set server.dataStorage.size=10Gi \
-        --set server.service.type=LoadBalancer \
-        --set server.storageBackend=raft \
-        --timeout 600s
-    """)
+    # Deploy Vault with hardcoded settings
+    upgrade_install(c, "vault", "hashicorp/vault", "vault", values={
+        "server.ha.enabled": "true",
+        "server.ha.raft.enabled": "true",
+        "server.ha.raft.storageClass": "standard",
+        "server.ha.raft.setSize": "3",
+        "server.dataStorage.storageClass": "standard",
+        "server.dataStorage.size": "10Gi",
+        "server.service.type": "LoadBalancer",
+        "server.storageBackend": "raft",
+    }, timeout="600s", force=force)
 
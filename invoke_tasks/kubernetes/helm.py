@@ -0,0 +1,367 @@
+import base64
+import gzip
+import hashlib
+import json
+import os
+import platform
+import re
+import shlex
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import yaml
+from invoke import task
+
+# Chart repositories used by the deploy tasks, registered under these names
+REPOS = {
+    "projectcalico": "https://docs.tigera.io/calico/charts",
+    "traefik": "https://helm.traefik.io/traefik",
+    "longhorn": "https://charts.longhorn.io",
+    "prometheus-community": "https://prometheus-community.github.io/helm-charts",
+    "grafana": "https://grafana.github.io/helm-charts",
+    "kubernetes-dashboard": "https://kubernetes.github.io/dashboard/",
+    "teleport": "https://charts.releases.teleport.dev",
+    "harbor": "https://helm.goharbor.io",
+    "twuni": "https://helm.twun.io",
+    "dokku": "https://dokku.github.io/dokku",
+    "gitlab": "https://charts.gitlab.io/",
+    "hashicorp": "https://helm.releases.hashicorp.com",
+    "ollama-helm": "https://otwld.github.io/ollama-helm/",
+    "open-webui": "https://helm.openwebui.com/",
+}
+
+# Seconds a downloaded repo index is considered fresh
+REPO_TTL = int(os.getenv("HELM_REPO_TTL", 3600))
+
+# Label on the deployed Helm release secret holding the hash of what was last deployed
+STATE_LABEL = "invoke-tasks/desired-state"
+
+# Resolved chart versions, keyed by repo index file and chart name
+VERSION_CACHE = Path.home() / ".cache" / "invoke-tasks" / "chart-versions.json"
+
+# Set OFFLINE_BUNDLE to a bundle directory (k8s.bundle) to install repo charts from it, without network
+OFFLINE_BUNDLE_ENV = "OFFLINE_BUNDLE"
+
+_thread_lock = threading.Lock()
+
+# Set by plan_mode() on the threads that only plan releases
+_plan = threading.local()
+
+
+class PlannedRelease(Exception):
+    """Raised by upgrade_install in plan mode instead of running Helm; `spec` is what it would install."""
+
+    def __init__(self, spec):
+        super().__init__(f"planned release {spec['release']}")
+        self.spec = spec
+
+
+@contextmanager
+def plan_mode():
+    """Within this block, upgrade_install on this thread raises PlannedRelease instead of installing."""
+    _plan.active = True
+    try:
+        yield
+    finally:
+        _plan.active = False
+
+
+def planning():
+    """True in plan mode, so deploy tasks can skip changes they make before their Helm release."""
+    return getattr(_plan, "active", False)
+
+
+def helm_paths():
+    """
+    Return (repositories.yaml, repository cache dir) the way Helm resolves them.
+
+    Honours HELM_REPOSITORY_CONFIG / HELM_REPOSITORY_CACHE and HELM_CONFIG_HOME / HELM_CACHE_HOME,
+    and otherwise uses Helm's per-platform defaults, so no `helm env` process is needed.
+    """
+    home = Path.home()
+    if platform.system() == "Windows":
+        config_home, cache_home = Path(os.environ["APPDATA"]), Path(tempfile.gettempdir())
+    elif platform.system() == "Darwin":
+        config_home, cache_home = home / "Library" / "Preferences", home / "Library" / "Caches"
+    else:
+        config_home = Path(os.getenv("XDG_CONFIG_HOME", home / ".config"))
+        cache_home = Path(os.getenv("XDG_CACHE_HOME", home / ".cache"))
+    config_dir = Path(os.getenv("HELM_CONFIG_HOME", config_home / "helm"))
+    cache_dir = Path(os.getenv("HELM_CACHE_HOME", cache_home / "helm"))
+    return (
+        Path(os.getenv("HELM_REPOSITORY_CONFIG", config_dir / "repositories.yaml")),
+        Path(os.getenv("HELM_REPOSITORY_CACHE", cache_dir / "repository")),
+    )
+
+
+@contextmanager
+def _file_lock(path):
+    """Exclusive lock shared between threads and concurrent invoke processes."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with _thread_lock, open(path, "a+") as handle:
+        if os.name == "nt":
+            import msvcrt
+            handle.seek(0)
+            msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                handle.seek(0)
+                msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def _registered_repos(repo_config):
+    if not repo_config.exists():
+        return {}
+    with open(repo_config) as f:
+        data = yaml.safe_load(f) or {}
+    return {repo["name"]: repo["url"] for repo in data.get("repositories") or []}
+
+
+def index_age(name):
+    """Seconds since the cached index of repo `name` was downloaded (infinite if missing)."""
+    _, cache_dir = helm_paths()
+    index_file = cache_dir / f"{name}-index.yaml"
+    if not index_file.exists():
+        return float("inf")
+    return time.time() - index_file.stat().st_mtime
+
+
+def ensure_repos(c, *names, ttl=None):
+    """
+    Make sure the chart repos `names` (keys of REPOS) are registered and their index is fresh.
+
+    Repos are only added when missing or pointing at another URL, and only the requested repos are
+    refreshed, and only if their cached index is older than `ttl` seconds (default HELM_REPO_TTL).
+    """
+    ttl = REPO_TTL if ttl is None else ttl
+    repo_config, _ = helm_paths()
+
+    # Helm itself takes repositories.lock during `repo add`, so use a separate lock file
+    with _file_lock(repo_config.with_name("repositories.invoke.lock")):
+        registered = _registered_repos(repo_config)
+        added = []
+        for name in names:
+            if registered.get(name, "").rstrip("/") != REPOS[name].rstrip("/"):
+                c.run(f"helm repo add --force-update {name} {REPOS[name]}")
+                added.append(name)
+
+        stale = [name for name in names if name not in added and index_age(name) > ttl]
+        if stale:
+            c.run(f"helm repo update {' '.join(stale)}")
+
+
+@task(help={
+    "names": "Comma separated repo names, defaults to all repos used by the deploy tasks",
+    "ttl": "Only refresh indexes older than this many seconds (0 forces a refresh)",
+})
+def update_helm_repos(c, names="", ttl=None):
+    """Register the chart repos and refresh the stale indexes"""
+    selected = [name.strip() for name in names.split(",") if name.strip()] or list(REPOS)
+    ensure_repos(c, *selected, ttl=None if ttl is None else int(ttl))
+    for name in selected:
+        print(f"{name:<22} index age: {index_age(name):.0f}s")
+
+
+def _semver_key(version):
+    return tuple(int(part) for part in re.findall(r"\d+", version.split("+")[0])[:3])
+
+
+def _latest_in_index(index_file, chart):
+    """
+    Newest stable version of `chart` in a repo index file.
+
+    The index is scanned line by line instead of parsed as YAML: the big indexes (GitLab, Bitnami)
+    are tens of MB and take seconds to load, but entries are always written as
+    `  <chart>:` followed by list items whose keys are indented by four spaces.
+    """
+    versions = []
+    in_chart = False
+    with open(index_file, encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("  ") and not line.startswith("   ") and not line.startswith("  -"):
+                in_chart = line.strip() == f"{chart}:"
+            elif in_chart:
+                match = re.match(r"  (?:- |  )version: ['\"]?([^'\"\s]+)", line)
+                if match and "-" not in match.group(1):
+                    versions.append(match.group(1))
+    return max(versions, key=_semver_key) if versions else None
+
+
+def resolve_chart_version(chart):
+    """
+    The version `helm upgrade` would install for `chart` ("repo/chart" or a local chart directory).
+
+    Repo charts resolve to the newest stable version in the cached repo index (memoized per index
+    mtime); local charts to their Chart.yaml version plus a hash of the chart files, so edited
+    templates count as a change.
+    """
+    chart_dir = Path(chart)
+    if chart_dir.is_dir():
+        digest = hashlib.sha256()
+        for path in sorted(p for p in chart_dir.rglob("*") if p.is_file()):
+            digest.update(path.relative_to(chart_dir).as_posix().encode())
+            digest.update(path.read_bytes())
+        with open(chart_dir / "Chart.yaml") as f:
+            version = yaml.safe_load(f)["version"]
+        return f"{version}+{digest.hexdigest()[:12]}"
+
+    repo, name = chart.split("/", 1)
+    _, cache_dir = helm_paths()
+    index_file = cache_dir / f"{repo}-index.yaml"
+    if not index_file.exists():
+        return None
+    mtime = index_file.stat().st_mtime
+
+    cache = json.loads(VERSION_CACHE.read_text()) if VERSION_CACHE.exists() else {}
+    cached = cache.get(f"{index_file}:{name}")
+    if cached and cached["mtime"] == mtime:
+        return cached["version"]
+
+    version = _latest_in_index(index_file, name)
+    cache[f"{index_file}:{name}"] = {"mtime": mtime, "version": version}
+    VERSION_CACHE.parent.mkdir(parents=True, exist_ok=True)
+    VERSION_CACHE.write_text(json.dumps(cache, indent=1))
+    return version
+
+
+def desired_state_hash(release, chart, version, namespace, values, string_values, extra_args):
+    """Hash of everything that determines what `helm upgrade --install` deploys."""
+    state = json.dumps({
+        "release": release,
+        "chart": chart,
+        "version": version,
+        "namespace": namespace,
+        "values": values,
+        "string_values": string_values,
+        "extra_args": extra_args,
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(state.encode()).hexdigest()[:40]
+
+
+def _deployed_release_secret(release, namespace):
+    from .api import core
+    from kubernetes.client.rest import ApiException
+
+    try:
+        secrets = core().list_namespaced_secret(
+            namespace, label_selector=f"owner=helm,name={release},status=deployed").items
+    except ApiException:
+        return None
+    return max(secrets, key=lambda s: int(s.metadata.labels.get("version", 0)), default=None)
+
+
+def deployed_state(release, namespace):
+    """The desired-state hash recorded on the deployed revision of `release`, if any."""
+    secret = _deployed_release_secret(release, namespace)
+    return (secret.metadata.labels or {}).get(STATE_LABEL) if secret else None
+
+
+def deployed_release(release, namespace):
+    """The decoded Helm release record (manifest, chart, config, ...) of the deployed revision, or None."""
+    secret = _deployed_release_secret(release, namespace)
+    if secret is None:
+        return None
+    # Helm stores the release as base64(gzip(json)), and the secret data is base64 encoded once more
+    data = base64.b64decode(base64.b64decode(secret.data["release"]))
+    if data[:2] == b"\x1f\x8b":
+        data = gzip.decompress(data)
+    return json.loads(data)
+
+
+def record_state(release, namespace, state):
+    from .api import core
+    from kubernetes.client.rest import ApiException
+
+    secret = _deployed_release_secret(release, namespace)
+    if secret is None:
+        print(f"Warning: no deployed Helm release secret for {release}, desired state not recorded")
+        return
+    try:
+        core().patch_namespaced_secret(secret.metadata.name, namespace, {"metadata": {"labels": {STATE_LABEL: state}}})
+    except ApiException as e:
+        print(f"Warning: could not record desired state of {release}: {e.reason}")
+
+
+def bundled_chart(chart, bundle):
+    """(chart archive, version) of repo chart `chart` in the offline bundle directory `bundle`."""
+    bundle = Path(bundle)
+    with open(bundle / "index.json") as f:
+        entry = json.load(f)["charts"].get(chart)
+    if entry is None:
+        raise FileNotFoundError(f"{chart} is not in the offline bundle {bundle}, add it with: invoke k8s.bundle")
+    return bundle / "blobs" / "sha256" / entry["digest"].split(":")[1], entry["version"]
+
+
+def chart_args(chart, source, version, values, string_values):
+    """Shell-quoted chart, --version and --set arguments shared by `helm upgrade` and `helm template`."""
+    args = [shlex.quote(str(source))]
+    if version and source == chart and not Path(chart).is_dir():
+        args += ["--version", version]
+    for key, value in values.items():
+        args += ["--set", shlex.quote(f"{key}={value}")]
+    for key, value in string_values.items():
+        args += ["--set-string", shlex.quote(f"{key}={value}")]
+    return args
+
+
+def upgrade_install(c, release, chart, namespace, values=None, string_values=None, extra_args="",
+                    version=None, timeout=None, force=False):
+    """
+    `helm upgrade --install` that is skipped when the release is already at the desired state.
+
+    The desired state is the effective chart version plus the `--set` / `--set-string` values and
+    extra args. Its hash is stored as a label on the release's Helm secret after a successful
+    upgrade, so it travels with the cluster (and works from fresh CI runners), and a rerun with the
+    same hash costs a single API call instead of a Helm upgrade. `force` upgrades regardless.
+    With OFFLINE_BUNDLE set, repo charts are installed from the bundle's archive and version
+    instead (their images come from the registry bundle_load mirrors them to). In plan_mode() it
+    raises PlannedRelease before touching the cluster. Returns True if Helm was run.
+    """
+    values = values or {}
+    string_values = string_values or {}
+    source = chart
+    bundle = os.getenv(OFFLINE_BUNDLE_ENV)
+    if "/" in chart and not Path(chart).is_dir():
+        if bundle:
+            source, effective_version = bundled_chart(chart, bundle)
+            if version and version != effective_version:
+                raise ValueError(f"{chart} {version} requested, but the offline bundle has {effective_version}")
+        else:
+            ensure_repos(c, chart.split("/", 1)[0])
+            effective_version = version or resolve_chart_version(chart)
+    else:
+        effective_version = version or resolve_chart_version(chart)
+
+    state = desired_state_hash(release, chart, effective_version, namespace, values, string_values, extra_args)
+    if planning():
+        raise PlannedRelease({
+            "release": release, "chart": chart, "source": str(source), "version": effective_version,
+            "namespace": namespace, "values": values, "string_values": string_values,
+            "extra_args": extra_args, "state": state,
+        })
+    if not force and deployed_state(release, namespace) == state:
+        print(f"{release} is up to date ({chart} {effective_version}), skipping helm upgrade (use --force to upgrade anyway)")
+        return False
+
+    kubeconfig = os.environ.get('KUBECONFIG')
+    command = [f"KUBECONFIG={shlex.quote(kubeconfig)}"] if kubeconfig else []
+    command += ["helm", "upgrade", "--install", release, *chart_args(chart, source, effective_version, values, string_values),
+                "--namespace", namespace, "--create-namespace"]
+    if timeout:
+        command += ["--timeout", timeout]
+    if extra_args:
+        command.append(extra_args)
+
+    c.run(" ".join(command))
+    record_state(release, namespace, state)
+    return True
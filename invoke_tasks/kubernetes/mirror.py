@@ -0,0 +1,248 @@
+"""
+Pull-through registry mirror for the cluster nodes.
+
+The registry from deploy_docker_registry (one upstream, usually Docker Hub) or Harbor proxy-cache
+projects (one per upstream) cache every image the first time a node pulls it, so the other nodes
+pull it from inside the cluster instead of from the upstream registry. containerd on the nodes
+finds the mirror through /etc/containerd/certs.d/<upstream>/hosts.toml, which is what both
+k8s/cluster/etc.containerd.config.toml (config_path) and kubespray (containerd_registries_mirrors)
+use.
+"""
+import base64
+import hashlib
+import io
+import json
+import os
+import re
+import statistics
+import threading
+import time
+import urllib.request
+
+import yaml
+from invoke import task, Exit
+
+from invoke_tasks.inventory import on_hosts, hosts_in
+
+CERTS_DIR = "/etc/containerd/certs.d"
+CONTAINERD_CONFIG = "k8s/cluster/etc.containerd.config.toml"
+KUBESPRAY_CONTAINERD = "kubespray_config/group_vars/all/containerd.yml"
+KUBESPRAY_BEGIN = "# BEGIN registry mirrors, written by k8s.configure-registry-mirror"
+KUBESPRAY_END = "# END registry mirrors"
+
+# Registry API endpoints of the upstreams, as containerd calls them ("server" in hosts.toml)
+UPSTREAM_SERVERS = {"docker.io": "https://registry-1.docker.io"}
+
+# Harbor endpoint type and URL of the upstreams; anything else is a plain "docker-registry"
+HARBOR_ENDPOINTS = {
+    "docker.io": ("docker-hub", "https://hub.docker.com"),
+    "ghcr.io": ("github-ghcr", "https://ghcr.io"),
+    "quay.io": ("quay", "https://quay.io"),
+}
+
+
+def _harbor(endpoint, method, path, body=None):
+    auth = base64.b64encode(f"admin:{os.getenv('ADMIN_PASSWORD', '')}".encode()).decode()
+    request = urllib.request.Request(
+        f"{endpoint}/api/v2.0{path}",
+        data=None if body is None else json.dumps(body).encode(),
+        method=method,
+        headers={"Authorization": f"Basic {auth}", "Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        data = response.read()
+    return json.loads(data) if data else None
+
+
+def harbor_proxy_project(endpoint, upstream):
+    """Create (if missing) the Harbor proxy-cache project for `upstream` and return its name."""
+    project = "proxy-" + upstream.replace(".", "-")
+    kind, url = HARBOR_ENDPOINTS.get(upstream, ("docker-registry", f"https://{upstream}"))
+
+    registries = [r for r in _harbor(endpoint, "GET", f"/registries?q=name%3D{project}") or [] if r["name"] == project]
+    if not registries:
+        _harbor(endpoint, "POST", "/registries", {"name": project, "type": kind, "url": url, "insecure": False})
+        registries = [r for r in _harbor(endpoint, "GET", f"/registries?q=name%3D{project}") if r["name"] == project]
+
+    projects = _harbor(endpoint, "GET", f"/projects?name={project}") or []
+    if not any(p["name"] == project for p in projects):
+        _harbor(endpoint, "POST", "/projects", {
+            "project_name": project,
+            "registry_id": registries[0]["id"],
+            "metadata": {"public": "true"},
+        })
+        print(f"Created Harbor proxy-cache project {project} for {upstream}")
+    return project
+
+
+def mirror_entries(backend, endpoint, upstreams, skip_verify=False):
+    """One {prefix, server, host, override_path, skip_verify} per upstream registry."""
+    entries = []
+    for upstream in upstreams:
+        if backend == "harbor":
+            # Harbor serves the cache of each upstream under its own project path
+            host, override_path = f"{endpoint}/v2/{harbor_proxy_project(endpoint, upstream)}", True
+        else:
+            host, override_path = endpoint, False
+        entries.append({
+            "prefix": upstream,
+            "server": UPSTREAM_SERVERS.get(upstream, f"https://{upstream}"),
+            "host": host,
+            "override_path": override_path,
+            "skip_verify": skip_verify,
+        })
+    return entries
+
+
+def hosts_toml(entry):
+    """containerd hosts.toml for one upstream: try the mirror first, then the upstream itself."""
+    lines = [
+        f'server = "{entry["server"]}"',
+        "",
+        f'[host."{entry["host"]}"]',
+        '  capabilities = ["pull", "resolve"]',
+    ]
+    if entry["override_path"]:
+        lines.append("  override_path = true")
+    if entry["skip_verify"]:
+        lines.append("  skip_verify = true")
+    return "\n".join(lines) + "\n"
+
+
+def render_containerd_config(path=CONTAINERD_CONFIG):
+    """Point the CRI registry config_path in `path` at CERTS_DIR; returns the new file content."""
+    with open(path) as f:
+        content = f.read()
+    content = re.sub(
+        r'(\[plugins\."io\.containerd\.grpc\.v1\.cri"\.registry\]\n\s*config_path = )"[^"]*"',
+        rf'\g<1>"{CERTS_DIR}"', content,
+    )
+    with open(path, "w") as f:
+        f.write(content)
+    return content
+
+
+def render_kubespray_mirrors(entries, path=KUBESPRAY_CONTAINERD):
+    """Write the mirrors as `containerd_registries_mirrors` into kubespray's containerd.yml."""
+    mirrors = [{
+        "prefix": entry["prefix"],
+        "mirrors": [
+            {"host": entry["host"], "capabilities": ["pull", "resolve"], "skip_verify": entry["skip_verify"],
+             **({"override_path": True} if entry["override_path"] else {})},
+            # Fall back to the upstream when the mirror is down
+            {"host": entry["server"], "capabilities": ["pull", "resolve"], "skip_verify": False},
+        ],
+    } for entry in entries]
+    block = f"{KUBESPRAY_BEGIN}\n{yaml.safe_dump({'containerd_registries_mirrors': mirrors}, sort_keys=False)}{KUBESPRAY_END}\n"
+
+    with open(path) as f:
+        content = f.read()
+    if KUBESPRAY_BEGIN in content:
+        start = content.index(KUBESPRAY_BEGIN)
+        end = content.index(KUBESPRAY_END, start) + len(KUBESPRAY_END) + 1
+        content = content[:start] + block + content[end:]
+    else:
+        content = content.rstrip("\n") + "\n\n" + block
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def install_file(host, content, path):
+    """Install `content` as root at `path` on `host` unless it is already there; returns True if changed."""
+    digest = hashlib.sha256(content.encode()).hexdigest()
+    current = host.sudo(f"sha256sum {path}", warn=True, hide=True)
+    if current.ok and current.stdout.split()[0] == digest:
+        return False
+    temporary = f"/tmp/invoke-{digest[:12]}"
+    host.put(io.BytesIO(content.encode()), remote=temporary)
+    host.sudo(f"install -D -m 644 {temporary} {path}")
+    host.run(f"rm -f {temporary}")
+    return True
+
+
+@task(help={
+    "backend": "'docker-registry' (one upstream, Docker Hub by default) or 'harbor' (a proxy-cache project per upstream)",
+    "endpoint": "Mirror URL, default https://registry.$DOMAIN or https://harbor.$DOMAIN",
+    "upstreams": "Comma separated registries to mirror; docker-registry can only proxy one",
+    "group": "Inventory group or hosts to configure",
+    "workers": "Number of hosts configured at the same time",
+    "skip_verify": "Don't verify the mirror's TLS certificate (e.g. Traefik's default certificate)",
+    "render_only": "Only render the containerd and kubespray config files, don't touch the nodes",
+    "force": "Run the Helm upgrade of the registry even if the release is already up to date",
+})
+def configure_registry_mirror(c, backend="docker-registry", endpoint=None, upstreams="docker.io",
+                              group="k8s_cluster", workers=None, skip_verify=False, render_only=False, force=False):
+    """Run the cluster registry as a pull-through cache and make every node's containerd pull through it"""
+    from .devops import deploy_docker_registry
+
+    domain = os.getenv("DOMAIN", "yourdomain.com")
+    upstreams = [upstream.strip() for upstream in upstreams.split(",") if upstream.strip()]
+    if backend == "docker-registry":
+        if len(upstreams) != 1:
+            raise Exit("The docker-registry backend can only mirror one upstream, use --backend harbor for more", code=1)
+        endpoint = endpoint or f"https://registry.{domain}"
+        deploy_docker_registry(c, force=force, proxy=UPSTREAM_SERVERS.get(upstreams[0], f"https://{upstreams[0]}"))
+    elif backend == "harbor":
+        endpoint = endpoint or f"https://harbor.{domain}"
+    else:
+        raise Exit(f"Unknown backend '{backend}', use docker-registry or harbor", code=1)
+
+    entries = mirror_entries(backend, endpoint.rstrip("/"), upstreams, skip_verify)
+    config = render_containerd_config()
+    render_kubespray_mirrors(entries)
+    print(f"Rendered {CONTAINERD_CONFIG} and {KUBESPRAY_CONTAINERD}")
+    if render_only:
+        return
+
+    install_mirrors(c, group, entries, config, workers, title="configure_registry_mirror")
+
+
+def install_mirrors(c, group, entries, config, workers=None, title="install_mirrors"):
+    """Write a hosts.toml per mirror entry on the hosts of `group`, and make containerd read them."""
+    def configure_host(host):
+        for entry in entries:
+            if install_file(host, hosts_toml(entry), f"{CERTS_DIR}/{entry['prefix']}/hosts.toml"):
+                print(f"{entry['prefix']} -> {entry['host']}")
+        # hosts.toml files are read on every pull; only a containerd that doesn't look in CERTS_DIR
+        # yet (kubespray nodes already do) needs the new config.toml and a restart
+        if not host.sudo(f"grep -q 'config_path = \"{CERTS_DIR}\"' /etc/containerd/config.toml", warn=True, hide=True).ok:
+            install_file(host, config, "/etc/containerd/config.toml")
+            host.sudo("systemctl restart containerd")
+            print("containerd restarted with the mirror config")
+
+    on_hosts(c, group, configure_host, workers, title=title)
+
+
+@task(help={
+    "image": "Image to pull, fully qualified",
+    "group": "Inventory group or hosts to pull on; the first host does the cold pull",
+    "workers": "Number of hosts pulling at the same time in the warm round",
+})
+def mirror_pull_check(c, image="docker.io/library/alpine:3.20", group="k8s_cluster", workers=None):
+    """Compare a cold pull through the mirror with warm pulls of the same image on the other nodes"""
+    hosts = list(hosts_in(group))
+    if not hosts:
+        raise Exit(f"No hosts in '{group}'", code=1)
+    timings = {}
+    lock = threading.Lock()
+
+    def pull(host):
+        host.sudo(f"crictl rmi {image}", warn=True, hide=True)
+        start = time.monotonic()
+        host.sudo(f"crictl pull {image}", hide=True)
+        with lock:
+            timings.setdefault(host.inventory_name, []).append(time.monotonic() - start)
+
+    # The first node pulls while the mirror doesn't have the image yet (unless an earlier run cached it)
+    on_hosts(c, hosts[0], pull, title="cold pull")
+    # A single node pulls twice; otherwise all the other nodes pull from the now warm cache
+    on_hosts(c, ",".join(hosts[1:]) or hosts[0], pull, workers, title="warm pull")
+
+    cold = timings[hosts[0]][0]
+    warm = [seconds for host in hosts for seconds in timings[host][1 if host == hosts[0] else 0:]]
+    print(f"\n{'host':<20} {'pull':<5} {'seconds':>8}")
+    for host in hosts:
+        for i, seconds in enumerate(timings[host]):
+            print(f"{host:<20} {'cold' if host == hosts[0] and i == 0 else 'warm':<5} {seconds:8.2f}")
+    median = statistics.median(warm)
+    print(f"{image}: cold {cold:.2f}s, warm median {median:.2f}s ({cold / median:.1f}x)")
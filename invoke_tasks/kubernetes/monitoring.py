@@ -1,123 +1,111 @@
+import base64
 import os
-import subprocess
 
 from invoke import task
 
-import time
+from . import api, cache
+from .helm import upgrade_install
 
 
 namespace = "monitoring"
+DASHBOARD_TOKEN_SECONDS = 24 * 3600
 
-@task
-def deploy_prometheus(c):
-    kubeconfig = os.environ.get('KUBECONFIG')
-
+@task(help={"force": "Run the Helm upgrade even if the release is already up to date"})
+def deploy_prometheus(c, force=False):
     print("Deploying Prometheus...")
-    c.run("helm repo add prometheus-community https://prometheus-community.github.io/helm-charts")
-    c.run("helm repo update prometheus-community")
-
-    c.run(f"KUBECONFIG={kubeconfig} helm upgrade --install prometheus prometheus-community/prometheus --namespace {namespace} --create-namespace \
-           --set server.persistentVolume.storageClass=longhorn \
-           --set alertmanager.persistentVolume.storageClass=longhorn \
-           --set pushgateway.persistentVolume.storageClass=longhorn")
+    upgrade_install(c, "prometheus", "prometheus-community/prometheus", namespace, values={
+        "server.persistentVolume.storageClass": "longhorn",
+        "alertmanager.persistentVolume.storageClass": "longhorn",
+        "pushgateway.persistentVolume.storageClass": "longhorn",
+    }, force=force)
 
     print("Prometheus deployed.")
 
-@task
-def deploy_grafana(c):
-    kubeconfig = os.environ.get('KUBECONFIG')
+@task(help={"force": "Run the Helm upgrade even if the release is already up to date"})
+def deploy_grafana(c, force=False):
     admin_password = os.getenv("ADMIN_PASSWORD")
 
     print("Deploying Grafana...")
-    c.run("helm repo add grafana https://grafana.github.io/helm-charts")
-    c.run("helm repo update grafana")
-
-    c.run(f"KUBECONFIG={kubeconfig} helm upgrade --install grafana grafana/grafana --namespace {namespace} --create-namespace \
-           --set persistence.enabled=true \
-           --set persistence.storageClassName=longhorn \
-           --set persistence.size=10Gi \
-           --set adminPassword='{admin_password}' \
-           --set service.type=LoadBalancer \
-           --set service.port=80")
+    upgrade_install(c, "grafana", "grafana/grafana", namespace, values={
+        "persistence.enabled": "true",
+        "persistence.storageClassName": "longhorn",
+        "persistence.size": "10Gi",
+        "adminPassword": admin_password,
+        "service.type": "LoadBalancer",
+        "service.port": "80",
+    }, force=force)
 
     print("Grafana deployed.")
 
 
-@task
-def deploy_dashboard(c):
-    kubeconfig = os.environ.get('KUBECONFIG')
+@task(help={"force": "Run the Helm upgrade even if the release is already up to date"})
+def deploy_dashboard(c, force=False):
     admin_password = os.getenv("ADMIN_PASSWORD")
     namespace = "monitoring"
 
     print("Deploying Kubernetes Dashboard...")
-    c.run("helm repo add kubernetes-dashboard https://kubernetes.github.io/dashboard/")
-    c.run("helm repo update kubernetes-dashboard")
-
-    c.run(f"KUBECONFIG={kubeconfig} helm upgrade --install kubernetes-dashboard kubernetes-dashboard/kubernetes-dashboard --namespace {namespace} --create-namespace \
-           --set extraArgs[0]='--authentication-mode=basic' \
-           --set extraArgs[1]='--token-ttl=0' \
-           --set extraEnv[0].name='KUBERNETES_DASHBOARD_USERNAME' \
-           --set extraEnv[0].value='admin' \
-           --set extraEnv[1].name='KUBERNETES_DASHBOARD_PASSWORD' \
-           --set extraEnv[1].value='{admin_password}' \
-           --set service.type=LoadBalancer")
+    upgrade_install(c, "kubernetes-dashboard", "kubernetes-dashboard/kubernetes-dashboard", namespace, values={
+        "extraArgs[0]": "--authentication-mode=basic",
+        "extraArgs[1]": "--token-ttl=0",
+        "extraEnv[0].name": "KUBERNETES_DASHBOARD_USERNAME",
+        "extraEnv[0].value": "admin",
+        "extraEnv[1].name": "KUBERNETES_DASHBOARD_PASSWORD",
+        "extraEnv[1].value": admin_password,
+        "service.type": "LoadBalancer",
+    }, force=force)
 
     print("Kubernetes Dashboard deployed.")
 
     print("Checking if Service Account exists...")
-    sa_exists = c.run(f"KUBECONFIG={kubeconfig} kubectl get serviceaccount dashboard-admin-sa -n {namespace} --ignore-not-found", warn=True, hide=True).stdout.strip()
+    sa_exists = cache.service_accounts(namespace).get("dashboard-admin-sa")
 
     if not sa_exists:
         print("Service Account does not exist. Creating Service Account...")
-        c.run(f"KUBECONFIG={kubeconfig} kubectl create serviceaccount dashboard-admin-sa -n {namespace}")
-        c.run(f"KUBECONFIG={kubeconfig} kubectl create clusterrolebinding dashboard-admin-sa-binding --clusterrole=cluster-admin --serviceaccount={namespace}:dashboard-admin-sa")
+        api.core().create_namespaced_service_account(namespace, {"metadata": {"name": "dashboard-admin-sa"}})
+        api.rbac().create_cluster_role_binding({
+            "metadata": {"name": "dashboard-admin-sa-binding"},
+            "roleRef": {"apiGroup": "rbac.authorization.k8s.io", "kind": "ClusterRole", "name": "cluster-admin"},
+            "subjects": [{"kind": "ServiceAccount", "name": "dashboard-admin-sa", "namespace": namespace}],
+        })
     else:
         print("Service Account already exists. Skipping creation.")
 
-    print("Fetching Service Account Token...")
-    time.sleep(5)  # Wait a few seconds to ensure the secret is created
-
-    secret_name = c.run(f"KUBECONFIG={kubeconfig} kubectl get secrets -n {namespace} | grep dashboard-admin-sa | awk '{{print $1}}'", hide=True).stdout.strip()
-
-    if secret_name:
-        token = c.run(f"KUBECONFIG={kubeconfig} kubectl get secret {secret_name} -n {namespace} -o jsonpath={{.data.token}} | base64 --decode", hide=True).stdout.strip()
-        print(f"Service Account Token: {token}")
-    else:
-        print("Error: Service account token secret not found.")
+    print("Requesting Service Account Token...")
+    # Kubernetes 1.24+ no longer creates token secrets for service accounts; ask the TokenRequest API
+    token_request = api.core().create_namespaced_service_account_token(
+        "dashboard-admin-sa", namespace, {"spec": {"expirationSeconds": DASHBOARD_TOKEN_SECONDS}})
+    print(f"Service Account Token (valid until {token_request.status.expiration_timestamp}): {token_request.status.token}")
 
     print(f"Admin user: admin")
     print(f"Admin password: {admin_password}")
 
 
-@task
-def deploy_monitoring_stack(c):
-    deploy_prometheus(c)
-    deploy_grafana(c)
-    deploy_dashboard(c)
+@task(help={"force": "Run the Helm upgrade even if the release is already up to date"})
+def deploy_monitoring_stack(c, force=False):
+    deploy_prometheus(c, force=force)
+    deploy_grafana(c, force=force)
+    deploy_dashboard(c, force=force)
 
 
 @task
 def remove_dashboard(c):
-    kubeconfig = os.environ.get('KUBECONFIG')
     namespace = "monitoring"
 
     print("Removing old Kubernetes Dashboard deployment if it exists...")
-    c.run(f"KUBECONFIG={kubeconfig} kubectl delete deployment kubernetes-dashboard -n {namespace} --ignore-not-found", warn=True)
-    c.run(f"KUBECONFIG={kubeconfig} kubectl delete service kubernetes-dashboard -n {namespace} --ignore-not-found", warn=True)
-    c.run(f"KUBECONFIG={kubeconfig} kubectl delete serviceaccount dashboard-admin-sa -n {namespace} --ignore-not-found", warn=True)
-    c.run(f"KUBECONFIG={kubeconfig} kubectl delete clusterrolebinding dashboard-admin-sa-binding --ignore-not-found", warn=True)
+    api.ignore_not_found(api.apps().delete_namespaced_deployment, "kubernetes-dashboard", namespace)
+    api.ignore_not_found(api.core().delete_namespaced_service, "kubernetes-dashboard", namespace)
+    api.ignore_not_found(api.core().delete_namespaced_service_account, "dashboard-admin-sa", namespace)
+    api.ignore_not_found(api.rbac().delete_cluster_role_binding, "dashboard-admin-sa-binding")
 
 
 
 
 @task
 def get_prometheus_grafana_password(c):
-    kubeconfig = os.environ.get('KUBECONFIG')
-        # Get the Grafana admin password
-    password_command = f"KUBECONFIG={kubeconfig} kubectl get secret --namespace {namespace} grafana -o jsonpath=\"{{.data.admin-password}}\" | base64 --decode"
-    result = subprocess.run(password_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    grafana_password = result.stdout.decode().strip()
-    if grafana_password:
+    # Get the Grafana admin password
+    secret = api.ignore_not_found(api.core().read_namespaced_secret, "grafana", namespace)
+    if secret and secret.data and "admin-password" in secret.data:
+        grafana_password = base64.b64decode(secret.data["admin-password"]).decode()
         print(f"Grafana Admin Password: {grafana_password}")
     else:
         print("Could not retrieve Grafana Admin Password")
@@ -132,20 +120,17 @@ def get_prometheus_grafana_password(c):
 
 
 
-@task
-def deploy_teleport(c):
-    kubeconfig = os.environ.get('KUBECONFIG')
+@task(help={"force": "Run the Helm upgrade even if the release is already up to date"})
+def deploy_teleport(c, force=False):
     namespace = "teleport"
     cluster_name = "kubernetes-teleport"
 
     print("Deploying Teleport Server...")
-    c.run("helm repo add teleport https://charts.releases.teleport.dev")
-    c.run("helm repo update")
-
-    c.run(f"KUBECONFIG={kubeconfig} helm upgrade --install teleport teleport/teleport-cluster --namespace {namespace} --create-namespace \
-           --set clusterName={cluster_name} \
-           --set proxyService.type=LoadBalancer \
-           --set authService.enabled=true \
-           --set proxyService.enabled=true \
-           --set kubeService.enabled=true")
+    upgrade_install(c, "teleport", "teleport/teleport-cluster", namespace, values={
+        "clusterName": cluster_name,
+        "proxyService.type": "LoadBalancer",
+        "authService.enabled": "true",
+        "proxyService.enabled": "true",
+        "kubeService.enabled": "true",
+    }, force=force)
 
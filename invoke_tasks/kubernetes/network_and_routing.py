@@ -2,23 +2,30 @@ import os
 
 from invoke import task
 
+from invoke_tasks.wait import wait_for_pods_ready
+from . import api
+from .helm import upgrade_install, planning
 
-@task
-def deploy_pod_network(c):
-    kubeconfig = os.environ.get('KUBECONFIG')
+
+@task(help={"force": "Run the Helm upgrade even if the release is already up to date"})
+def deploy_pod_network(c, force=False):
     """Install Calico v3.28 on the Kubernetes cluster"""
-    # Add the Calico Helm repository
-    c.run("helm repo add projectcalico https://docs.tigera.io/calico/charts")
-    # Update the Helm repositories
-    c.run("helm repo update")
-    
+
     # Ensure the existing Installation resource has the correct annotations and labels
     installation_name = "default"  # replace with your actual installation name if different
-    c.run(f"KUBECONFIG={kubeconfig} kubectl annotate installations.operator.tigera.io {installation_name} meta.helm.sh/release-name=calico meta.helm.sh/release-namespace=tigera-operator --overwrite")
-    c.run(f"KUBECONFIG={kubeconfig} kubectl label installations.operator.tigera.io {installation_name} app.kubernetes.io/managed-by=Helm --overwrite")
+    if not planning():
+        api.dynamic().patch(
+            api.resource("operator.tigera.io/v1", "Installation"),
+            name=installation_name,
+            body={"metadata": {
+                "annotations": {"meta.helm.sh/release-name": "calico", "meta.helm.sh/release-namespace": "tigera-operator"},
+                "labels": {"app.kubernetes.io/managed-by": "Helm"},
+            }},
+            content_type="application/merge-patch+json",
+        )
     
     # Install the Calico operator
-    c.run(f"KUBECONFIG={kubeconfig} helm upgrade --install --force --debug calico projectcalico/tigera-operator --namespace tigera-operator --create-namespace")
+    upgrade_install(c, "calico", "projectcalico/tigera-operator", "tigera-operator", extra_args="--force --debug", force=force)
     print("Calico installed successfully")
 
 
@@ -36,24 +43,20 @@ def deploy_calico(c):
     c.run(f"KUBECONFIG={kubeconfig} kubectl create --validate=false -f k8s/cluster/calico-custom-resources.yaml")
     print("Calico custom resources created successfully")
 
-    # Monitor the status of Calico pods
-    c.run("watch kubectl get pods -n calico-system")
+    # Wait until the Calico pods are up
+    wait_for_pods_ready("calico-system", timeout=600)
+    print("Calico pods are ready")
 
 
-@task
-def deploy_traefik(c):
+@task(help={"force": "Run the Helm upgrade even if the release is already up to date"})
+def deploy_traefik(c, force=False):
     """Deploy Traefik Ingress Controller to the Kubernetes cluster"""
     domain = os.getenv('DOMAIN')
-    c.run("helm repo add traefik https://helm.traefik.io/traefik")
-    c.run("helm repo update")
-    kubeconfig = os.environ.get('KUBECONFIG')
-    c.run(f"""
-        KUBECONFIG={kubeconfig} helm upgrade --install traefik traefik/traefik \
-        --namespace kube-system --create-namespace \
-        --set ingress.enabled=true \
-        --set ingress.hosts[0]=traefik.{domain} \
-        --set ingress.annotations."traefik\.ingress\.kubernetes\.io/router\.entrypoints"=web \
-        --set ingress.paths[0]=/ \
-        --set ingress.pathType=Prefix
-    """)
+    upgrade_install(c, "traefik", "traefik/traefik", "kube-system", values={
+        "ingress.enabled": "true",
+        "ingress.hosts[0]": f"traefik.{domain}",
+        r"ingress.annotations.traefik\.ingress\.kubernetes\.io/router\.entrypoints": "web",
+        "ingress.paths[0]": "/",
+        "ingress.pathType": "Prefix",
+    }, force=force)
     print("Traefik Ingress Controller installed successfully")
@@ -0,0 +1,185 @@
+"""
+What the deploy tasks would change, release by release, without changing anything.
+
+Every deploy task with a Helm release runs in helm.plan_mode(), where upgrade_install hands back the
+chart, version and --set values it would install instead of installing them. Each release is then
+rendered with `helm template` and diffed object by object against the manifest of its deployed
+revision. Rendering and diffing run concurrently across releases. Renders are cached by the
+desired-state hash (chart version plus values, see helm.desired_state_hash), so a repeated plan only
+reads the live releases.
+
+Charts that generate random values (passwords, certificates) show those objects as changed on
+every plan, the same way `helm diff` does.
+"""
+import ast
+import difflib
+import importlib
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from pathlib import Path
+
+import yaml
+from invoke import task, Exit
+
+from .helm import PlannedRelease, chart_args, deployed_release, plan_mode
+
+RENDER_CACHE = Path.home() / ".cache" / "invoke-tasks" / "renders"
+
+
+def deploy_tasks():
+    """(module, task name) of every task in this package that calls upgrade_install."""
+    tasks = []
+    for path in sorted(Path(__file__).parent.glob("*.py")):
+        for node in ast.parse(path.read_text(encoding="utf-8")).body:
+            if isinstance(node, ast.FunctionDef) and any(
+                    isinstance(call, ast.Call) and getattr(call.func, "id", None) == "upgrade_install"
+                    for call in ast.walk(node)):
+                tasks.append((f"{__package__}.{path.stem}", node.name))
+    return tasks
+
+
+def planned_release(c, module, name):
+    """The release spec the deploy task would install, captured in plan mode (its output is discarded)."""
+    output = io.StringIO()
+    try:
+        with plan_mode(), redirect_stdout(output):
+            getattr(importlib.import_module(module), name)(c)
+    except PlannedRelease as planned:
+        return planned.spec
+    except Exception as e:
+        raise RuntimeError(f"{name} failed in plan mode: {e}\n{output.getvalue()}") from e
+    raise RuntimeError(f"{name} returned without installing a release")
+
+
+def render(c, spec, refresh=False):
+    """(manifest, cached) of `helm template` with the spec's chart, version and values."""
+    cached = RENDER_CACHE / f"{spec['state']}.yaml"
+    if cached.exists() and not refresh:
+        return cached.read_text(encoding="utf-8"), True
+    command = ["helm", "template", spec["release"],
+               *chart_args(spec["chart"], spec["source"], spec["version"], spec["values"], spec["string_values"]),
+               "--namespace", spec["namespace"]]
+    manifest = c.run(" ".join(command), hide=True, in_stream=False).stdout
+    cached.parent.mkdir(parents=True, exist_ok=True)
+    temporary = cached.with_suffix(f".{os.getpid()}.tmp")
+    temporary.write_text(manifest, encoding="utf-8")
+    os.replace(temporary, cached)
+    return manifest, False
+
+
+def manifest_documents(manifest):
+    """The objects of a rendered manifest; hooks are left out like Helm's release manifest does."""
+    for document in yaml.safe_load_all(manifest or ""):
+        if not isinstance(document, dict):
+            continue
+        items = (document.get("items") or []) if document.get("kind", "").endswith("List") else [document]
+        for item in items:
+            if "helm.sh/hook" not in ((item.get("metadata") or {}).get("annotations") or {}):
+                yield item
+
+
+def manifest_objects(manifest):
+    """{"Kind namespace/name": normalized YAML} of the objects of a manifest."""
+    objects = {}
+    for item in manifest_documents(manifest):
+        metadata = item.get("metadata") or {}
+        namespace = metadata.get("namespace")
+        key = f"{item.get('kind')} {namespace + '/' if namespace else ''}{metadata.get('name')}"
+        objects[key] = yaml.safe_dump(item, sort_keys=True)
+    return objects
+
+
+def diff_objects(live, planned):
+    """(added, removed, changed) object keys and the unified diff of every changed object."""
+    added = sorted(planned.keys() - live.keys())
+    removed = sorted(live.keys() - planned.keys())
+    changed = sorted(key for key in planned.keys() & live.keys() if planned[key] != live[key])
+    diffs = {key: "\n".join(difflib.unified_diff(live[key].splitlines(), planned[key].splitlines(),
+                                                 f"live {key}", f"planned {key}", lineterm=""))
+             for key in changed}
+    return added, removed, changed, diffs
+
+
+def plan_release(c, spec, refresh=False):
+    manifest, cached = render(c, spec, refresh)
+    live = deployed_release(spec["release"], spec["namespace"])
+    planned = manifest_objects(manifest)
+    result = {"spec": spec, "cached": cached, "objects": len(planned),
+              "live_version": live["chart"]["metadata"]["version"] if live else None}
+    if live is None:
+        result.update(status="install", added=sorted(planned), removed=[], changed=[], diffs={})
+    else:
+        added, removed, changed, diffs = diff_objects(manifest_objects(live["manifest"]), planned)
+        result.update(status="change" if added or removed or changed else "unchanged",
+                      added=added, removed=removed, changed=changed, diffs=diffs)
+    return result
+
+
+@task(help={
+    "releases": "Comma separated releases to plan (default: the releases of all deploy tasks)",
+    "details": "Print the diff of every changed object",
+    "workers": "Number of releases rendered and diffed at the same time",
+    "refresh": "Render every release again instead of using cached renders",
+})
+def plan(c, releases="", details=False, workers=8, refresh=False):
+    """Diff what every deploy task would install against the live Helm releases, without changing anything"""
+    start = time.monotonic()
+    selected = {release.strip() for release in releases.split(",") if release.strip()}
+    specs, errors = [], {}
+    # Capturing is quick (ensure_repos serializes on the repo lock anyway), so it runs sequentially
+    for module, name in deploy_tasks():
+        try:
+            spec = planned_release(c, module, name)
+        except RuntimeError as e:
+            errors[name] = str(e)
+            continue
+        if not selected or spec["release"] in selected:
+            specs.append(spec)
+    unknown = selected - {spec["release"] for spec in specs}
+    if unknown:
+        raise Exit(f"No deploy task installs: {', '.join(sorted(unknown))}", code=1)
+
+    def plan_one(spec):
+        try:
+            return plan_release(c, spec, refresh)
+        except Exception as e:
+            return {"spec": spec, "status": "error", "error": (str(e).strip().splitlines() or [repr(e)])[-1]}
+
+    with ThreadPoolExecutor(max_workers=int(workers)) as pool:
+        results = list(pool.map(plan_one, specs))
+
+    print(f"{'release':<22} {'namespace':<20} {'chart':<44} {'live':<10} {'planned':<10} changes")
+    for result in sorted(results, key=lambda result: result["spec"]["release"]):
+        spec = result["spec"]
+        if result["status"] == "error":
+            changes = f"error: {result['error']}"
+        elif result["status"] == "install":
+            changes = f"new install, {result['objects']} objects"
+        elif result["status"] == "unchanged":
+            changes = "unchanged"
+        else:
+            changes = f"~{len(result['changed'])} +{len(result['added'])} -{len(result['removed'])}"
+        version = spec["version"] or "-"
+        print(f"{spec['release']:<22} {spec['namespace']:<20} {spec['chart']:<44} "
+              f"{result.get('live_version') or '-':<10} {version.split('+')[0]:<10} {changes}")
+        if result["status"] == "change":
+            for marker, keys in (("~", result["changed"]), ("+", result["added"]), ("-", result["removed"])):
+                for key in keys:
+                    print(f"    {marker} {key}")
+            if details:
+                for diff in result["diffs"].values():
+                    print("\n".join(f"      {line}" for line in diff.splitlines()))
+    for name, error in errors.items():
+        print(f"Warning: {error.strip()}")
+
+    counts = {status: sum(result["status"] == status for result in results)
+              for status in ("unchanged", "change", "install", "error")}
+    rendered = sum(not result.get("cached", True) for result in results)
+    print(f"\n{len(results)} releases: {counts['unchanged']} unchanged, {counts['change']} would change, "
+          f"{counts['install']} new, {counts['error']} failed; {rendered} rendered, "
+          f"{len(results) - rendered - counts['error']} from cache, {time.monotonic() - start:.1f}s")
+    if counts["error"] or (errors and not selected):
+        raise Exit(code=1)
@@ -0,0 +1,120 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from kubernetes.client.rest import ApiException
+from kubernetes.dynamic.resource import ResourceList
+
+from . import api
+
+# Namespaced types that are not worth purging: events expire on their own
+SKIPPED_RESOURCES = {"events"}
+
+# Objects the control plane recreates in every namespace, so waiting for them to disappear never ends
+RECREATED_OBJECTS = {("ServiceAccount", "default"), ("ConfigMap", "kube-root-ca.crt")}
+
+
+def namespaced_resources():
+    """Every namespaced resource type (CRDs included) the API server lets us list and delete."""
+    resources = api.dynamic().resources.search(namespaced=True, preferred=True)
+    return sorted(
+        (r for r in resources
+         if not isinstance(r, ResourceList)
+         and {"list", "delete"} <= set(r.verbs or [])
+         and "/" not in r.name
+         and r.name not in SKIPPED_RESOURCES),
+        key=lambda r: r.group_version + "/" + r.name,
+    )
+
+
+def _is_recreated(resource, item):
+    return (resource.kind, item.metadata.name) in RECREATED_OBJECTS
+
+
+def _strip_finalizers(resource, namespace, name):
+    api.ignore_not_found(
+        api.dynamic().patch, resource, name=name, namespace=namespace,
+        body={"metadata": {"finalizers": None}}, content_type="application/merge-patch+json",
+    )
+
+
+def purge_resource(resource, namespace, deadline, force_finalizers=False, finalizer_grace=30):
+    """
+    Delete all objects of one resource type in `namespace` and watch until they are really gone.
+
+    Objects that are recreated (e.g. pods of a ReplicaSet that is still being deleted) are deleted
+    again. Objects stuck on finalizers for longer than `finalizer_grace` seconds have their finalizers
+    removed when `force_finalizers` is set. Returns (objects found, names still present at the deadline).
+    """
+    listing = api.dynamic().get(resource, namespace=namespace)
+    remaining = {item.metadata.name: item for item in listing.items if not _is_recreated(resource, item)}
+    found = len(remaining)
+    if not remaining:
+        return 0, []
+
+    api.delete_all(resource, namespace=namespace)
+    resource_version = listing.metadata.resourceVersion
+    terminating_since = {}
+
+    while remaining and time.monotonic() < deadline:
+        received = 0
+        try:
+            for event in api.dynamic().watch(resource, namespace=namespace, resource_version=resource_version,
+                                             timeout=max(1, min(finalizer_grace, int(deadline - time.monotonic())))):
+                received += 1
+                item = event["object"]
+                if event["type"] == "ERROR":
+                    raise ApiException(status=item.code, reason=item.message)
+                resource_version = item.metadata.resourceVersion
+                name = item.metadata.name
+                if event["type"] == "DELETED":
+                    remaining.pop(name, None)
+                elif not _is_recreated(resource, item):
+                    remaining[name] = item
+                    if not item.metadata.deletionTimestamp:
+                        api.ignore_not_found(api.dynamic().delete, resource, name=name, namespace=namespace)
+                if not remaining:
+                    break
+        except ApiException as e:
+            if e.status != 410:
+                raise
+            # Our resourceVersion expired, start over from a fresh list
+            listing = api.dynamic().get(resource, namespace=namespace)
+            remaining = {item.metadata.name: item for item in listing.items if not _is_recreated(resource, item)}
+            resource_version = listing.metadata.resourceVersion
+
+        if not received:
+            # The watch closed without news (e.g. a proxy dropping idle streams), don't spin on it
+            time.sleep(1)
+
+        now = time.monotonic()
+        for name, item in remaining.items():
+            if item.metadata.finalizers:
+                terminating_since.setdefault(name, now)
+                if force_finalizers and now - terminating_since[name] >= finalizer_grace:
+                    print(f"Removing finalizers {list(item.metadata.finalizers)} from {resource.kind}/{name}")
+                    _strip_finalizers(resource, namespace, name)
+
+    return found, sorted(remaining)
+
+
+def purge_namespace(namespace, workers=8, timeout=300, force_finalizers=False):
+    """
+    Purge every namespaced resource type in `namespace` concurrently with bounded parallelism.
+
+    Returns a report {"<group/version>/<resource>": (objects found, seconds, names left behind)}
+    for all types that had objects.
+    """
+    deadline = time.monotonic() + timeout
+
+    def purge(resource):
+        start = time.monotonic()
+        try:
+            found, left = purge_resource(resource, namespace, deadline, force_finalizers=force_finalizers)
+        except ApiException as e:
+            found, left = 0, [f"<{e.status} {e.reason}>"]
+        return f"{resource.group_version}/{resource.name}", found, time.monotonic() - start, left
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(purge, namespaced_resources()))
+
+    return {name: (found, seconds, left) for name, found, seconds, left in results if found or left}
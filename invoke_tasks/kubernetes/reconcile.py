@@ -0,0 +1,399 @@
+"""
+Keep the platform releases at the state the deploy tasks define, driven by watches.
+
+The desired state is what each deploy task would install (captured in plan mode, see plan.py).
+A release has drifted when:
+- it is not installed;
+- its deployed revision carries another desired-state hash (someone upgraded it with other values);
+- or one of the objects of its manifest was deleted, or no longer contains what the manifest sets.
+
+A release that is not installed is only installed when --releases names it or with
+--install-missing, so that a plain run doesn't install every chart in the repo; otherwise it is
+reported as missing. Only the drifted release is upgraded again, by its own deploy task (with
+--force for object drift, so Helm's three-way merge puts the objects back). --daemon lists every
+watched object type once and then only holds watches open: an idle cluster costs a few
+long-polling requests, not periodic re-applies. Changes go through a work queue. It coalesces
+bursts (--settle), limits the upgrades per minute (--rate), and backs off a release that keeps
+drifting right after being reconciled, e.g. because another controller fights over a field.
+"""
+import importlib
+import threading
+import time
+
+from invoke import task, Exit
+
+from . import api
+from .helm import deployed_release, deployed_state
+from .plan import deploy_tasks, manifest_documents, planned_release
+
+RELEASE_ANNOTATION = "meta.helm.sh/release-name"
+RELEASE_NAMESPACE_ANNOTATION = "meta.helm.sh/release-namespace"
+
+# Seconds a release must stay in sync after a reconcile before its backoff resets, and the longest backoff
+MIN_BACKOFF = 30
+MAX_BACKOFF = 1800
+
+
+# Keys whose values (all the way down) are resource quantities, which the API server stores in canonical form
+QUANTITY_KEYS = {"resources", "requests", "limits", "capacity", "storage", "cpu", "memory", "ephemeral-storage", "sizeLimit"}
+
+
+def same_quantity(desired, live):
+    from kubernetes.utils import parse_quantity
+
+    try:
+        return parse_quantity(desired) == parse_quantity(live)
+    except (ValueError, TypeError):
+        return False
+
+
+def differs(desired, live, quantities=False):
+    """
+    True if `live` doesn't contain everything `desired` sets; fields the API server adds are ignored.
+
+    Values under QUANTITY_KEYS compare as quantities, so "0.5" matches the "500m" the API server stores.
+    """
+    if isinstance(desired, dict):
+        return not isinstance(live, dict) or any(differs(value, live.get(key), quantities or key in QUANTITY_KEYS)
+                                                 for key, value in desired.items())
+    if isinstance(desired, list):
+        return (not isinstance(live, list) or len(desired) != len(live)
+                or any(differs(d, l, quantities) for d, l in zip(desired, live)))
+    if desired is None:
+        return False
+    if quantities and same_quantity(desired, live):
+        return False
+    return desired != live and str(desired) != str(live)
+
+
+def comparable(manifest):
+    """The parts of a manifest object the live object must contain."""
+    # stringData is write-only (it ends up in data) and status belongs to the controllers
+    return {key: value for key, value in manifest.items() if key not in ("status", "stringData")}
+
+
+class WorkQueue:
+    """Releases waiting to be reconciled; a release queued again before it is processed is reconciled once."""
+
+    def __init__(self):
+        self.pending = {}
+        self.changed = threading.Condition()
+
+    def add(self, release, reason, force, delay=0):
+        """Queue `release`; returns False if it was already queued."""
+        with self.changed:
+            due = time.monotonic() + delay
+            if release in self.pending:
+                queued_due, queued_reason, queued_force = self.pending[release]
+                self.pending[release] = (min(due, queued_due), queued_reason, queued_force or force)
+                self.changed.notify_all()
+                return False
+            self.pending[release] = (due, reason, force)
+            self.changed.notify_all()
+            return True
+
+    def get(self, block=True):
+        """(release, reason, force) of the next due release; None when empty and not blocking."""
+        with self.changed:
+            while True:
+                if not self.pending and not block:
+                    return None
+                now = time.monotonic()
+                due = [(item[0], release) for release, item in self.pending.items()]
+                if due and min(due)[0] <= now:
+                    release = min(due)[1]
+                    _, reason, force = self.pending.pop(release)
+                    return release, reason, force
+                self.changed.wait(min(due)[0] - now if due else None)
+
+
+class RateLimiter:
+    """Token bucket of `per_minute` reconciles."""
+
+    def __init__(self, per_minute):
+        self.interval = 60 / per_minute
+        self.capacity = max(1.0, float(per_minute))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def wait(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) / self.interval)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            time.sleep((1 - self.tokens) * self.interval)
+
+
+class Reconciler:
+    def __init__(self, c, desired, settle=10, rate=2, dry_run=False, installable=()):
+        self.c = c
+        self.desired = desired
+        self.installable = set(installable)
+        self.missing = set()
+        self.settle = settle
+        self.dry_run = dry_run
+        self.queue = WorkQueue()
+        self.limiter = RateLimiter(rate)
+        self.lock = threading.Lock()
+        self.manifests = {}
+        self.generations = {}
+        self.busy = set()
+        self.last_run = {}
+        self.backoff = {release: MIN_BACKOFF for release in desired}
+        self.watched = set()
+        self.reconciled = 0
+
+    def enqueue(self, release, reason, force=False):
+        delay = self.settle
+        last = self.last_run.get(release)
+        if last is not None:
+            delay = max(delay, last + self.backoff[release] - time.monotonic())
+        if self.queue.add(release, reason, force, max(delay, 0)):
+            print(f"{release}: {reason}, reconciling in {max(delay, 0):.0f}s")
+
+    def load(self, release):
+        """Read the deployed manifest of `release` and queue it if it isn't at the desired state."""
+        spec = self.desired[release]["spec"]
+        deployed = deployed_release(release, spec["namespace"])
+        with self.lock:
+            if deployed is None:
+                self.manifests[release] = {}
+            else:
+                self.manifests[release] = {self.key(obj, spec["namespace"]): obj
+                                           for obj in manifest_documents(deployed["manifest"])}
+        if deployed is None:
+            if release in self.installable:
+                self.enqueue(release, "not installed")
+            elif release not in self.missing:
+                print(f"{release}: not installed, skipped (name it in --releases or use --install-missing)")
+                self.missing.add(release)
+            return
+        self.missing.discard(release)
+        if deployed_state(release, spec["namespace"]) != spec["state"]:
+            self.enqueue(release, "deployed with other values or another chart version")
+
+    @staticmethod
+    def key(obj, release_namespace):
+        metadata = obj.get("metadata") or {}
+        namespace = metadata.get("namespace")
+        if namespace is None:
+            resource = _resource(obj["apiVersion"], obj["kind"])
+            namespace = release_namespace if resource is not None and resource.namespaced else None
+        return obj["apiVersion"], obj["kind"], namespace, metadata.get("name")
+
+    def watch_targets(self):
+        """(apiVersion, kind, namespace) of every object type the releases' manifests contain."""
+        with self.lock:
+            return {key[:3] for manifest in self.manifests.values() for key in manifest}
+
+    def observe(self, event_type, obj):
+        """Check one listed or watched object against the manifest of the release it belongs to."""
+        metadata = obj.get("metadata") or {}
+        annotations = metadata.get("annotations") or {}
+        release = annotations.get(RELEASE_ANNOTATION)
+        if release not in self.desired or release in self.busy:
+            return
+        if annotations.get(RELEASE_NAMESPACE_ANNOTATION, self.desired[release]["spec"]["namespace"]) \
+                != self.desired[release]["spec"]["namespace"]:
+            return
+        key = (obj["apiVersion"], obj["kind"], metadata.get("namespace"), metadata.get("name"))
+        with self.lock:
+            manifest = self.manifests.get(release, {}).get(key)
+            if manifest is None:
+                return
+            if event_type == "DELETED":
+                self.generations.pop(key, None)
+            else:
+                # A status update leaves the generation alone, and there's nothing to compare then
+                generation = metadata.get("generation")
+                if generation is not None and self.generations.get(key) == generation:
+                    return
+                self.generations[key] = generation
+        if event_type == "DELETED":
+            self.enqueue(release, f"{key[1]} {key[3]} was deleted", force=True)
+        elif differs(comparable(manifest), obj):
+            self.enqueue(release, f"{key[1]} {key[3]} was changed", force=True)
+
+    def check_missing(self, target, present):
+        """Queue the releases whose objects of `target` are not among the listed `present` keys."""
+        with self.lock:
+            missing = [(release, key) for release, manifest in self.manifests.items()
+                       for key in manifest if key[:3] == target and key not in present]
+        for release, key in missing:
+            if release not in self.busy:
+                self.enqueue(release, f"{key[1]} {key[3]} is missing", force=True)
+
+    def list_and_check(self, target):
+        """List one object type, check every object of the releases, and return the list's resourceVersion."""
+        resource = _resource(*target[:2])
+        listing = api.dynamic().get(resource, namespace=target[2]).to_dict()
+        present = set()
+        for obj in listing.get("items") or []:
+            obj.setdefault("apiVersion", target[0])
+            obj.setdefault("kind", target[1])
+            present.add((obj["apiVersion"], obj["kind"], obj["metadata"].get("namespace"), obj["metadata"]["name"]))
+            self.observe("ADDED", obj)
+        self.check_missing(target, present)
+        return listing["metadata"].get("resourceVersion")
+
+    def watch(self, target):
+        """List `target` once, then follow it with a watch (re-listing when the watch expires)."""
+        backoff = 1
+        resource_version = None
+        while True:
+            try:
+                if resource_version is None:
+                    resource_version = self.list_and_check(target)
+                for event in api.dynamic().watch(_resource(*target[:2]), namespace=target[2],
+                                                 resource_version=resource_version, timeout=300):
+                    obj = event["raw_object"]
+                    if event["type"] == "ERROR":
+                        resource_version = None
+                        break
+                    resource_version = obj["metadata"].get("resourceVersion", resource_version)
+                    obj.setdefault("apiVersion", target[0])
+                    obj.setdefault("kind", target[1])
+                    self.observe(event["type"], obj)
+                backoff = 1
+            except Exception as e:
+                print(f"Warning: watch of {target[1]} in {target[2] or 'the cluster'} failed ({e}), listing again")
+                resource_version = None
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+
+    def watch_releases(self):
+        """Follow the Helm release secrets, so upgrades from elsewhere are noticed."""
+        resource = _resource("v1", "Secret")
+        resource_version = None
+        while True:
+            try:
+                if resource_version is None:
+                    listing = api.dynamic().get(resource, label_selector="owner=helm,status=deployed")
+                    resource_version = listing.metadata.resourceVersion
+                for event in api.dynamic().watch(resource, label_selector="owner=helm", resource_version=resource_version,
+                                                 timeout=300):
+                    obj = event["raw_object"]
+                    if event["type"] == "ERROR":
+                        resource_version = None
+                        break
+                    resource_version = obj["metadata"].get("resourceVersion", resource_version)
+                    labels = obj["metadata"].get("labels") or {}
+                    release = labels.get("name")
+                    if (release in self.desired and release not in self.busy and labels.get("status") == "deployed"
+                            and obj["metadata"].get("namespace") == self.desired[release]["spec"]["namespace"]):
+                        self.load(release)
+                        self.start_watches()
+            except Exception as e:
+                print(f"Warning: watch of the Helm releases failed ({e}), listing again")
+                resource_version = None
+                time.sleep(5)
+
+    def start_watches(self):
+        for target in self.watch_targets() - self.watched:
+            if _resource(*target[:2]) is None:
+                continue
+            self.watched.add(target)
+            threading.Thread(target=self.watch, args=(target,), daemon=True).start()
+
+    def process(self, release, reason, force):
+        if self.dry_run:
+            print(f"{release}: would reconcile ({reason})")
+            return
+        now = time.monotonic()
+        last = self.last_run.get(release)
+        # Drifting again soon after the last reconcile: something keeps changing it, slow down
+        if last is not None and now - last < self.backoff[release] * 2:
+            self.backoff[release] = min(self.backoff[release] * 2, MAX_BACKOFF)
+        else:
+            self.backoff[release] = MIN_BACKOFF
+        self.limiter.wait()
+        module, name = self.desired[release]["task"]
+        print(f"{release}: reconciling with {name}{' --force' if force else ''} ({reason})")
+        self.busy.add(release)
+        try:
+            getattr(importlib.import_module(module), name)(self.c, force=force)
+            self.reconciled += 1
+        except Exception as e:
+            print(f"{release}: reconcile failed: {e}")
+            self.last_run[release] = time.monotonic()
+            self.queue.add(release, reason, force, self.backoff[release])
+            return
+        finally:
+            self.busy.discard(release)
+        self.last_run[release] = time.monotonic()
+        with self.lock:
+            self.generations = {key: generation for key, generation in self.generations.items()
+                                if key not in self.manifests.get(release, {})}
+        self.load(release)
+
+    def run_once(self):
+        for release in self.desired:
+            self.load(release)
+        for target in sorted(self.watch_targets(), key=str):
+            if _resource(*target[:2]) is not None:
+                self.list_and_check(target)
+        while (item := self.queue.get(block=False)) is not None:
+            self.process(*item)
+
+    def run_forever(self):
+        for release in self.desired:
+            self.load(release)
+        self.start_watches()
+        threading.Thread(target=self.watch_releases, daemon=True).start()
+        while True:
+            self.process(*self.queue.get())
+            self.start_watches()
+
+
+def _resource(api_version, kind):
+    try:
+        return api.resource(api_version, kind)
+    except Exception:
+        return None
+
+
+def desired_releases(c, selected=()):
+    """{release: {"spec", "task"}} of every deploy task (or of the `selected` releases)."""
+    desired = {}
+    for module, name in deploy_tasks():
+        try:
+            spec = planned_release(c, module, name)
+        except RuntimeError as e:
+            print(f"Warning: {str(e).strip().splitlines()[0]}")
+            continue
+        if not selected or spec["release"] in selected:
+            desired[spec["release"]] = {"spec": spec, "task": (module, name)}
+    return desired
+
+
+@task(help={
+    "releases": "Comma separated releases to reconcile (default: the releases of all deploy tasks)",
+    "daemon": "Keep watching the cluster and reconcile drift as it happens, until interrupted",
+    "settle": "Seconds to wait after a change before reconciling, so a burst of changes causes one upgrade",
+    "rate": "Most reconciles per minute across all releases",
+    "dry_run": "Only report the releases that drifted",
+    "install_missing": "Also install the releases that aren't installed yet (default: only those named in --releases)",
+})
+def reconcile(c, releases="", daemon=False, settle=10, rate=2, dry_run=False, install_missing=False):
+    """Upgrade only the releases that drifted from what their deploy tasks define (--daemon: watch and repeat)"""
+    selected = {release.strip() for release in releases.split(",") if release.strip()}
+    desired = desired_releases(c, selected)
+    unknown = selected - set(desired)
+    if unknown:
+        raise Exit(f"No deploy task installs: {', '.join(sorted(unknown))}", code=1)
+
+    reconciler = Reconciler(c, desired, settle=float(settle) if daemon else 0, rate=float(rate), dry_run=dry_run,
+                            installable=set(desired) if install_missing else selected)
+    print(f"Desired state: {len(desired)} releases")
+    if not daemon:
+        reconciler.run_once()
+        missing = f", {len(reconciler.missing)} not installed" if reconciler.missing else ""
+        print(f"{reconciler.reconciled} releases reconciled{missing}")
+        return
+    try:
+        reconciler.run_forever()
+    except KeyboardInterrupt:
+        print(f"\nStopped, {reconciler.reconciled} releases reconciled")
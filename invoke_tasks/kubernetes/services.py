@@ -1,28 +1,23 @@
 from invoke import task
-import os
 
-@task
-def deploy_ollama(c):
-    kubeconfig = os.environ.get('KUBECONFIG')
+from .helm import upgrade_install
+
+@task(help={"force": "Run the Helm upgrade even if the release is already up to date"})
+def deploy_ollama(c, force=False):
     namespace = "ollama"
 
     print("Deploying Ollama Server...")
-    c.run("helm repo add ollama-helm https://otwld.github.io/ollama-helm/")
-    c.run("helm repo update ollama-helm")
-
-    c.run(f"KUBECONFIG={kubeconfig} helm upgrade --install ollama ollama-helm/ollama --namespace {namespace} --create-namespace \
-           --set ollama.gpu.enabled=false \
-           --set ollama.models[0]=llama3.1 \
-           --set service.type=LoadBalancer")
+    upgrade_install(c, "ollama", "ollama-helm/ollama", namespace, values={
+        "ollama.gpu.enabled": "false",
+        "ollama.models[0]": "llama3.1",
+        "service.type": "LoadBalancer",
+    }, force=force)
 
 
-@task
-def deploy_open_webui(c):
-    kubeconfig = os.environ.get('KUBECONFIG')
+@task(help={"force": "Run the Helm upgrade even if the release is already up to date"})
+def deploy_open_webui(c, force=False):
     namespace = "ollama"
 
     print("Deploying Open WebUI...")
-    c.run("helm repo add open-webui https://helm.openwebui.com/")
-    c.run("helm repo update")
-    c.run(f"KUBECONFIG={kubeconfig} helm upgrade --install open-webui open-webui/open-webui --namespace {namespace} --create-namespace")
+    upgrade_install(c, "open-webui", "open-webui/open-webui", namespace, force=force)
 
@@ -1,8 +1,13 @@
 import os
 import platform
+import time
 from pathlib import Path
 from invoke import task
 
+from invoke_tasks.inventory import on_hosts
+from . import api, cache
+from .purge import purge_namespace
+
 @task
 def setup_cluster(c, name="my-cluster", api_port=6443):
     """Setup a new Kubernetes cluster with kubeadm and install Traefik"""
@@ -21,10 +26,8 @@ def setup_cluster(c, name="my-cluster", api_port=6443):
 
 
 def get_control_plane_node(c):
-    kubeconfig = os.environ.get('KUBECONFIG')
     """Retrieve the control plane node name."""
-    result = c.run(f"KUBECONFIG={kubeconfig} kubectl get nodes --selector='node-role.kubernetes.io/control-plane' -o jsonpath='{{.items[0].metadata.name}}'", hide=True)
-    return result.stdout.strip()
+    return cache.control_plane_node()
 
 
 @task
@@ -37,55 +40,70 @@ def get_kubeconfig(c):
     else:
         print("KUBECONFIG environment variable not set")
 
+CONTROL_PLANE_TAINT = {"key": "node-role.kubernetes.io/control-plane", "effect": "NoSchedule"}
+
+
+def _set_node_taints(node_name, update):
+    """Patch the taints of a node with `update(list_of_taint_dicts)`."""
+    from kubernetes.client.rest import ApiException
+
+    node = cache.nodes().get(node_name) or api.core().read_node(node_name)
+    while True:
+        taints = [{"key": t.key, "value": t.value, "effect": t.effect} for t in node.spec.taints or []]
+        try:
+            # The resourceVersion makes the API server refuse the patch if the cached node is outdated
+            cache.nodes().store(api.core().patch_node(node_name, {
+                "metadata": {"resourceVersion": node.metadata.resource_version},
+                "spec": {"taints": update(taints)},
+            }))
+            return
+        except ApiException as e:
+            if e.status != 409:
+                raise
+            node = api.core().read_node(node_name)
+
+
 @task
 def add_taint(c):
-    kubeconfig = os.environ.get('KUBECONFIG')
     """Add taint to the control plane node to prevent scheduling workloads."""
     node_name = get_control_plane_node(c)
-    taint_cmd = f"KUBECONFIG={kubeconfig} kubectl taint nodes {node_name} node-role.kubernetes.io/control-plane:NoSchedule"
-    c.run(taint_cmd)
+    _set_node_taints(node_name, lambda taints: [t for t in taints if not _is_control_plane_taint(t)] + [CONTROL_PLANE_TAINT])
     print(f"Taint added to {node_name}")
 
 
 @task
 def remove_taint(c):
-    kubeconfig = os.environ.get('KUBECONFIG')
     """Remove taint from the control plane node to allow scheduling workloads."""
     node_name = get_control_plane_node(c)
-    remove_taint_cmd = f"KUBECONFIG={kubeconfig} kubectl taint nodes {node_name} node-role.kubernetes.io/control-plane:NoSchedule-"
-    c.run(remove_taint_cmd)
+    _set_node_taints(node_name, lambda taints: [t for t in taints if not _is_control_plane_taint(t)])
     print(f"Taint removed from {node_name}")
 
 
+def _is_control_plane_taint(taint):
+    return taint["key"] == CONTROL_PLANE_TAINT["key"] and taint["effect"] == CONTROL_PLANE_TAINT["effect"]
 
-@task
-def clean_namespace(c, namespace):
-    kubeconfig = os.environ.get('KUBECONFIG')
 
-    print(f"Cleaning up namespace: {namespace}")
 
-    resource_types = [
-        "deployments",
-        "services",
-        "daemonsets",
-        "statefulsets",
-        "replicasets",
-        "pods",
-        "configmaps",
-        "secrets",
-        "serviceaccounts",
-        "persistentvolumeclaims",
-        "ingresses",
-        "roles",
-        "rolebindings",
-        "clusterrolebindings"  # Be careful with cluster-wide resources
-    ]
+@task(help={
+    "workers": "Number of resource types purged at the same time",
+    "timeout": "Seconds to wait for objects (and their finalizers) to disappear",
+    "force_finalizers": "Remove finalizers from objects stuck terminating for more than 30s",
+})
+def clean_namespace(c, namespace, workers=8, timeout=300, force_finalizers=False):
+    """Delete every namespaced resource (including CRDs) in a namespace and wait until it is gone"""
+    print(f"Cleaning up namespace: {namespace}")
+    start = time.monotonic()
+    report = purge_namespace(namespace, workers=int(workers), timeout=int(timeout), force_finalizers=force_finalizers)
 
-    for resource in resource_types:
-        print(f"Deleting {resource} in {namespace}...")
-        c.run(f"KUBECONFIG={kubeconfig} kubectl delete {resource} --all -n {namespace} --ignore-not-found", warn=True)
+    width = max((len(name) for name in report), default=0)
+    for name, (found, seconds, left) in sorted(report.items(), key=lambda item: -item[1][1]):
+        status = f"{len(left)} left: {', '.join(left)}" if left else "gone"
+        print(f"  {name.ljust(width)}  {found:5d} objects  {seconds:6.1f}s  {status}")
 
-    print(f"Namespace {namespace} cleaned up.")
+    if any(left for _, _, left in report.values()):
+        print(f"Namespace {namespace} not fully cleaned after {time.monotonic() - start:.1f}s.")
+    else:
+        print(f"Namespace {namespace} cleaned up in {time.monotonic() - start:.1f}s.")
 
 
 
@@ -129,18 +147,18 @@ def set_kubeconfig_env(c):
 @task
 def get_cluster_ip(c):
     """Get the IP address of the cluster for connecting worker nodes"""
-    result = c.run("kubectl get nodes -o wide", hide=True)
-    lines = result.stdout.split('\n')
-    if len(lines) > 1:
-        # Split the second line (first node) by whitespace and get the internal IP
-        node_info = lines[1].split()
-        if len(node_info) >= 6:
-            internal_ip = node_info[5]
-            print(f"Cluster IP for connecting worker nodes: {internal_ip}")
-        else:
-            print("Unable to parse node information")
-    else:
+    if not cache.nodes().list():
         print("No nodes found in the cluster")
+        return
+    ips = cache.node_ips()
+    try:
+        ip = ips.get(cache.control_plane_node())
+    except LookupError:
+        ip = next(iter(ips.values()), None)
+    if ip:
+        print(f"Cluster IP for connecting worker nodes: {ip}")
+    else:
+        print("Unable to parse node information")
 
 
 @task
@@ -168,9 +186,15 @@ def clean_network(c):
     print("Network configurations and IP tables reset.")
 
 
-@task
-def stop_kubelet(c):
+@task(help={
+    "group": "Run on all hosts of this inventory group (or comma separated groups/hosts) over SSH",
+    "workers": "Number of hosts worked on at the same time",
+})
+def stop_kubelet(c, group=None, workers=None):
     """Stop and disable kubelet service"""
+    if group:
+        on_hosts(c, group, stop_kubelet, workers, title="stop_kubelet")
+        return
     c.sudo("systemctl stop kubelet")
     c.sudo("systemctl disable kubelet")
     print("Kubelet service stopped and disabled.")
@@ -192,9 +216,15 @@ def restart_docker(c):
     print("Docker service restarted.")
 
 
-@task
-def full_cleanup(c):
+@task(help={
+    "group": "Run on all hosts of this inventory group (or comma separated groups/hosts) over SSH",
+    "workers": "Number of hosts worked on at the same time",
+})
+def full_cleanup(c, group=None, workers=None):
     """Perform full cleanup of stale Kubernetes resources and prepare environment"""
+    if group:
+        on_hosts(c, group, full_cleanup, workers, title="full_cleanup")
+        return
     clean_containers(c)
     clean_network(c)
     stop_kubelet(c)
@@ -203,8 +233,11 @@ def full_cleanup(c):
     print("Full cleanup complete. Environment is ready for a new cluster setup.")
 
 
-@task
-def join_as_worker(c, skip_cert_verification=True):
+@task(help={
+    "group": "Join all hosts of this inventory group (e.g. kube_node) over SSH",
+    "workers": "Number of hosts joined at the same time",
+})
+def join_as_worker(c, skip_cert_verification=True, group=None, workers=None):
     k8s_master_ip = os.getenv("K8S_JOIN_IP")
     k8s_token = os.getenv("K8S_JOIN_TOKEN")
     k8s_ca_cert_hash = os.getenv("K8S_CA_CERT_HASH", None)
@@ -216,6 +249,9 @@ def join_as_worker(c, skip_cert_verification=True):
     join_command = f"kubeadm join {k8s_master_ip}:6443 --token {k8s_token} " \
                    f"{'--discovery-token-unsafe-skip-ca-verification' if skip_cert_verification else f'--discovery-token-ca-cert-hash {k8s_ca_cert_hash}' or ''}"
 
+    if group:
+        on_hosts(c, group, lambda host: host.sudo(join_command), workers, title="join_as_worker")
+        return
     c.sudo(join_command)
 
 
@@ -1,58 +1,345 @@
+import json
+import math
 import os
+import re
+from pathlib import Path
 
-from invoke import task
+import yaml
+from invoke import task, Exit
 
+from invoke_tasks.inventory import on_hosts
+from . import api
+from .helm import upgrade_install
 
-@task
-def deploy_longhorn(c):
-    kubeconfig = os.environ.get('KUBECONFIG')
+
+@task(help={"force": "Run the Helm upgrade even if the release is already up to date"})
+def deploy_longhorn(c, force=False):
     """Deploy Longhorn storage to the Kubernetes cluster"""
-    # Add the Longhorn Helm repository
-    c.run("helm repo add longhorn https://charts.longhorn.io")
-    c.run("helm repo update")
     # Deploy Longhorn
-    c.run(f"KUBECONFIG={kubeconfig} helm upgrade --install longhorn longhorn/longhorn --namespace longhorn-system --create-namespace")
-    c.run(f"KUBECONFIG={kubeconfig} kubectl apply -f k8s/cluster/longhorn-storageclass.yaml")
-    c.run(f"KUBECONFIG={kubeconfig} kubectl patch storageclass longhorn -p '{{\"metadata\": {{\"annotations\":{{\"storageclass.kubernetes.io/is-default-class\":\"true\"}}}}}}'")
+    upgrade_install(c, "longhorn", "longhorn/longhorn", "longhorn-system", force=force)
+    with open("k8s/cluster/longhorn-storageclass.yaml") as f:
+        api.apply(yaml.safe_load(f))
+    api.storage().patch_storage_class("longhorn", {"metadata": {"annotations": {"storageclass.kubernetes.io/is-default-class": "true"}}})
 
 
-@task
-def configure_longhorn_node(c, node_name, storage_path='/mnt/longhorn'):
+@task(help={
+    "group": "Configure all hosts of this inventory group instead of one node, creating the directory over SSH",
+    "workers": "Number of hosts configured at the same time",
+})
+def configure_longhorn_node(c, node_name=None, storage_path='/mnt/longhorn', group=None, workers=None):
     """
     Configure Longhorn to use a specific directory for storage on a specific node.
     
     :param node_name: The name of the Kubernetes node to configure.
     :param storage_path: The directory path to use for Longhorn storage (default is /mnt/longhorn).
+    :param group: Inventory group whose hosts are all configured; node names are the inventory host names.
     """
-    kubeconfig = os.environ.get('KUBECONFIG')
-
-    # YAML configuration to specify disk settings for Longhorn
-    longhorn_disk_yaml = f"""
-    apiVersion: longhorn.io/v1beta1
-    kind: Node
-    metadata:
-      name: {node_name}
-    spec:
-      disks:
-        longhorn-disk:
-          path: {storage_path}
-          allowScheduling: true
-          storageReserved: 1024  # Reserve 1GB for the OS
-      allowScheduling: true
-    """
+    if group:
+        def configure_host(host):
+            host.sudo(f"mkdir -p {storage_path}")
+            configure_longhorn_node(host, host.inventory_name, storage_path)
+
+        on_hosts(c, group, configure_host, workers, title="configure_longhorn_node")
+        return
+    if not node_name:
+        raise Exit("Either node_name or group is required", code=1)
+
+    # Disk settings for the Longhorn node object
+    longhorn_node = {
+        "apiVersion": "longhorn.io/v1beta1",
+        "kind": "Node",
+        "metadata": {"name": node_name, "namespace": "longhorn-system"},
+        "spec": {
+            "disks": {
+                "longhorn-disk": {
+                    "path": storage_path,
+                    "allowScheduling": True,
+                    "storageReserved": 1024,  # Reserve 1GB for the OS
+                },
+            },
+            "allowScheduling": True,
+        },
+    }
 
     # Create the storage directory on the node if it doesn't exist
     # c.run(f"ssh {node_name} 'sudo mkdir -p {storage_path} && sudo chown -R $(whoami):$(whoami) {storage_path}'")
 
-    # Write the configuration to a temporary YAML file
-    yaml_file_path = f"/tmp/{node_name}_longhorn_disk.yaml"
-    with open(yaml_file_path, "w") as f:
-        f.write(longhorn_disk_yaml)
+    api.apply(longhorn_node)
 
-    # Apply the configuration using kubectl
-    c.run(f"KUBECONFIG={kubeconfig} kubectl apply -f {yaml_file_path}")
+    print(f"Longhorn configuration applied for node: {node_name}, using storage path: {storage_path}")
 
-    # Clean up the temporary YAML file
-    os.remove(yaml_file_path)
 
-    print(f"Longhorn configuration applied for node: {node_name}, using storage path: {storage_path}")
+LONGHORN_NODE_API = "longhorn.io/v1beta1"
+
+
+def longhorn_disks(host_vars, storage_path, reserved_gb, tags):
+    """
+    Disk specs of one node: its `longhorn_disks` inventory variable, or a single disk at `storage_path`.
+
+    Each inventory disk may set `path`, `name`, `reserved_gb` and `tags`; missing fields use the defaults.
+    """
+    disks = {}
+    for i, disk in enumerate(host_vars.get("longhorn_disks") or [{"path": storage_path}]):
+        name = disk.get("name") or ("longhorn-disk" if i == 0 else f"longhorn-disk-{i + 1}")
+        disks[name] = {
+            "path": disk.get("path", storage_path),
+            "allowScheduling": True,
+            "storageReserved": int(float(disk.get("reserved_gb", reserved_gb)) * 1024 ** 3),
+            "tags": list(disk.get("tags", tags)),
+        }
+    return disks
+
+
+def _disk_schedulable(disk_status):
+    # v1beta1 keeps conditions in a map by type, v1beta2 in a list
+    conditions = disk_status.get("conditions") or {}
+    if isinstance(conditions, dict):
+        conditions = conditions.values()
+    return any(cond.get("type") == "Schedulable" and cond.get("status") == "True" for cond in conditions)
+
+
+def unschedulable_disks(expected):
+    """[(node, disk, reason)] of the `expected` {node: [disk names]} Longhorn does not schedule on (yet)."""
+    listing = api.dynamic().get(api.resource(LONGHORN_NODE_API, "Node"), namespace="longhorn-system").to_dict()
+    status = {item["metadata"]["name"]: (item.get("status") or {}).get("diskStatus") or {} for item in listing["items"]}
+    pending = []
+    for node, disks in expected.items():
+        for disk in disks:
+            disk_status = status.get(node, {}).get(disk)
+            if disk_status is None:
+                pending.append((node, disk, "no status yet"))
+            elif not _disk_schedulable(disk_status):
+                conditions = disk_status.get("conditions") or {}
+                if isinstance(conditions, dict):
+                    conditions = conditions.values()
+                reasons = [cond.get("message") or cond.get("reason") for cond in conditions if cond.get("status") != "True"]
+                pending.append((node, disk, "; ".join(filter(None, reasons)) or "not schedulable"))
+    return pending
+
+
+@task(help={
+    "source": "'inventory' (hosts of --group, with their longhorn_disks variables) or 'cluster' (the node list)",
+    "group": "Inventory group or hosts to configure with --source inventory",
+    "selector": "Label selector for the nodes with --source cluster, e.g. node-role.kubernetes.io/storage",
+    "storage_path": "Disk path for nodes without longhorn_disks",
+    "reserved_gb": "GiB reserved for the OS on disks without their own reserved_gb",
+    "tags": "Comma separated disk tags for disks without their own tags, e.g. ssd,fast",
+    "mkdir": "Create the disk directories over SSH first (inventory source only)",
+    "workers": "Number of apply requests in flight at the same time",
+    "timeout": "Seconds to wait for the disks to become schedulable (0 skips the check)",
+})
+def configure_longhorn_nodes(c, source="inventory", group="kube_node", selector="", storage_path='/mnt/longhorn',
+                             reserved_gb=1, tags="", mkdir=False, workers=16, timeout=300):
+    """Configure the Longhorn disks of all storage nodes at once and wait until they are schedulable"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    from invoke_tasks.inventory import hosts_in
+    from invoke_tasks.wait import wait_for
+
+    tag_list = [tag.strip() for tag in tags.split(",") if tag.strip()]
+    if source == "inventory":
+        hosts = hosts_in(group)
+    elif source == "cluster":
+        hosts = {node.metadata.name: {} for node in api.core().list_node(label_selector=selector).items}
+    else:
+        raise Exit(f"Unknown source '{source}', use inventory or cluster", code=1)
+    if not hosts:
+        raise Exit(f"No nodes found in {source} ({group if source == 'inventory' else selector or 'all nodes'})", code=1)
+
+    specs = {node: longhorn_disks(host_vars, storage_path, reserved_gb, tag_list) for node, host_vars in hosts.items()}
+
+    if mkdir:
+        if source != "inventory":
+            raise Exit("--mkdir needs --source inventory to reach the nodes over SSH", code=1)
+        on_hosts(c, group, lambda host: host.sudo(
+            "mkdir -p " + " ".join(disk["path"] for disk in specs[host.inventory_name].values())),
+            title="create Longhorn disk directories")
+
+    def apply_node(node):
+        api.apply({
+            "apiVersion": LONGHORN_NODE_API,
+            "kind": "Node",
+            "metadata": {"name": node, "namespace": "longhorn-system"},
+            "spec": {"allowScheduling": True, "disks": specs[node]},
+        })
+        return node
+
+    # Server-side apply takes one object per request; the requests share the API client's
+    # keep-alive connections and go out together, so the whole cluster costs about one round trip
+    with ThreadPoolExecutor(max_workers=int(workers)) as pool:
+        for node in pool.map(apply_node, specs):
+            disks = ", ".join(f"{name}={disk['path']}" for name, disk in specs[node].items())
+            print(f"{node:<24} {disks}")
+
+    if not int(timeout):
+        return
+    expected = {node: list(disks) for node, disks in specs.items()}
+    try:
+        wait_for(lambda: not unschedulable_disks(expected), timeout=int(timeout),
+                 description="Longhorn disks to become schedulable")
+    except TimeoutError as e:
+        for node, disk, reason in unschedulable_disks(expected):
+            print(f"{node:<24} {disk}: {reason}")
+        raise Exit(str(e), code=1)
+    print(f"All {sum(map(len, expected.values()))} disks on {len(expected)} nodes are schedulable")
+
+
+# fio jobs of the storage benchmark, run one after the other (stonewall) in a single fio process
+FIO_PROFILES = {
+    "randread-4k": "--rw=randread --bs=4k --iodepth=32",
+    "randwrite-4k": "--rw=randwrite --bs=4k --iodepth=32",
+    "seqread-1m": "--rw=read --bs=1M --iodepth=8",
+    "seqwrite-1m": "--rw=write --bs=1M --iodepth=8",
+    # One 4k write plus fsync at a time, like a database commit; its latency is the fsync latency
+    "fsync-4k": "--rw=write --bs=4k --iodepth=1 --fsync=1",
+}
+
+# Image with fio for the PVC benchmark; nixery builds it on demand
+FIO_IMAGE = os.getenv("FIO_IMAGE", "nixery.dev/shell/fio")
+
+# Stored storage benchmark results, so runs against different disks and storage classes compare
+STORAGE_RESULTS = Path(os.getenv("STORAGE_RESULTS", ".bench/storage.json"))
+
+
+def size_mib(size):
+    """MiB in a test file size such as 512M, 1G, 1Gi or 1.5GiB (M and G are binary, as for fio)."""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([mg])(?:ib?|b)?\s*", str(size), re.IGNORECASE)
+    if not match:
+        raise Exit(f"Can't read the size '{size}', use a number of M/Mi or G/Gi, e.g. 512M or 1Gi", code=1)
+    mib = float(match.group(1)) * (1024 if match.group(2).lower() == "g" else 1)
+    return math.ceil(mib)
+
+
+def fio_command(directory, size="1G", runtime=30, profiles=FIO_PROFILES):
+    """
+    One fio invocation running `profiles` in turn on the test file `directory`/fio-benchmark, with JSON
+    output. The test file is left behind for the caller to remove.
+    """
+    jobs = " ".join(f"--name={name} {options}" for name, options in profiles.items())
+    return (f"fio --output-format=json --filename={directory}/fio-benchmark --size={size} --direct=1 "
+            f"--ioengine=libaio --time_based --runtime={runtime} --stonewall --group_reporting {jobs}")
+
+
+def parse_fio(output):
+    """{profile: {iops, mib_s, p99_ms}} from fio's JSON output (anything printed before it is ignored)."""
+    report = json.loads(output[output.index("{"):])
+    results = {}
+    for job in report["jobs"]:
+        direction = "read" if job["read"]["io_bytes"] else "write"
+        stats = job[direction]
+        latency = stats["clat_ns"]
+        if job.get("sync", {}).get("lat_ns", {}).get("percentile"):
+            latency = job["sync"]["lat_ns"]
+        results[job["jobname"]] = {
+            "iops": stats["iops"],
+            "mib_s": stats["bw_bytes"] / 1024 / 1024,
+            "p99_ms": latency.get("percentile", {}).get("99.000000", 0) / 1_000_000,
+        }
+    return results
+
+
+def _fio_on_pvc(storage_class, size, runtime, image, namespace="default"):
+    """Run the fio profiles in a Job on a fresh PVC of `storage_class` and return fio's output."""
+    from invoke_tasks.wait import watch_until
+
+    name = f"fio-benchmark-{storage_class}".lower()[:52]
+    # Room for the test file plus filesystem overhead
+    capacity = f"{math.ceil(size_mib(size) / 1024) + 1}Gi"
+    api.apply({
+        "apiVersion": "v1",
+        "kind": "PersistentVolumeClaim",
+        "metadata": {"name": name, "namespace": namespace},
+        "spec": {"accessModes": ["ReadWriteOnce"], "storageClassName": storage_class,
+                 "resources": {"requests": {"storage": capacity}}},
+    })
+    api.apply({
+        "apiVersion": "batch/v1",
+        "kind": "Job",
+        "metadata": {"name": name, "namespace": namespace},
+        "spec": {
+            "backoffLimit": 0,
+            "template": {
+                "metadata": {"labels": {"job-name": name}},
+                "spec": {
+                    "restartPolicy": "Never",
+                    "containers": [{
+                        "name": "fio",
+                        "image": image,
+                        "command": ["sh", "-c", fio_command("/data", size, runtime)],
+                        "volumeMounts": [{"name": "data", "mountPath": "/data"}],
+                    }],
+                    "volumes": [{"name": "data", "persistentVolumeClaim": {"claimName": name}}],
+                },
+            },
+        },
+    })
+    try:
+        pods = watch_until(
+            api.core().list_namespaced_pod,
+            lambda pods: pods and all(pod.status.phase in ("Succeeded", "Failed") for pod in pods.values()),
+            timeout=runtime * len(FIO_PROFILES) + 600, description=f"fio job {name}",
+            namespace=namespace, label_selector=f"job-name={name}",
+        )
+        pod = next(iter(pods.values()))
+        logs = api.core().read_namespaced_pod_log(pod.metadata.name, namespace)
+        if pod.status.phase != "Succeeded":
+            raise Exit(f"fio failed on {storage_class}:\n{logs}", code=1)
+        return logs
+    finally:
+        api.ignore_not_found(api.batch().delete_namespaced_job, name, namespace, propagation_policy="Foreground")
+        api.ignore_not_found(api.core().delete_namespaced_persistent_volume_claim, name, namespace)
+
+
+@task(help={
+    "storage_path": "Directory to benchmark on the nodes (or locally without --group)",
+    "group": "Inventory group or hosts to benchmark storage_path on, over SSH",
+    "storage_class": "Also benchmark a fresh PVC of this StorageClass, e.g. longhorn",
+    "size": "Size of the fio test file, e.g. 512M or 1Gi",
+    "runtime": "Seconds per profile",
+    "image": "Image with fio for the PVC benchmark (default $FIO_IMAGE)",
+    "label": "Suffix for the stored result names, e.g. 'replicas-2'",
+    "skip_node": "Only benchmark the PVC",
+})
+def benchmark_storage(c, storage_path='/mnt/longhorn', group=None, storage_class=None, size="1G", runtime=30,
+                      image=None, label="", skip_node=False):
+    """Benchmark node disks and Longhorn volumes with fio: 4k random, 1M sequential and fsync latency"""
+    runtime = int(runtime)
+    # fio reads M/G as MiB/GiB but not the Mi/Gi spelling, so hand it plain MiB
+    size = f"{size_mib(size)}M"
+    results = {}
+    suffix = f" ({label})" if label else ""
+
+    if not skip_node:
+        command = fio_command(storage_path, size, runtime)
+
+        def run_fio(host):
+            # A separate sudo: chained with &&, the rm would run as the login user and fail on root-owned paths
+            try:
+                return parse_fio(host.sudo(command, hide=True).stdout)
+            finally:
+                host.sudo(f"rm -f {storage_path}/fio-benchmark", hide=True, warn=True)
+
+        if group:
+            def run_on_host(host):
+                results[f"{host.inventory_name}:{storage_path}{suffix}"] = run_fio(host)
+
+            on_hosts(c, group, run_on_host, title="benchmark_storage")
+        else:
+            results[f"local:{storage_path}{suffix}"] = run_fio(c)
+
+    if storage_class:
+        output = _fio_on_pvc(storage_class, size, runtime, image or FIO_IMAGE)
+        results[f"pvc:{storage_class}{suffix}"] = parse_fio(output)
+
+    stored = json.loads(STORAGE_RESULTS.read_text()) if STORAGE_RESULTS.exists() else {}
+    stored.update(results)
+    STORAGE_RESULTS.parent.mkdir(parents=True, exist_ok=True)
+    STORAGE_RESULTS.write_text(json.dumps(stored, indent=1, sort_keys=True))
+
+    # Every stored target, so disks and storage classes measured in earlier runs compare side by side
+    print(f"\n{'target':<40} {'profile':<13} {'IOPS':>9} {'MiB/s':>9} {'p99 ms':>9}")
+    for target, profiles in sorted(stored.items()):
+        marker = "*" if target in results else " "
+        for profile, row in profiles.items():
+            print(f"{marker}{target:<39} {profile:<13} {row['iops']:9.0f} {row['mib_s']:9.1f} {row['p99_ms']:9.2f}")
+    print(f"\n* measured now; all results are kept in {STORAGE_RESULTS}")
@@ -0,0 +1,211 @@
+"""
+Follow the logs of every pod matching a label selector, including pods created while tailing.
+
+Everything runs on one asyncio loop: a pod watch plus one log stream coroutine per container,
+talking to the API server directly (asynchttp), so hundreds of pods cost hundreds of sockets rather
+than hundreds of kubectl processes or threads. Each stream has a bounded ring buffer between it and
+the output. A slow terminal or file makes the buffers fill up, and then the streams stop reading,
+which throttles the API server through TCP flow control (or, with --drop, the oldest buffered
+lines are dropped and counted instead).
+"""
+import asyncio
+import json
+import re
+import sys
+from collections import deque
+from urllib.parse import urlsplit
+
+from invoke import task
+
+from invoke_tasks import asynchttp
+from . import api
+
+
+def _connection():
+    """(API server base URL, auth headers, TLS context) from the shared client's kubeconfig."""
+    configuration = api.api_client().configuration
+    if configuration.refresh_api_key_hook is not None:
+        configuration.refresh_api_key_hook(configuration)
+    headers = {setting["key"]: setting["value"] for setting in configuration.auth_settings().values()
+               if setting["in"] == "header" and setting["value"]}
+    context = None
+    if urlsplit(configuration.host).scheme == "https":
+        context = asynchttp.ssl_context(configuration.ssl_ca_cert, configuration.cert_file, configuration.key_file,
+                                        verify=configuration.verify_ssl)
+    return configuration.host.rstrip("/"), headers, context
+
+
+class _Stream:
+    """Bounded buffer of the lines of one container's log."""
+
+    def __init__(self, prefix, size, drop):
+        self.prefix = prefix
+        self.lines = deque(maxlen=size)
+        self.drop = drop
+        self.dropped = 0
+        self.space = asyncio.Event()
+
+    async def put(self, line):
+        if len(self.lines) == self.lines.maxlen:
+            if self.drop:
+                self.dropped += 1
+            else:
+                self.space.clear()
+                await self.space.wait()
+        self.lines.append(line)
+
+
+class Tail:
+    def __init__(self, namespace, selector, pattern=None, tail_lines=10, buffer_lines=1000, drop=False, sink=None):
+        self.namespace = namespace
+        self.selector = selector
+        self.pattern = re.compile(pattern) if pattern else None
+        self.tail_lines = tail_lines
+        self.buffer_lines = buffer_lines
+        self.drop = drop
+        self.sink = sink or sys.stdout
+        self.streams = {}
+        self.followed = set()
+        self.tasks = set()
+        self.ready = asyncio.Event()
+        self.base, self.headers, self.ssl = _connection()
+
+    async def _get(self, path, **params):
+        return await asynchttp.request(f"{self.base}{path}", params=params, headers=self.headers,
+                                       ssl_context=self.ssl)
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def watch_pods(self):
+        path = f"/api/v1/namespaces/{self.namespace}/pods"
+        resource_version = None
+        while True:
+            try:
+                if resource_version is None:
+                    response = await self._get(path, labelSelector=self.selector)
+                    listing = json.loads(await response.read())
+                    response.close()
+                    for pod in listing["items"]:
+                        self.on_pod(pod)
+                    resource_version = listing["metadata"]["resourceVersion"]
+                response = await self._get(path, labelSelector=self.selector, watch="true",
+                                           resourceVersion=resource_version, timeoutSeconds=300)
+                try:
+                    async for line in response.lines():
+                        event = json.loads(line)
+                        if event["type"] == "ERROR":
+                            # Expired resourceVersion: list again
+                            resource_version = None
+                            break
+                        resource_version = event["object"]["metadata"]["resourceVersion"]
+                        if event["type"] != "DELETED":
+                            self.on_pod(event["object"])
+                finally:
+                    response.close()
+            except (OSError, asynchttp.HTTPStatusError, asyncio.TimeoutError) as e:
+                self.sink.write(f"Warning: pod watch failed ({e}), retrying\n")
+                resource_version = None
+                await asyncio.sleep(2)
+
+    def on_pod(self, pod):
+        name = pod["metadata"]["name"]
+        statuses = (pod.get("status") or {}).get("containerStatuses") or []
+        for status in statuses:
+            state = status.get("state") or {}
+            if "running" not in state and "terminated" not in state:
+                continue
+            key = (name, status["name"], status.get("restartCount", 0))
+            if key in self.followed:
+                continue
+            # A restarted container we already followed only gets its new lines
+            restarted = any(seen[:2] == key[:2] for seen in self.followed)
+            self.followed.add(key)
+            since = (state.get("running") or state.get("terminated") or {}).get("startedAt") if restarted else None
+            prefix = name if len(statuses) == 1 else f"{name}/{status['name']}"
+            self._spawn(self.follow(name, status["name"], prefix, since))
+
+    async def follow(self, pod, container, prefix, since=None):
+        stream = self.streams.setdefault((pod, container), _Stream(prefix, self.buffer_lines, self.drop))
+        params = {"follow": "true", "container": container}
+        if since:
+            params["sinceTime"] = since
+        else:
+            params["tailLines"] = self.tail_lines
+        try:
+            response = await self._get(f"/api/v1/namespaces/{self.namespace}/pods/{pod}/log", **params)
+        except (OSError, asynchttp.HTTPStatusError, asyncio.TimeoutError) as e:
+            await stream.put(f"<log unavailable: {e}>")
+            self.ready.set()
+            return
+        try:
+            async for line in response.lines():
+                text = line.decode(errors="replace").rstrip("\r")
+                if self.pattern and not self.pattern.search(text):
+                    continue
+                await stream.put(text)
+                self.ready.set()
+        finally:
+            response.close()
+
+    def _drain(self, limit=5000):
+        out = []
+        for stream in list(self.streams.values()):
+            if stream.dropped:
+                out.append(f"[{stream.prefix}] ... {stream.dropped} lines dropped, output too slow\n")
+                stream.dropped = 0
+            while stream.lines and len(out) < limit:
+                out.append(f"[{stream.prefix}] {stream.lines.popleft()}\n")
+            stream.space.set()
+        return out
+
+    def _write(self, lines):
+        self.sink.write("".join(lines))
+        self.sink.flush()
+
+    async def write_output(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            lines = self._drain()
+            if lines:
+                # The write runs in a thread so a blocked terminal doesn't stall the loop;
+                # meanwhile the buffers fill up and the streams wait for space
+                await asyncio.to_thread(self._write, lines)
+                self.ready.set()
+
+    async def run(self, duration=None):
+        self._spawn(self.write_output())
+        self._spawn(self.watch_pods())
+        try:
+            await asyncio.sleep(duration) if duration else await asyncio.Event().wait()
+        finally:
+            for running in list(self.tasks):
+                running.cancel()
+            self._write(self._drain(limit=len(self.streams) * self.buffer_lines + len(self.streams)))
+
+
+@task(help={
+    "selector": "Label selector of the pods, e.g. app=gitlab or app.kubernetes.io/instance=harbor",
+    "namespace": "Namespace of the pods",
+    "grep": "Only show lines matching this regular expression",
+    "tail_lines": "Lines of history to show per container when it is first followed",
+    "buffer_lines": "Lines buffered per container between the API server and the output",
+    "drop": "Drop the oldest buffered lines when the output is too slow instead of pausing the streams",
+    "output": "Append to this file instead of printing",
+    "duration": "Stop after this many seconds (default: until Ctrl-C)",
+})
+def tail(c, selector="", namespace="default", grep=None, tail_lines=10, buffer_lines=1000, drop=False, output=None,
+         duration=None):
+    """Follow the logs of all pods matching a selector, including new ones, on a single asyncio loop"""
+    sink = open(output, "a") if output else sys.stdout
+    try:
+        tailer = Tail(namespace, selector, grep, int(tail_lines), int(buffer_lines), drop, sink)
+        asyncio.run(tailer.run(float(duration) if duration else None))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if output:
+            sink.close()
@@ -0,0 +1,109 @@
+import ast
+import importlib
+import importlib.util
+import inspect
+from pathlib import Path
+
+from invoke import Collection, Task
+
+from invoke_tasks import tracing
+
+
+class LazyTask(Task):
+    """
+    Task built from the source of a module without importing it.
+
+    The name, docstring, arguments and @task options are read with `ast`, so `invoke --list` and
+    `invoke --help <task>` cost nothing; the module (and whatever it imports) is only loaded when
+    the task is actually called.
+    """
+
+    def __init__(self, module_name, func_name, signature, doc, **task_options):
+        self.module_name = module_name
+        self.func_name = func_name
+
+        def body(*args, **kwargs):
+            # By now tasks.py has loaded .env, which may set INVOKE_TRACE
+            tracing.install_from_env()
+            return self.load()(*args, **kwargs)
+
+        body.__name__ = func_name
+        body.__qualname__ = func_name
+        body.__module__ = module_name
+        body.__doc__ = doc
+        body.__signature__ = signature
+        super().__init__(body, **task_options)
+
+    def load(self):
+        """Import the real module and return its Task object."""
+        return getattr(importlib.import_module(self.module_name), self.func_name)
+
+
+def _task_options(decorator):
+    """Return the @task(...) keyword options of a decorator node, or None if it isn't @task."""
+    if isinstance(decorator, ast.Name) and decorator.id == "task":
+        return {}
+    if isinstance(decorator, ast.Call) and isinstance(decorator.func, ast.Name) and decorator.func.id == "task":
+        return {keyword.arg: ast.literal_eval(keyword.value) for keyword in decorator.keywords}
+    return None
+
+
+def _signature(func):
+    args = func.args.args
+    defaults = [None] * (len(args) - len(func.args.defaults)) + func.args.defaults
+    parameters = [(arg, default, inspect.Parameter.POSITIONAL_OR_KEYWORD) for arg, default in zip(args, defaults)]
+    # kw_defaults holds None for keyword-only arguments without a default
+    parameters += [(arg, default, inspect.Parameter.KEYWORD_ONLY)
+                   for arg, default in zip(func.args.kwonlyargs, func.args.kw_defaults)]
+    return inspect.Signature([
+        inspect.Parameter(
+            arg.arg,
+            kind,
+            default=inspect.Parameter.empty if default is None else ast.literal_eval(default),
+        )
+        for arg, default, kind in parameters
+    ])
+
+
+def lazy_tasks(module_name, path):
+    """
+    Yield a LazyTask for every @task function defined at the top level of the file `path`.
+
+    A task whose @task options or argument defaults aren't literals (e.g. a constant from another
+    module) can't be read from the source; the module is then imported and its real Task yielded.
+    """
+    tree = ast.parse(Path(path).read_text(encoding="utf-8"), filename=str(path))
+    for node in tree.body:
+        if not isinstance(node, ast.FunctionDef):
+            continue
+        try:
+            options = next((options for options in map(_task_options, node.decorator_list) if options is not None),
+                           None)
+            if options is None:
+                continue
+            lazy_task = LazyTask(module_name, node.name, _signature(node), ast.get_docstring(node), **options)
+        except ValueError:
+            lazy_task = getattr(importlib.import_module(module_name), node.name)
+        yield lazy_task
+
+
+def lazy_collection(module_name, name=None):
+    """
+    Collection of the tasks in a module, or in all modules of a package, without importing them.
+    """
+    spec = importlib.util.find_spec(module_name)
+    if spec.submodule_search_locations:
+        sources = [
+            (f"{module_name}.{path.stem}", path)
+            for location in spec.submodule_search_locations
+            for path in sorted(Path(location).glob("*.py"))
+            if path.stem != "__init__"
+        ]
+    else:
+        sources = [(module_name, spec.origin)]
+
+    collection = Collection(name or module_name.rsplit(".", 1)[-1])
+    for source_module, path in sources:
+        for lazy_task in lazy_tasks(source_module, path):
+            collection.add_task(lazy_task)
+    return collection
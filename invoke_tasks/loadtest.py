@@ -0,0 +1,186 @@
+"""
+HTTP load generator on asyncio, for measuring a serving path such as a Traefik ingress route.
+
+Two ways to drive the target, over keep-alive connections (asynchttp.Connection):
+
+- fixed concurrency (closed loop): `concurrency` clients each send their next request as soon as
+  the previous one completed, so the request rate is whatever the server sustains;
+- fixed rate (open loop): requests are scheduled every 1/rate seconds, whether or not earlier ones
+  completed, on up to `concurrency` connections. Latency is measured from the scheduled time, so
+  time spent waiting for a free connection counts too, and a stalling server shows up in the high
+  percentiles instead of quietly lowering the rate (coordinated omission).
+
+Latencies go into a Histogram with HDR-style buckets: exact below 256µs, then 128 linear
+sub-buckets per power of two, i.e. under 1% error at any magnitude in a few KB.
+"""
+import asyncio
+import time
+from collections import Counter
+
+from invoke_tasks import asynchttp
+
+SUB_BUCKET_BITS = 8
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+
+class Histogram:
+    """Latency histogram in microseconds with HDR-style log-linear buckets."""
+
+    def __init__(self):
+        self.counts = Counter()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    @staticmethod
+    def index(value):
+        if value < SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - SUB_BUCKET_BITS
+        return (shift << (SUB_BUCKET_BITS - 1)) + (value >> shift)
+
+    @staticmethod
+    def value(index):
+        """Midpoint of the values that fall into bucket `index`."""
+        if index < SUB_BUCKETS:
+            return index
+        shift = (index >> (SUB_BUCKET_BITS - 1)) - 1
+        low = (index - (shift << (SUB_BUCKET_BITS - 1))) << shift
+        return low + ((1 << shift) - 1) / 2
+
+    def record(self, microseconds):
+        value = max(0, int(microseconds))
+        self.counts[self.index(value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0
+        rank = max(1, round(self.count * percent / 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self.value(index), self.max)
+        return self.max
+
+    def summary(self):
+        """Milliseconds at the usual percentiles."""
+        return {
+            "p50": self.percentile(50) / 1000,
+            "p90": self.percentile(90) / 1000,
+            "p99": self.percentile(99) / 1000,
+            "p999": self.percentile(99.9) / 1000,
+            "max": self.max / 1000,
+            "mean": self.total / self.count / 1000 if self.count else 0,
+        }
+
+    def buckets(self):
+        """[[microseconds, count], ...] of the non-empty buckets, to store and compare runs."""
+        return [[self.value(index), self.counts[index]] for index in sorted(self.counts)]
+
+
+class LoadTest:
+    def __init__(self, url, host=None, method="GET", rate=None, concurrency=10, duration=10, timeout=10,
+                 ssl_context=None):
+        self.url = url
+        self.headers = {"Host": host} if host else {}
+        self.method = method
+        self.rate = rate
+        self.concurrency = concurrency
+        self.duration = duration
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self.histogram = Histogram()
+        self.statuses = Counter()
+        self.errors = Counter()
+        self.connections = asyncio.Queue()
+        self.opened = 0
+
+    def _connection(self):
+        # A Connection reconnects by itself after a failure, so each client keeps its one object
+        self.opened += 1
+        return asynchttp.Connection(self.url, self.ssl_context, self.timeout)
+
+    async def _send(self, connection, started):
+        """One request on `connection`; latency is counted from `started` (perf_counter seconds)."""
+        try:
+            status, _, _ = await asyncio.wait_for(
+                connection.request(self.method, headers=self.headers), self.timeout)
+        except asyncio.TimeoutError:
+            connection.close()
+            self.errors["timeout"] += 1
+            return
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            self.errors[type(e).__name__] += 1
+            return
+        self.statuses[status] += 1
+        if status >= 400:
+            self.errors[f"HTTP {status}"] += 1
+        self.histogram.record((time.perf_counter() - started) * 1e6)
+
+    async def _closed_loop(self, deadline):
+        connection = self._connection()
+        try:
+            while time.perf_counter() < deadline:
+                await self._send(connection, time.perf_counter())
+        finally:
+            connection.close()
+
+    async def _scheduled(self, scheduled):
+        connection = await self.connections.get()
+        try:
+            await self._send(connection, scheduled)
+        finally:
+            self.connections.put_nowait(connection)
+
+    async def _open_loop(self, start, deadline):
+        for _ in range(self.concurrency):
+            self.connections.put_nowait(self._connection())
+        pending = set()
+        sent = 0
+        while True:
+            scheduled = start + sent / self.rate
+            if scheduled >= deadline:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            request = asyncio.create_task(self._scheduled(scheduled))
+            pending.add(request)
+            request.add_done_callback(pending.discard)
+            sent += 1
+        if pending:
+            await asyncio.wait(pending)
+        while not self.connections.empty():
+            self.connections.get_nowait().close()
+
+    async def run(self):
+        start = time.perf_counter()
+        deadline = start + self.duration
+        if self.rate:
+            await self._open_loop(start, deadline)
+        else:
+            await asyncio.gather(*(self._closed_loop(deadline) for _ in range(self.concurrency)))
+        elapsed = time.perf_counter() - start
+        requests = sum(self.statuses.values()) + sum(count for error, count in self.errors.items()
+                                                     if not error.startswith("HTTP "))
+        failed = sum(self.errors.values())
+        return {
+            "url": self.url,
+            "host": self.headers.get("Host"),
+            "mode": f"rate {self.rate:g}/s" if self.rate else f"concurrency {self.concurrency}",
+            "duration": round(elapsed, 2),
+            "requests": requests,
+            "rps": round(requests / elapsed, 1),
+            "error_rate": round(failed / requests, 4) if requests else 0,
+            "errors": dict(self.errors),
+            "statuses": {str(status): count for status, count in sorted(self.statuses.items())},
+            "connections": self.opened,
+            "latency_ms": {key: round(value, 3) for key, value in self.histogram.summary().items()},
+            "histogram_us": self.histogram.buckets(),
+        }
@@ -0,0 +1,171 @@
+import contextvars
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+
+from invoke import Context
+from invoke.runners import normalize_hide
+
+_print_lock = threading.Lock()
+_thread_streams = threading.local()
+
+
+class PrefixedStream:
+    """Line-buffered writer that prefixes every line with a label, e.g. `[harbor] ...`."""
+
+    def __init__(self, prefix, stream=None):
+        self.prefix = prefix
+        self.stream = stream or sys.__stdout__
+        self._buffer = ""
+
+    def write(self, data):
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split("\n")
+        if lines:
+            with _print_lock:
+                for line in lines:
+                    self.stream.write(f"[{self.prefix}] {line.rstrip(chr(13))}\n")
+                self.stream.flush()
+        return len(data)
+
+    def flush(self):
+        # Partial lines stay buffered until the newline arrives, so prefixes never interleave
+        pass
+
+    def close(self):
+        if self._buffer:
+            self.write("\n")
+
+    def isatty(self):
+        return False
+
+
+class _ThreadRoutedStdout:
+    """sys.stdout replacement sending print() output to the current thread's PrefixedStream."""
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+    def _target(self):
+        return getattr(_thread_streams, "stream", None) or self.fallback
+
+    def write(self, data):
+        return self._target().write(data)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.fallback, name)
+
+
+@contextmanager
+def routed_stdout():
+    """Route print() output of worker threads through their own PrefixedStream while active."""
+    original = sys.stdout
+    sys.stdout = _ThreadRoutedStdout(original)
+    try:
+        yield
+    finally:
+        sys.stdout = original
+
+
+class PrefixedOutput:
+    """Context mixin writing command output to `self._stream` instead of the terminal."""
+
+    def run(self, command, **kwargs):
+        return super().run(command, **self._stream_kwargs(kwargs))
+
+    def sudo(self, command, **kwargs):
+        return super().sudo(command, **self._stream_kwargs(kwargs))
+
+    def _stream_kwargs(self, kwargs):
+        # invoke shows any stream passed explicitly, so only route the ones that aren't hidden
+        hidden = normalize_hide(kwargs.get("hide", self.config.run.hide))
+        if "stdout" not in hidden:
+            kwargs.setdefault("out_stream", self._stream)
+        if "stderr" not in hidden:
+            kwargs.setdefault("err_stream", self._stream)
+        # Parallel steps must not compete for the terminal's stdin
+        kwargs.setdefault("in_stream", False)
+        return kwargs
+
+
+class PrefixedContext(PrefixedOutput, Context):
+    """Invoke context whose commands write through a PrefixedStream and never read the terminal."""
+
+    def __init__(self, config, stream):
+        super().__init__(config=config)
+        self._set(_stream=stream)
+
+
+def run_dag(c, steps, workers=4, make_context=None):
+    """
+    Run `steps` ({name: (func, [dependency names])}) on a bounded thread pool.
+
+    Each step is called as `func(ctx)` with a PrefixedContext labelled with the step name, as soon as
+    all of its dependencies have succeeded. Steps whose dependencies failed are skipped.
+    `make_context(name, stream)` can supply another context per step, e.g. an SSH connection; its
+    commands should write to `stream`.
+    Returns {name: (status, seconds)} with status one of "ok", "failed" or "skipped".
+    """
+    width = max(len(name) for name in steps)
+    output = sys.stdout
+    results = {}
+    pending = dict(steps)
+    running = {}
+
+    def run_step(name, func):
+        stream = PrefixedStream(name.ljust(width), output)
+        if make_context:
+            ctx = make_context(name, stream)
+        else:
+            ctx = PrefixedContext(c.config.clone(), stream)
+        _thread_streams.stream = stream
+        start = time.monotonic()
+        try:
+            func(ctx)
+        finally:
+            stream.close()
+            _thread_streams.stream = None
+        return time.monotonic() - start
+
+    with routed_stdout(), ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            for name, (func, deps) in list(pending.items()):
+                statuses = [results[dep][0] for dep in deps if dep in results]
+                if any(status != "ok" for status in statuses):
+                    results[name] = ("skipped", 0.0)
+                    del pending[name]
+                elif len(statuses) == len(deps):
+                    # Copy the context so context variables (e.g. the tracing task stack) reach the step
+                    running[pool.submit(contextvars.copy_context().run, run_step, name, func)] = (name, time.monotonic())
+                    del pending[name]
+
+            if not running:
+                if pending:
+                    raise ValueError(f"Unresolvable dependencies for steps: {', '.join(pending)}")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, started = running.pop(future)
+                try:
+                    results[name] = ("ok", future.result())
+                except BaseException as e:
+                    result = getattr(e, "result", None)
+                    reason = f"'{result.command.strip()}' exited with {result.exited}" if result is not None else repr(e)
+                    print(f"[{name}] failed: {reason}")
+                    results[name] = ("failed", time.monotonic() - started)
+
+    return {name: results[name] for name in steps}
+
+
+def print_summary(results, title="Summary"):
+    """Print a status/duration table for the results of run_dag."""
+    print(f"\n{title}:")
+    width = max((len(name) for name in results), default=0)
+    for name, (status, seconds) in results.items():
+        print(f"  {name.ljust(width)}  {status:<8} {seconds:7.1f}s")
@@ -0,0 +1,261 @@
+"""
+Pushing local images to our Docker registry without re-sending what it already has.
+
+Before pushing, the registry's v2 API is asked for the image's manifest. When it exists and points
+at the same image config (the local image ID), the image is skipped without tagging or pushing.
+Otherwise the image is tagged and pushed through the Engine API. Layers the registry already holds
+are then only checked by the daemon ("Layer already exists"), and the byte counts come from the
+pushed manifest.
+
+Credentials are the docker CLI's (~/.docker/config.json, including credential helpers) unless given
+explicitly. They are used for the registry's Basic or Bearer token challenge, and passed to the
+daemon for the push.
+"""
+import base64
+import fnmatch
+import json
+import os
+import re
+import ssl
+import subprocess
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from urllib.parse import quote, urlencode
+
+from invoke_tasks.docker import engine_request, engine_stream
+
+# Registry pushed to when none is given: the local registry from create_docker_registry
+REGISTRY = os.getenv("REGISTRY", "localhost:5000")
+
+# The docker CLI's config, where `docker login` stores credentials (or the name of a credential helper)
+DOCKER_CONFIG = Path(os.getenv("DOCKER_CONFIG", Path.home() / ".docker")) / "config.json"
+
+# Authorization header per (registry, repository), reused until the registry rejects it
+_authorizations = {}
+_authorizations_lock = threading.Lock()
+
+MANIFEST_TYPES = ", ".join([
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.index.v1+json",
+])
+
+
+def registry_url(registry):
+    """Base URL of a registry: plain http for localhost (like the Docker daemon), https otherwise."""
+    if "://" in registry:
+        return registry.rstrip("/")
+    host = registry.split(":")[0]
+    scheme = "http" if host in ("localhost", "127.0.0.1") else "https"
+    return f"{scheme}://{registry}"
+
+
+def registry_host(registry):
+    return registry.split("://")[-1].rstrip("/")
+
+
+def docker_credentials(registry):
+    """(username, password) the docker CLI has for `registry` after `docker login`, or None."""
+    try:
+        config = json.loads(DOCKER_CONFIG.read_text())
+    except FileNotFoundError:
+        return None
+    host = registry_host(registry)
+    for key, entry in (config.get("auths") or {}).items():
+        # Keys are hosts or URLs like https://index.docker.io/v1/
+        if registry_host(key).split("/")[0] == host and entry.get("auth"):
+            username, _, password = base64.b64decode(entry["auth"]).decode().partition(":")
+            return username, password
+    helper = (config.get("credHelpers") or {}).get(host) or config.get("credsStore")
+    if helper:
+        result = subprocess.run([f"docker-credential-{helper}", "get"], input=host, capture_output=True, text=True)
+        if result.returncode == 0:
+            stored = json.loads(result.stdout)
+            return stored["Username"], stored["Secret"]
+    return None
+
+
+def _basic(credentials):
+    return "Basic " + base64.b64encode(":".join(credentials).encode()).decode()
+
+
+def _authorization(challenge, credentials):
+    """The Authorization header answering a WWW-Authenticate `challenge` (Basic, or a Bearer token service)."""
+    scheme, _, params = challenge.partition(" ")
+    if scheme.lower() == "basic":
+        if credentials is None:
+            raise PermissionError("The registry requires a login: run `docker login` or pass --username/--password")
+        return _basic(credentials)
+    fields = dict(re.findall(r'(\w+)="([^"]*)"', params))
+    query = urlencode({key: fields[key] for key in ("service", "scope") if key in fields})
+    request = urllib.request.Request(f"{fields['realm']}?{query}")
+    if credentials is not None:
+        request.add_header("Authorization", _basic(credentials))
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            body = json.load(response)
+    except urllib.error.HTTPError as e:
+        if e.code in (401, 403):
+            refused = "the credentials" if credentials else "an anonymous login"
+            raise PermissionError(f"The registry's token service refused {refused}: "
+                                  "run `docker login` or pass --username/--password") from e
+        raise
+    return f"Bearer {body.get('token') or body['access_token']}"
+
+
+def registry_auth(registry, credentials):
+    """X-Registry-Auth header value for a daemon push to `registry`."""
+    auth = {}
+    if credentials is not None:
+        auth = {"username": credentials[0], "password": credentials[1], "serveraddress": registry_host(registry)}
+    return base64.urlsafe_b64encode(json.dumps(auth).encode()).decode()
+
+
+def split_image(image):
+    """'ghcr.io/org/app:1.2' -> ('org/app', '1.2'); the source registry host is dropped."""
+    name, tag = image, "latest"
+    if ":" in image.rsplit("/", 1)[-1]:
+        name, tag = image.rsplit(":", 1)
+    first, _, rest = name.partition("/")
+    if rest and ("." in first or ":" in first or first == "localhost"):
+        name = rest
+    return name, tag
+
+
+def source_repository(image):
+    """'nginx:1.25' -> 'docker.io/library/nginx': the repository with its registry, as containerd names it."""
+    name = image.split("@")[0]
+    if ":" in name.rsplit("/", 1)[-1]:
+        name = name.rsplit(":", 1)[0]
+    first, _, rest = name.partition("/")
+    if not rest:
+        return f"docker.io/library/{name}"
+    if "." in first or ":" in first or first == "localhost":
+        return name
+    return f"docker.io/{name}"
+
+
+def remote_manifest(registry, repository, reference, credentials=None):
+    """The manifest of repository:reference in the registry, or None if it has none."""
+    url = f"{registry_url(registry)}/v2/{repository}/manifests/{reference}"
+    context = ssl.create_default_context() if url.startswith("https") else None
+    key = (registry_host(registry), repository)
+    for attempt in range(2):
+        request = urllib.request.Request(url, headers={"Accept": MANIFEST_TYPES})
+        with _authorizations_lock:
+            authorization = _authorizations.get(key)
+        if authorization:
+            request.add_header("Authorization", authorization)
+        try:
+            with urllib.request.urlopen(request, timeout=30, context=context) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            challenge = e.headers.get("WWW-Authenticate")
+            if e.code != 401 or not challenge or attempt:
+                raise
+            # No or an expired token: answer the challenge and retry once
+            authorization = _authorization(challenge, credentials)
+            with _authorizations_lock:
+                _authorizations[key] = authorization
+
+
+def local_images(patterns):
+    """
+    Tags of local images matching comma separated names or globs.
+
+    A name without a tag means `:latest`, like the docker CLI; a glob without a tag matches all tags.
+    """
+    tags = [tag for image in engine_request("GET", "/images/json")
+            for tag in image.get("RepoTags") or [] if tag != "<none>:<none>"]
+    selected = []
+    for pattern in (part.strip() for part in patterns.split(",")):
+        if not pattern:
+            continue
+        if ":" not in pattern.rsplit("/", 1)[-1]:
+            pattern += ":*" if any(char in pattern for char in "*?[") else ":latest"
+        matches = fnmatch.filter(tags, pattern)
+        if not matches:
+            raise ValueError(f"No local image matches '{pattern}'")
+        selected += matches
+    return list(dict.fromkeys(selected))
+
+
+def _layer_sizes(manifest, image):
+    """{short diff id: compressed size} of the layers of a pushed image."""
+    diff_ids = image["RootFS"]["Layers"]
+    return {diff_id.split(":")[1][:12]: layer["size"] for diff_id, layer in zip(diff_ids, manifest["layers"])}
+
+
+def push_image(image, registry=REGISTRY, credentials=None, keep_source=False):
+    """
+    Push a local image to `registry` unless it already has it, as the (username, password) `credentials`.
+
+    The source registry host is dropped from the pushed path, unless `keep_source`: then
+    `quay.io/org/app` is pushed as `<registry>/quay.io/org/app`, where a containerd mirror with
+    override_path finds it.
+
+    Returns a dict with the target, whether it was "skipped" or "pushed", and the uploaded and
+    skipped byte counts.
+    """
+    repository, tag = split_image(image)
+    if keep_source:
+        repository = source_repository(image)
+    target = f"{registry.split('://')[-1]}/{repository}:{tag}"
+    local = engine_request("GET", f"/images/{quote(image, safe='')}/json")
+
+    manifest = remote_manifest(registry, repository, tag, credentials)
+    if manifest and manifest.get("config", {}).get("digest") == local["Id"]:
+        size = manifest["config"]["size"] + sum(layer["size"] for layer in manifest["layers"])
+        return {"image": image, "target": target, "status": "skipped", "uploaded": 0, "skipped": size}
+
+    engine_request("POST", f"/images/{quote(image, safe='')}/tag",
+                   params={"repo": target.rsplit(":", 1)[0], "tag": tag})
+    auth = registry_auth(registry, credentials)
+    layer_status = {}
+    digest = None
+    for message in engine_stream("POST", f"/images/{quote(target.rsplit(':', 1)[0], safe='')}/push",
+                                 params={"tag": tag}, headers={"X-Registry-Auth": auth}):
+        if "error" in message:
+            raise RuntimeError(f"Pushing {target} failed: {message['error']}")
+        if message.get("id") and message.get("status"):
+            layer_status[message["id"]] = message["status"]
+        digest = (message.get("aux") or {}).get("Digest", digest)
+
+    pushed = remote_manifest(registry, repository, digest or tag, credentials)
+    sizes = _layer_sizes(pushed, local)
+    uploaded = sum(size for layer, size in sizes.items() if layer_status.get(layer) == "Pushed")
+    return {
+        "image": image,
+        "target": target,
+        "status": "pushed",
+        "uploaded": uploaded + pushed["config"]["size"],
+        "skipped": sum(sizes.values()) - uploaded,
+    }
+
+
+def push_images(patterns, registry=REGISTRY, workers=4, credentials=None, keep_source=False):
+    """
+    Push the images matching `patterns` concurrently; returns the push_image results, failures included.
+
+    Without `credentials` the docker CLI's for `registry` are used, if it has any.
+    """
+    images = local_images(patterns)
+    credentials = credentials or docker_credentials(registry)
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(push_image, image, registry, credentials, keep_source): image for image in images}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"image": futures[future], "target": "", "status": "failed", "error": str(e),
+                          "uploaded": 0, "skipped": 0}
+            print(f"{result['status']:<8} {result['image']}" + (f": {result['error']}" if "error" in result else ""))
+            results.append(result)
+    return results
@@ -0,0 +1,140 @@
+"""
+Opt-in tracing of every command the tasks run.
+
+Set INVOKE_TRACE to a file name to enable it, e.g.
+
+    INVOKE_TRACE=trace.json invoke k8s.bootstrap
+
+Every `c.run` / `c.sudo` (and `run` / `sudo` on a fabric Connection, when fabric is installed) is
+recorded with its start and end time, exit code, stdout/stderr size, the host for fabric, and the
+chain of tasks that called it (also through nested calls such as full_cleanup -> clean_network),
+and every task call becomes a span around its commands. When invoke exits the spans are written as
+a Chrome trace (open it in chrome://tracing or https://ui.perfetto.dev) and the slowest commands are
+printed. INVOKE_TRACE_TOP sets how many (default 15).
+
+The variables are read when the first task runs rather than on import, so they can also be set
+in the .env file that tasks.py loads.
+"""
+import atexit
+import contextvars
+import json
+import os
+import threading
+import time
+
+from invoke import Context, Task
+
+# Names of the tasks the current code runs in, outermost first. A context variable rather than a
+# thread-local, so steps that run_dag hands to worker threads keep the task that started them.
+_task_stack = contextvars.ContextVar("task_stack", default=())
+_lock = threading.Lock()
+_spans = []
+_installed = False
+
+
+def _micros(seconds):
+    return int(seconds * 1_000_000)
+
+
+def _record(name, category, start, end, **args):
+    with _lock:
+        _spans.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": _micros(start),
+            "dur": _micros(end - start),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        })
+
+
+def _traced_command(method, kind, remote=False):
+    def traced(self, command, **kwargs):
+        tasks = " > ".join(_task_stack.get()) or "-"
+        start = time.time()
+        result = None
+        try:
+            result = method(self, command, **kwargs)
+            return result
+        except Exception as e:
+            # UnexpectedExit carries the failed Result, anything else (e.g. a watcher error) does not
+            result = getattr(e, "result", None)
+            raise
+        finally:
+            # fabric Connections run the command on another machine; keep which one
+            host = {"host": self.host} if remote else {}
+            _record(command.strip(), kind, start, time.time(), task=tasks, **host,
+                    exit_code=result.exited if result is not None else None,
+                    stdout_bytes=len(result.stdout) if result is not None else 0,
+                    stderr_bytes=len(result.stderr) if result is not None else 0)
+    return traced
+
+
+def _traced_task_call(call):
+    def traced(self, *args, **kwargs):
+        from invoke_tasks.lazy import LazyTask
+
+        # A LazyTask only forwards to the real task, which gets traced itself
+        if isinstance(self, LazyTask):
+            return call(self, *args, **kwargs)
+        stack = _task_stack.get() + (self.name,)
+        token = _task_stack.set(stack)
+        start = time.time()
+        try:
+            return call(self, *args, **kwargs)
+        finally:
+            _record(self.name, "task", start, time.time(), task=" > ".join(stack))
+            _task_stack.reset(token)
+    return traced
+
+
+def install(path, top=15):
+    """Start tracing commands and task calls, writing the trace to `path` when the process exits."""
+    global _installed
+    if _installed:
+        return
+    _installed = True
+    Context.run = _traced_command(Context.run, "run")
+    Context.sudo = _traced_command(Context.sudo, "sudo")
+    try:
+        from fabric import Connection
+    except ImportError:
+        pass
+    else:
+        # Connection overrides run/sudo to go over SSH; its local() goes through Context.run
+        Connection.run = _traced_command(Connection.run, "run", remote=True)
+        Connection.sudo = _traced_command(Connection.sudo, "sudo", remote=True)
+    Task.__call__ = _traced_task_call(Task.__call__)
+    atexit.register(write_trace, path, top)
+
+
+def install_from_env():
+    """Start tracing if INVOKE_TRACE is set."""
+    if not _installed and os.getenv("INVOKE_TRACE"):
+        install(os.environ["INVOKE_TRACE"], top=int(os.getenv("INVOKE_TRACE_TOP", 15)))
+
+
+def write_trace(path, top=15):
+    """Write the recorded spans as a Chrome trace and print the `top` slowest commands."""
+    with _lock:
+        spans = list(_spans)
+    with open(path, "w") as f:
+        json.dump({"traceEvents": spans, "displayTimeUnit": "ms"}, f)
+
+    commands = sorted((span for span in spans if span["cat"] != "task"), key=lambda span: -span["dur"])
+    if not commands:
+        return
+    total = sum(span["dur"] for span in commands) / 1_000_000
+    print(f"\n{len(commands)} commands, {total:.1f}s in total, trace written to {path}")
+    print(f"{'seconds':>8} {'exit':>5} {'stdout':>8} {'stderr':>7}  {'task':<36} command")
+    for span in commands[:top]:
+        args = span["args"]
+        exit_code = "-" if args["exit_code"] is None else args["exit_code"]
+        caller = args["task"] if len(args["task"]) <= 36 else "..." + args["task"][-33:]
+        command = ("sudo " if span["cat"] == "sudo" else "") + span["name"].replace("\n", " ")
+        if "host" in args:
+            command = f"{args['host']}: {command}"
+        print(f"{span['dur'] / 1_000_000:8.2f} {exit_code:>5} {args['stdout_bytes']:>8} {args['stderr_bytes']:>7}  "
+              f"{caller:<36} {command[:100]}")
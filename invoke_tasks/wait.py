@@ -0,0 +1,126 @@
+import socket
+import time
+
+
+def wait_for(check, timeout=120, interval=0.25, max_interval=5, description="condition"):
+    """
+    Call `check()` until it returns something truthy and return that value.
+
+    Retries back off exponentially from `interval` up to `max_interval` seconds, so a condition that
+    is already true costs a single call. Raises TimeoutError after `timeout` seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        result = check()
+        if result:
+            return result
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Timed out after {timeout}s waiting for {description}")
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
+
+
+def port_open(host, port, timeout=1):
+    """True if something accepts TCP connections on host:port."""
+    try:
+        with socket.create_connection((host, int(port)), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def wait_for_port(host, port, timeout=60):
+    """Wait until host:port accepts connections."""
+    return wait_for(lambda: port_open(host, port), timeout=timeout, description=f"{host}:{port} to accept connections")
+
+
+def watch_until(list_func, condition, timeout=300, description="condition", **list_kwargs):
+    """
+    Wait for `condition({name: object})` on a Kubernetes list, driven by a watch stream.
+
+    `list_func` is a list method of the API client (e.g. `api.core().list_namespaced_pod`). The objects
+    are listed once, then kept up to date from watch events, and the condition is re-evaluated after
+    every event, so this returns the moment it holds. A broken or expired watch is re-listed with
+    backoff. Returns the objects as they were when the condition held.
+    """
+    from kubernetes import watch
+    from kubernetes.client.rest import ApiException
+
+    deadline = time.monotonic() + timeout
+
+    def current_state():
+        listing = list_func(**list_kwargs)
+        return {item.metadata.name: item for item in listing.items}, listing.metadata.resource_version
+
+    objects, resource_version = current_state()
+    backoff = 0.25
+    while not condition(objects):
+        remaining = int(deadline - time.monotonic())
+        if remaining <= 0:
+            raise TimeoutError(f"Timed out after {timeout}s waiting for {description}")
+        watcher = watch.Watch()
+        received = 0
+        try:
+            for event in watcher.stream(list_func, resource_version=resource_version,
+                                        timeout_seconds=remaining, **list_kwargs):
+                received += 1
+                item = event["object"]
+                resource_version = item.metadata.resource_version
+                if event["type"] == "DELETED":
+                    objects.pop(item.metadata.name, None)
+                else:
+                    objects[item.metadata.name] = item
+                if condition(objects):
+                    watcher.stop()
+                    break
+        except ApiException:
+            # Expired resourceVersion or a broken stream: back off, re-list and resume watching
+            received = 0
+            objects, resource_version = current_state()
+        if not received:
+            time.sleep(min(backoff, max(0, deadline - time.monotonic())))
+            backoff = min(backoff * 2, 5)
+    return objects
+
+
+def pod_ready(pod):
+    if pod.status.phase == "Succeeded":
+        return True
+    return any(cond.type == "Ready" and cond.status == "True" for cond in pod.status.conditions or [])
+
+
+def wait_for_pods_ready(namespace, label_selector=None, timeout=300):
+    """Wait until the namespace has pods (matching `label_selector`) and all of them are Ready."""
+    from invoke_tasks.kubernetes import api
+
+    last_report = [None]
+
+    def all_ready(pods):
+        ready = sum(pod_ready(pod) for pod in pods.values())
+        if (ready, len(pods)) != last_report[0]:
+            print(f"{ready}/{len(pods)} pods ready in {namespace}")
+            last_report[0] = (ready, len(pods))
+        return pods and ready == len(pods)
+
+    kwargs = {"label_selector": label_selector} if label_selector else {}
+    return watch_until(api.core().list_namespaced_pod, all_ready, timeout=timeout,
+                       description=f"pods in {namespace} to become Ready", namespace=namespace, **kwargs)
+
+
+def deployment_rolled_out(deployment):
+    """Like `kubectl rollout status`: the current spec is observed and all replicas are updated and available."""
+    status, replicas = deployment.status, deployment.spec.replicas or 0
+    return (status.observed_generation or 0) >= deployment.metadata.generation and (
+        (status.updated_replicas or 0) == replicas == (status.replicas or 0) == (status.available_replicas or 0))
+
+
+def wait_for_rollout(namespace, name, timeout=300):
+    """Wait until the Deployment `name` finished rolling out its current spec."""
+    from invoke_tasks.kubernetes import api
+
+    return watch_until(api.apps().list_namespaced_deployment,
+                       lambda deployments: name in deployments and deployment_rolled_out(deployments[name]),
+                       timeout=timeout, description=f"deployment {name} in {namespace} to roll out",
+                       namespace=namespace, field_selector=f"metadata.name={name}")[name]
+